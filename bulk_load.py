@@ -0,0 +1,93 @@
+"""
+Bulk-load (backfill) path that bypasses per-row ``INSERT ... ON CONFLICT``.
+
+``merge_rebuild`` builds the merged table set-wise: the existing rows whose key is not in the
+batch (anti-join) plus every batch row (merged with the stored row on a key conflict), inserted into a fresh copy of the table without any
+index; the primary key index is then built once and the copy replaces the table. The cost is
+O(table + batch) instead of one index probe and update per batch row, which wins when the batch
+is large compared to the table (initial loads, historical backfills).
+
+``choose_load_mode`` picks between the two paths per run.
+"""
+import os
+
+LOAD_MODE = os.getenv("LOAD_MODE", "auto")          # "upsert" | "bulk" | "auto"
+LOAD_MODES = ("upsert", "bulk", "auto")
+BULK_LOAD_MIN_ROWS = int(os.getenv("BULK_LOAD_MIN_ROWS", 1_000_000))
+BULK_LOAD_MIN_RATIO = 0.5   # auto: bulk khi batch >= 50% số dòng hiện có của bảng
+
+
+def _check_mode(mode: str) -> None:
+    if mode not in LOAD_MODES:
+        raise ValueError(f"LOAD_MODE không hợp lệ: {mode} (hỗ trợ: {', '.join(LOAD_MODES)})")
+
+
+def table_rows(con, table: str) -> int:
+    """Row count of a physical table from DuckDB's catalog (no scan)."""
+    row = con.execute(
+        "SELECT estimated_size FROM duckdb_tables() WHERE table_name = ? AND NOT temporary", [table]).fetchone()
+    return row[0] if row else 0
+
+
+def choose_load_mode(con, table: str, source: str, mode: str = LOAD_MODE) -> str:
+    """
+    ``"bulk"`` or ``"upsert"`` for loading ``source`` into ``table``.
+    ``auto`` uses bulk only for batches of at least ``BULK_LOAD_MIN_ROWS`` rows that are also at
+    least ``BULK_LOAD_MIN_RATIO`` of the table, so small incremental batches keep the upsert path.
+    """
+    _check_mode(mode)
+    if mode != "auto":
+        return mode
+    batch_rows = con.execute(f"SELECT count(*) FROM {source}").fetchone()[0]
+    if batch_rows < BULK_LOAD_MIN_ROWS:
+        return "upsert"
+    return "bulk" if batch_rows >= BULK_LOAD_MIN_RATIO * table_rows(con, table) else "upsert"
+
+
+def merge_rebuild(con, table: str, source_sql: str, key_columns: list[str], update_columns: list[str] | None = None,
+                  order_by: list[str] = ()) -> None:
+    """
+    Merge the rows of ``source_sql`` (a query with the columns of ``table``, in order) into ``table``
+    with the semantics of ``INSERT ... ON CONFLICT (key_columns) DO UPDATE SET`` ``update_columns``:
+    new keys are inserted; for existing keys only ``update_columns`` (default: every non-key column)
+    take the batch values and the other columns keep their stored values.
+    Must run inside the caller's transaction.
+
+    Raises:
+        ValueError: If a key appears more than once in the batch.
+    """
+    keys = ", ".join(key_columns)
+    new_table = f"{table}__bulk"
+    con.execute(f"CREATE OR REPLACE TEMP TABLE bulk_batch AS {source_sql};")
+    try:
+        duplicates = con.execute(
+            f"SELECT count(*) FROM (SELECT 1 FROM bulk_batch GROUP BY {keys} HAVING count(*) > 1)").fetchone()[0]
+        if duplicates:
+            raise ValueError(f"{duplicates} khoá xuất hiện nhiều lần trong batch.")
+
+        columns = [c[0] for c in con.execute(f"SELECT * FROM {table} LIMIT 0").description]
+        kept = [c for c in columns if c not in key_columns and update_columns is not None and c not in update_columns]
+        if kept:
+            # Khoá đã có: cột không nằm trong update_columns giữ giá trị cũ, như ON CONFLICT DO UPDATE
+            select = ", ".join(f"CASE WHEN t.__matched THEN t.{c} ELSE b.{c} END AS {c}" if c in kept else f"b.{c}"
+                               for c in columns)
+            batch_rows = (f"SELECT {select} FROM bulk_batch b "
+                          f"LEFT JOIN (SELECT *, true AS __matched FROM {table}) t USING ({keys})")
+        else:
+            batch_rows = "SELECT * FROM bulk_batch"
+
+        # Bản sao rỗng cùng kiểu cột, chưa có index: INSERT chỉ còn là append
+        con.execute(f"CREATE TABLE {new_table} AS SELECT * FROM {table} LIMIT 0;")
+        order = f"ORDER BY {', '.join(order_by)}" if order_by else ""
+        con.execute(f"""
+            INSERT INTO {new_table}
+            SELECT * FROM (
+                SELECT t.* FROM {table} t ANTI JOIN bulk_batch b USING ({keys})
+                UNION ALL
+                {batch_rows}
+            ) {order};
+        """)
+        con.execute(f"ALTER TABLE {new_table} ADD PRIMARY KEY ({keys});")   # dựng index 1 lần
+        con.execute(f"DROP TABLE {table}; ALTER TABLE {new_table} RENAME TO {table};")
+    finally:
+        con.execute("DROP TABLE IF EXISTS bulk_batch;")
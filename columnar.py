@@ -0,0 +1,108 @@
+"""
+Readers for columnar uploads: flat NDJSON, Parquet and Arrow IPC (stream or file format).
+
+Inputs must carry the ``weather_data_table`` columns (``ARROW_SCHEMA``); extra columns are
+dropped. For Parquet and Arrow IPC the schema is checked from the file metadata before any
+data is read, then the columns are cast to ``ARROW_SCHEMA`` in one vectorized step and the
+result is staged as Parquet, which goes through the same validation + upsert as decoded JSON uploads.
+"""
+from pathlib import Path
+
+import pyarrow as pa
+import pyarrow.json as pa_json
+import pyarrow.parquet as pq
+
+from json_stream import ARROW_SCHEMA
+
+# Đuôi file / Content-Type → định dạng
+COLUMNAR_SUFFIXES = {
+    ".parquet": "parquet",
+    ".arrow": "arrow", ".arrows": "arrow", ".ipc": "arrow", ".feather": "arrow",
+    ".ndjson": "ndjson", ".jsonl": "ndjson",
+}
+COLUMNAR_CONTENT_TYPES = {
+    "application/vnd.apache.parquet": "parquet",
+    "application/vnd.apache.arrow.stream": "arrow",
+    "application/vnd.apache.arrow.file": "arrow",
+    "application/x-ndjson": "ndjson",
+    "application/jsonl": "ndjson",
+}
+
+_ARROW_FILE_MAGIC = b"ARROW1"
+
+
+def columnar_format(name: str | None, content_type: str | None = None) -> str | None:
+    """Detect the format of an upload from its name, then its Content-Type (``None`` if unknown)."""
+    suffix = Path(name or "").suffix.lower()
+    if suffix in COLUMNAR_SUFFIXES:
+        return COLUMNAR_SUFFIXES[suffix]
+    return COLUMNAR_CONTENT_TYPES.get((content_type or "").split(";")[0].strip().lower())
+
+
+def check_schema(schema: pa.Schema) -> None:
+    """
+    Check that ``schema`` has every ``ARROW_SCHEMA`` column with a numeric type.
+
+    Raises:
+        ValueError: Listing the missing columns and the columns with a non-numeric type.
+    """
+    missing = [f.name for f in ARROW_SCHEMA if f.name not in schema.names]
+    wrong = [f"{f.name}: {schema.field(f.name).type}" for f in ARROW_SCHEMA
+             if f.name in schema.names
+             and not (pa.types.is_integer(schema.field(f.name).type) or pa.types.is_floating(schema.field(f.name).type))]
+    if missing or wrong:
+        raise ValueError(f"Schema không khớp {ARROW_SCHEMA.names} - thiếu cột: {missing}, sai kiểu: {wrong}")
+
+
+def _conform(table: pa.Table) -> pa.Table:
+    # Cast an toàn: số nguyên tràn INTEGER hay số thực có phần lẻ ở cột nguyên → ArrowInvalid (ValueError)
+    return table.select(ARROW_SCHEMA.names).cast(ARROW_SCHEMA)
+
+
+def read_parquet(path: Path) -> pa.Table:
+    parquet_file = pq.ParquetFile(path)
+    check_schema(parquet_file.schema_arrow)
+    return _conform(parquet_file.read(columns=ARROW_SCHEMA.names))
+
+
+def read_arrow(path: Path) -> pa.Table:
+    with open(path, "rb") as f:
+        is_file_format = f.read(len(_ARROW_FILE_MAGIC)) == _ARROW_FILE_MAGIC
+    with pa.memory_map(str(path)) as source:
+        reader = pa.ipc.open_file(source) if is_file_format else pa.ipc.open_stream(source)
+        check_schema(reader.schema)
+        return _conform(reader.read_all())
+
+
+def read_ndjson(path: Path) -> pa.Table:
+    # Parser C++ của Arrow, ép kiểu theo schema ngay khi đọc; cột thiếu thành null và bị GE từ chối
+    options = pa_json.ParseOptions(explicit_schema=ARROW_SCHEMA, unexpected_field_behavior="ignore")
+    return _conform(pa_json.read_json(path, parse_options=options))
+
+
+_READERS = {"parquet": read_parquet, "arrow": read_arrow, "ndjson": read_ndjson}
+
+
+def read_columnar(path: Path, fmt: str) -> pa.Table:
+    """
+    Read a columnar upload as an Arrow table with ``ARROW_SCHEMA``.
+
+    Raises:
+        ValueError: If the format is unknown, the schema does not match or a value cannot be cast.
+    """
+    if fmt not in _READERS:
+        raise ValueError(f"Định dạng không hỗ trợ: {fmt}")
+    try:
+        return _READERS[fmt](path)
+    except pa.ArrowException as e:
+        raise ValueError(str(e)) from e
+
+
+def stage_columnar(path: Path, fmt: str, out_path: Path) -> int:
+    """
+    Read a columnar upload (see ``read_columnar``) and write it to ``out_path`` as Parquet with
+    ``ARROW_SCHEMA``, for the pipeline to validate and load. Returns the number of rows.
+    """
+    table = read_columnar(path, fmt)
+    pq.write_table(table, out_path)
+    return table.num_rows
@@ -0,0 +1,156 @@
+"""
+Process-wide DuckDB connection manager.
+
+Opening and closing a connection per query throws away DuckDB's buffer cache and, when a
+read-write connection is opened next to the ingest, fights over the database lock. Instead
+each database file gets one long-lived connection per process:
+
+- ``writer()`` hands out the single writer cursor; writers in the process are serialized.
+- ``cursor()`` returns a per-thread cursor for reads. Cursors share the database instance
+  (and its buffer cache) with the writer and see committed data only.
+- ``stream()`` yields the result of a query as Arrow record batches from its own cursor, so
+  exports of any size run in constant memory.
+- In read-only mode (``DUCKDB_READ_ONLY=1``) the file is attached ``READ_ONLY`` to an
+  in-memory database and ``writer()`` is unavailable. DuckDB lets a file be opened either by one
+  read-write process or by any number of read-only processes, never both: a read-only query
+  process cannot run next to the API or a pipeline that writes the file (the attach fails with
+  "Conflicting lock"). Use it only while no writer has the file open, e.g. on a copy of the
+  database; a running API serves reads from its own connection through ``cursor()``.
+"""
+import logging
+import os
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+
+import duckdb
+import pandas as pd
+import pyarrow as pa
+
+READ_ONLY = os.getenv("DUCKDB_READ_ONLY", "0") == "1"   # chỉ khi không có process nào đang ghi file
+ATTACH_ALIAS = "weather"
+STREAM_BATCH_ROWS = 122_880   # số dòng mỗi record batch khi stream (= 1 row group của DuckDB)
+
+
+class ConnectionManager:
+    """
+    Long-lived connection to one DuckDB file.
+
+    Args:
+        db_path (Path): Database file.
+        read_only (bool): Attach the file read-only; ``writer()`` is then unavailable, and no
+            other process may have the file open read-write.
+    """
+
+    def __init__(self, db_path: Path, read_only: bool = False):
+        self.db_path = Path(db_path)
+        self.read_only = read_only
+        self._con = None
+        self._writer = None
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._write_lock = threading.RLock()
+
+    def _connection(self) -> duckdb.DuckDBPyConnection:
+        with self._lock:
+            if self._con is None:
+                if self.read_only:
+                    con = duckdb.connect()
+                    try:
+                        con.execute(f"ATTACH '{self.db_path}' AS {ATTACH_ALIAS} (READ_ONLY); USE {ATTACH_ALIAS};")
+                    except duckdb.IOException as e:
+                        con.close()
+                        raise duckdb.IOException(
+                            f"{e}\nRead-only mode needs every process writing {self.db_path} to be stopped.") from e
+                else:
+                    self.db_path.parent.mkdir(parents=True, exist_ok=True)
+                    con = duckdb.connect(str(self.db_path))
+                self._con = con
+                logging.info(f"🔌 Opened DuckDB {self.db_path} ({'read-only' if self.read_only else 'read-write'}).")
+            return self._con
+
+    def _new_cursor(self) -> duckdb.DuckDBPyConnection:
+        cur = self._connection().cursor()
+        if self.read_only:
+            cur.execute(f"USE {ATTACH_ALIAS};")   # USE không được cursor mới kế thừa
+        return cur
+
+    def cursor(self) -> duckdb.DuckDBPyConnection:
+        """Per-thread cursor for reads, reused across calls."""
+        cur = getattr(self._local, "cursor", None)
+        if cur is None:
+            cur = self._local.cursor = self._new_cursor()
+        return cur
+
+    def stream(self, query: str, params: list | None = None, batch_rows: int = STREAM_BATCH_ROWS):
+        """
+        Yield the result of ``query`` as ``pa.RecordBatch``es of at most ``batch_rows`` rows.
+
+        The query runs on a dedicated cursor (the generator may be resumed from different
+        threads and must not share the per-thread cursor); it is closed when the generator
+        is exhausted or closed. At least one batch is yielded (empty if there are no rows),
+        so consumers can always take the schema from the first batch.
+        """
+        cur = self._new_cursor()
+        try:
+            reader = cur.execute(query, params or []).fetch_record_batch(batch_rows)
+            empty = True
+            for batch in reader:
+                empty = False
+                yield batch
+            if empty:
+                yield pa.RecordBatch.from_pylist([], schema=reader.schema)
+        finally:
+            cur.close()
+
+    @contextmanager
+    def writer(self):
+        """The process' single writer cursor, held exclusively for the ``with`` block."""
+        if self.read_only:
+            raise PermissionError(f"{self.db_path} is opened read-only.")
+        with self._write_lock:
+            if self._writer is None:
+                self._writer = self._connection().cursor()
+            yield self._writer
+
+    def query(self, query: str, params: list | None = None) -> pd.DataFrame:
+        return self.cursor().execute(query, params or []).df()
+
+    def close(self) -> None:
+        with self._lock:
+            if self._con is not None:
+                self._con.close()   # đóng luôn mọi cursor con
+            self._con = None
+            self._writer = None
+            self._local = threading.local()
+
+
+_managers: dict[tuple[Path, bool], ConnectionManager] = {}
+_managers_lock = threading.Lock()
+
+
+def get_manager(db_path: Path, read_only: bool = READ_ONLY) -> ConnectionManager:
+    """The shared manager for ``db_path`` (relative and absolute paths map to the same one)."""
+    key = (Path(db_path).resolve(), read_only)
+    with _managers_lock:
+        if key not in _managers:
+            _managers[key] = ConnectionManager(key[0], read_only)
+        return _managers[key]
+
+
+def duckdb_query(db_path: Path, query: str, params: list | None = None) -> pd.DataFrame:
+    """Run a read query on the shared connection of ``db_path`` and return a DataFrame."""
+    return get_manager(db_path).query(query, params)
+
+
+def duckdb_stream(db_path: Path, query: str, params: list | None = None,
+                  batch_rows: int = STREAM_BATCH_ROWS):
+    """Like ``duckdb_query`` but yields Arrow record batches instead of one DataFrame."""
+    return get_manager(db_path).stream(query, params, batch_rows)
+
+
+def close_all() -> None:
+    with _managers_lock:
+        for manager in _managers.values():
+            manager.close()
+        _managers.clear()
@@ -0,0 +1,60 @@
+"""
+In-batch duplicate-key resolution before an upsert.
+
+DuckDB rejects ``INSERT ... ON CONFLICT DO UPDATE`` when a key occurs twice in the inserted rows
+(and the primary key build of a bulk load fails the same way). Every staged row therefore carries
+its position in the batch: ``_file_seq`` (the file's index in the staged list, i.e. upload order
+for API jobs and name order for directory scans, or an explicit number when several staged sources
+of one batch are merged) and ``_row_seq`` (its position inside the file).
+``stage_latest`` keeps the last row of each key by that order (last writer wins) in one
+vectorized window pass, so a batch with repeated files or rows commits in a single upsert.
+"""
+import numpy as np
+import pyarrow as pa
+
+SEQ_COLUMNS = ["_file_seq", "_row_seq"]
+STAGED_BATCH = "staged_batch"
+
+
+def tag_sequence(tables: list[pa.Table], file_seqs: list[int] | None = None) -> pa.Table:
+    """Concatenate ``tables`` with the ``SEQ_COLUMNS`` of every row (``_file_seq``: ``file_seqs`` or the index)."""
+    file_seqs = range(len(tables)) if file_seqs is None else file_seqs
+    tagged = [
+        table.append_column("_file_seq", pa.array(np.full(table.num_rows, seq, dtype=np.int64)))
+             .append_column("_row_seq", pa.array(np.arange(table.num_rows, dtype=np.int64)))
+        for seq, table in zip(file_seqs, tables)
+    ]
+    return pa.concat_tables(tagged, promote_options="permissive")
+
+
+def parquet_sequence_sql(files: list[str], file_seqs: list[int] | None = None) -> str:
+    """
+    ``read_parquet`` over ``files`` with the ``SEQ_COLUMNS`` of every row
+    (``_file_seq``: ``file_seqs`` or the 1-based position in ``files``).
+    """
+    file_seq = f"list_position({files}, filename)"
+    if file_seqs is not None:
+        file_seq = f"({list(file_seqs)})[{file_seq}]"
+    return f"""(
+        SELECT * EXCLUDE (filename, file_row_number),
+               {file_seq}::BIGINT AS _file_seq, file_row_number AS _row_seq
+        FROM read_parquet({files}, filename = true, file_row_number = true)
+    )"""
+
+
+def stage_latest(con, source: str, key_columns: list[str], name: str = STAGED_BATCH) -> int:
+    """
+    Materialize the last row of each key of ``source`` (which has ``SEQ_COLUMNS``) as the temp
+    table ``name``, without the sequence columns. Returns the number of duplicate rows dropped.
+    """
+    con.execute(f"""
+        CREATE OR REPLACE TEMP TABLE {name} AS
+        SELECT * EXCLUDE ({", ".join(SEQ_COLUMNS)})
+        FROM {source}
+        QUALIFY row_number() OVER (
+            PARTITION BY {", ".join(key_columns)}
+            ORDER BY {", ".join(f"{c} DESC" for c in SEQ_COLUMNS)}
+        ) = 1;
+    """)
+    rows_in = con.execute(f"SELECT count(*) FROM {source}").fetchone()[0]
+    return rows_in - con.execute(f"SELECT count(*) FROM {name}").fetchone()[0]
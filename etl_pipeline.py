@@ -2,7 +2,7 @@
 import os
 import json
 import pandas as pd
-import duckdb
+import pyarrow as pa
 from datetime import datetime
 import shutil
 import matplotlib
@@ -15,6 +15,11 @@ import logging
 from io import BytesIO
 import psutil
 import gc
+from pathlib import Path
+from json_stream import compile_header
+from db import duckdb_query, get_manager
+from dedup import STAGED_BATCH, parquet_sequence_sql, stage_latest, tag_sequence
+from rollups import KEY_COLUMNS
 
 def print_ram_usage(message):
     process = psutil.Process(os.getpid())
@@ -22,7 +27,8 @@ def print_ram_usage(message):
     now = datetime.now().strftime("%H:%M:%S")
     print(f"[{now}] [{message}] RAM sử dụng: {mem:.2f} MB")
 
-def convert_json_to_parquet(new_json_folder: str, output_parquet_folder:str, batch_definition, context):
+def convert_json_to_parquet(new_json_folder: str, output_parquet_folder:str, batch_definition, context, staged_tables=None):
+    # Nếu truyền staged_tables (list), dữ liệu hợp lệ được giữ dưới dạng bảng Arrow trong bộ nhớ thay vì ghi Parquet
     print_ram_usage("🚦 Trước khi bắt đầu")
 
     json_files = [f for f in os.listdir(new_json_folder) if f.endswith('.json')]
@@ -46,11 +52,25 @@ def convert_json_to_parquet(new_json_folder: str, output_parquet_folder:str, bat
                     continue
 
             values = []
-            for loc in raw['data']:
-                lon_lat = loc['location']
-                for row_data in loc['value']:
-                    combined_row = [*lon_lat, *row_data]
-                    values.append(combined_row)
+            skipped = 0
+            try:
+                for loc in raw['data']:
+                    lon_lat = loc['location']
+                    # Sắp lại cột theo header của từng location (cột thiếu = None)
+                    layout = compile_header(loc.get('header'))
+                    for row_data in loc['value']:
+                        # Dòng lệch độ rộng so với header: chỉ bỏ dòng đó, không bỏ cả file
+                        if not isinstance(row_data, list) or len(row_data) != layout.width:
+                            skipped += 1
+                            continue
+                        combined_row = [*lon_lat, *(row_data[i] if i is not None else None for i in layout.positions)]
+                        values.append(combined_row)
+            except ValueError as e:
+                print(f"Header không hợp lệ trong {file_path}: {e}")
+                shutil.move(file_path, 'error_data')
+                continue
+            if skipped:
+                print(f"⚠️ Bỏ {skipped} dòng sai độ rộng so với header trong {file_path}.")
 
             df = pd.DataFrame(data=values, columns=col_name)
 
@@ -64,9 +84,13 @@ def convert_json_to_parquet(new_json_folder: str, output_parquet_folder:str, bat
                 finally:
                     continue
 
-            parquet_path = os.path.join(output_parquet_folder, filename.replace(".json", ".parquet"))
-            df.to_parquet(parquet_path, index=False)
-            print(f"✅ Đã chuyển {filename} → {parquet_path}")
+            if staged_tables is not None:
+                staged_tables.append(pa.Table.from_pandas(df, preserve_index=False))
+                print(f"✅ Đã chuyển {filename} → bảng Arrow ({len(df)} dòng)")
+            else:
+                parquet_path = os.path.join(output_parquet_folder, filename.replace(".json", ".parquet"))
+                df.to_parquet(parquet_path, index=False)
+                print(f"✅ Đã chuyển {filename} → {parquet_path}")
             print_ram_usage(f"📄 Sau khi xử lý {filename}")
 
             # Giải phóng bộ nhớ
@@ -104,7 +128,12 @@ def valid(df, batch_definition, context):
     return True
 
 def load_parquet_to_duckdb(output_parquet_folder:str, output_duckdb_file: str, table_name: str):
-    con = duckdb.connect(output_duckdb_file)
+    with get_manager(output_duckdb_file).writer() as con:
+        _load_parquet(con, output_parquet_folder, table_name)
+    print(f"✅ Đã UPSERT dữ liệu mới vào bảng '{table_name}'.\n")
+    return None
+
+def _load_parquet(con, output_parquet_folder: str, table_name: str):
     con.execute(f"""
             CREATE TABLE IF NOT EXISTS {table_name} (
                 longitude DOUBLE,
@@ -119,27 +148,58 @@ def load_parquet_to_duckdb(output_parquet_folder:str, output_duckdb_file: str, t
                 PRIMARY KEY (day, month, year, longitude, latitude)
             );
         """)
+    # Khoá lặp trong batch (vd cùng một file nạp nhiều lần): giữ dòng của file/vị trí sau cùng
+    parquet_files = sorted(str(f) for f in Path(output_parquet_folder).glob("*.parquet"))
+    stage_latest(con, parquet_sequence_sql(parquet_files), KEY_COLUMNS)
     con.execute(f"""
             INSERT INTO {table_name}
-            SELECT * FROM '{output_parquet_folder}/*.parquet'
+            SELECT * FROM {STAGED_BATCH}
             ON CONFLICT (day, month, year, longitude, latitude) DO UPDATE SET
                 t2m_max = EXCLUDED.t2m_max,
                 t2m_min = EXCLUDED.t2m_min,
                 precipitation = EXCLUDED.precipitation;
         """)
-    print(f"✅ Đã UPSERT dữ liệu mới vào bảng '{table_name}'.\n")
+    con.execute(f"DROP TABLE {STAGED_BATCH};")
 
     # print(f"\n10 hàng đầu tiên từ bảng '{table_name}':")
     # print(con.execute(f"SELECT * FROM {table_name} LIMIT 10;").df())
     # print("\nKích thước của tệp DuckDB:")
     # print(con.execute("PRAGMA database_size;").df())
+
+def load_arrow_to_duckdb(staged_tables: list, output_duckdb_file: str, table_name: str):
+    with get_manager(output_duckdb_file).writer() as con:
+        _load_arrow(con, staged_tables, table_name)
+    print(f"✅ Đã UPSERT dữ liệu mới vào bảng '{table_name}'.\n")
     return None
 
-def duckdb_query(duckdb_fileabase, query):
-    con = duckdb.connect(f'{duckdb_fileabase}')
-    result = con.sql(query).df()
-    con.close()
-    return result
+def _load_arrow(con, staged_tables: list, table_name: str):
+    con.execute(f"""
+            CREATE TABLE IF NOT EXISTS {table_name} (
+                longitude DOUBLE,
+                latitude DOUBLE,
+                day INTEGER,
+                month INTEGER,
+                year INTEGER,
+                day_of_year INTEGER,
+                t2m_max DOUBLE,
+                t2m_min DOUBLE,
+                precipitation DOUBLE,
+                PRIMARY KEY (day, month, year, longitude, latitude)
+            );
+        """)
+    # DuckDB quét trực tiếp bảng Arrow đã đăng ký, không cần file Parquet tạm
+    con.register("staged_data", tag_sequence(staged_tables))
+    stage_latest(con, "staged_data", KEY_COLUMNS)
+    con.unregister("staged_data")
+    con.execute(f"""
+            INSERT INTO {table_name}
+            SELECT * FROM {STAGED_BATCH}
+            ON CONFLICT (day, month, year, longitude, latitude) DO UPDATE SET
+                t2m_max = EXCLUDED.t2m_max,
+                t2m_min = EXCLUDED.t2m_min,
+                precipitation = EXCLUDED.precipitation;
+        """)
+    con.execute(f"DROP TABLE {STAGED_BATCH};")
 
 def visualize_summary(result_df, output_dir="charts"):
     if result_df.empty:
@@ -241,6 +301,7 @@ def main():
     database_name = "weather_data_database"
     table_name    = "weather_data_table"
     output_duckdb_file = os.path.join(output_duckdb_folder, f"{database_name}.duckdb")
+    stage_to_disk = False   # True: ghi Parquet tạm vào parquet_data như trước
     
     time_start = datetime.now()
 
@@ -251,12 +312,16 @@ def main():
     batch_definition = data_asset.add_batch_definition_whole_dataframe(name="pandas_batch")
 
     # Xử lý từng JSON mới thành Parquet
-    status = convert_json_to_parquet(new_json_folder, output_parquet_folder, batch_definition, context)
+    staged_tables = None if stage_to_disk else []
+    status = convert_json_to_parquet(new_json_folder, output_parquet_folder, batch_definition, context, staged_tables)
 
-    # Tải dữ liệu từ Parquet vào DuckDB
+    # Tải dữ liệu vào DuckDB
     if status:
         print(f"\nBắt đầu quá trình UPSERT dữ liệu mới vào bảng '{table_name}'...")
-        load_parquet_to_duckdb(output_parquet_folder, output_duckdb_file, table_name)
+        if stage_to_disk:
+            load_parquet_to_duckdb(output_parquet_folder, output_duckdb_file, table_name)
+        elif staged_tables:
+            load_arrow_to_duckdb(staged_tables, output_duckdb_file, table_name)
 
     try:
         # Truy vấn tổng hợp 
@@ -280,7 +345,8 @@ def main():
     if status:
         print("\nDọn dẹp dữ liệu...")
         move_all_files(new_json_folder, raw_json_folder)
-        delete_all_files(output_parquet_folder)
+        if stage_to_disk:
+            delete_all_files(output_parquet_folder)
         
     print("\nKết thúc chương trình.\n")
     return None
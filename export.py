@@ -0,0 +1,75 @@
+"""
+Incremental encoders that turn a stream of Arrow record batches into Arrow IPC or Parquet bytes.
+
+Each encoder is a generator: it writes one record batch at a time into an in-memory sink and
+yields whatever bytes the writer produced, so only one batch (plus, for Parquet, the row group
+being built) is held in memory regardless of the size of the export.
+"""
+from typing import Iterable, Iterator
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+EXPORT_FORMATS = {
+    "arrow": ("application/vnd.apache.arrow.stream", ".arrows"),
+    "parquet": ("application/vnd.apache.parquet", ".parquet"),
+}
+
+
+class _ChunkSink:
+    """Write-only file object that buffers writes until they are drained."""
+
+    closed = False
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+
+    def write(self, data) -> int:
+        data = bytes(data)
+        self._chunks.append(data)
+        self._position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        self.closed = True
+
+    def drain(self) -> bytes:
+        data, self._chunks = b"".join(self._chunks), []
+        return data
+
+
+def _encode(batches: Iterable[pa.RecordBatch], open_writer) -> Iterator[bytes]:
+    sink = _ChunkSink()
+    writer = None
+    try:
+        for batch in batches:
+            if writer is None:
+                writer = open_writer(sink, batch.schema)
+            writer.write_batch(batch)
+            if data := sink.drain():
+                yield data
+    finally:
+        if writer is not None:
+            writer.close()
+    if data := sink.drain():
+        yield data
+
+
+def iter_arrow_ipc(batches: Iterable[pa.RecordBatch]) -> Iterator[bytes]:
+    """Arrow IPC stream format, one IPC message per record batch."""
+    return _encode(batches, pa.ipc.new_stream)
+
+
+def iter_parquet(batches: Iterable[pa.RecordBatch], compression: str = "zstd") -> Iterator[bytes]:
+    """Parquet file, one row group per record batch; the footer is written at the end."""
+    return _encode(batches, lambda sink, schema: pq.ParquetWriter(sink, schema, compression=compression))
+
+
+ENCODERS = {"arrow": iter_arrow_ipc, "parquet": iter_parquet}
@@ -0,0 +1,181 @@
+"""
+In-process ingest job queue for the API.
+
+``/upload-and-run`` only stores the uploads and enqueues a job; a single background consumer
+runs the pipeline in a worker thread, so the event loop is never blocked. Jobs that arrive
+within a short window are coalesced into one micro-batch: one pipeline run and a single
+upsert transaction for all of their files, instead of one DuckDB write (and one fight over
+the single-writer lock) per request. Job state is kept in memory and exposed through
+``/jobs/{job_id}``.
+"""
+import asyncio
+import logging
+import uuid
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from datetime import datetime
+from pathlib import Path
+from typing import Callable
+
+JOB_QUEUE_SIZE = 16          # số job tối đa đang chờ
+MAX_FINISHED_JOBS = 1000     # số job đã xong được giữ lại để tra cứu
+
+# Cửa sổ gom job: chờ tối đa COALESCE_WINDOW giây sau job đầu tiên, dừng sớm khi đủ file/dung lượng
+COALESCE_WINDOW = 0.5
+COALESCE_MAX_FILES = 64
+COALESCE_MAX_BYTES = 512 * 1024 * 1024
+
+
+class QueueFullError(Exception):
+    """Raised when the ingest queue is at capacity."""
+
+
+@dataclass
+class Job:
+    files: list[Path]
+    uploads: list[dict] = field(default_factory=list)
+    id: str = field(default_factory=lambda: uuid.uuid4().hex)
+    status: str = "queued"           # queued → running → done | failed
+    stage: str | None = None         # bước hiện tại của pipeline
+    created_at: datetime = field(default_factory=datetime.now)
+    started_at: datetime | None = None
+    finished_at: datetime | None = None
+    results: list[dict] = field(default_factory=list)
+    timings: dict = field(default_factory=dict)
+    error: str | None = None
+    batch_id: str | None = None      # micro-batch mà job được gom vào
+    batch_jobs: int = 0              # số job trong micro-batch đó
+    decoded: dict = field(default_factory=dict, repr=False)  # file → Parquet đã giải mã lúc upload
+
+    @property
+    def size(self) -> int:
+        return sum(f.stat().st_size for f in self.files if f.exists())
+
+    def to_dict(self) -> dict:
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "stage": self.stage,
+            "created_at": self.created_at.isoformat(),
+            "started_at": self.started_at.isoformat() if self.started_at else None,
+            "finished_at": self.finished_at.isoformat() if self.finished_at else None,
+            "uploads": self.uploads,
+            "results": self.results,
+            "timings": self.timings,
+            "error": self.error,
+            "batch_id": self.batch_id,
+            "batch_jobs": self.batch_jobs,
+        }
+
+
+class JobQueue:
+    """
+    Bounded queue of ingest jobs with one consumer task that coalesces jobs into micro-batches.
+
+    Args:
+        runner (Callable): ``runner(json_files=..., decoded=..., progress=...)``, returns the pipeline report.
+        maxsize (int): Maximum number of queued jobs; ``submit`` raises ``QueueFullError`` beyond it.
+        window (float): Seconds to keep collecting jobs after the first one of a batch.
+        max_files (int): Close the batch early once it holds this many files.
+        max_bytes (int): Close the batch early once its files reach this total size.
+    """
+
+    def __init__(self, runner: Callable, maxsize: int = JOB_QUEUE_SIZE, window: float = COALESCE_WINDOW,
+                 max_files: int = COALESCE_MAX_FILES, max_bytes: int = COALESCE_MAX_BYTES):
+        self.runner = runner
+        self.maxsize = maxsize
+        self.window = window
+        self.max_files = max_files
+        self.max_bytes = max_bytes
+        self._jobs = OrderedDict()
+        self._queue = None
+        self._consumer = None
+
+    def start(self) -> None:
+        self._queue = asyncio.Queue(maxsize=self.maxsize)
+        self._consumer = asyncio.create_task(self._consume())
+
+    async def stop(self) -> None:
+        if self._consumer is not None:
+            self._consumer.cancel()
+            try:
+                await self._consumer
+            except asyncio.CancelledError:
+                pass
+            self._consumer = None
+
+    def get(self, job_id: str) -> Job | None:
+        return self._jobs.get(job_id)
+
+    def submit(self, files: list[Path], uploads: list[dict] | None = None, decoded: dict | None = None) -> Job:
+        job = Job(files=files, uploads=uploads or [], decoded=decoded or {})
+        try:
+            self._queue.put_nowait(job)
+        except asyncio.QueueFull:
+            raise QueueFullError(f"Hàng đợi đã đầy ({self.maxsize} job).")
+        self._jobs[job.id] = job
+        self._evict()
+        return job
+
+    def _evict(self) -> None:
+        finished = [j.id for j in self._jobs.values() if j.status in ("done", "failed")]
+        for job_id in finished[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+            del self._jobs[job_id]
+
+    async def _next_batch(self) -> list[Job]:
+        """Wait for one job, then keep collecting until the window closes or the batch is full."""
+        loop = asyncio.get_running_loop()
+        batch = [await self._queue.get()]
+        n_files, n_bytes = len(batch[0].files), batch[0].size
+        deadline = loop.time() + self.window
+        while n_files < self.max_files and n_bytes < self.max_bytes:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                job = await asyncio.wait_for(self._queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            batch.append(job)
+            n_files += len(job.files)
+            n_bytes += job.size
+        return batch
+
+    async def _consume(self) -> None:
+        while True:
+            batch = await self._next_batch()
+            batch_id = uuid.uuid4().hex
+            files = [f for job in batch for f in job.files]
+            decoded = {f: p for job in batch for f, p in job.decoded.items()}
+            logging.info(f"📦 Micro-batch {batch_id}: {len(batch)} jobs, {len(files)} files.")
+
+            def set_stage(stage):
+                for job in batch:
+                    job.stage = stage
+
+            for job in batch:
+                job.status = "running"
+                job.started_at = datetime.now()
+                job.batch_id = batch_id
+                job.batch_jobs = len(batch)
+            try:
+                report = await asyncio.to_thread(self.runner, json_files=files, decoded=decoded,
+                                                progress=set_stage)
+                by_name = {r["filename"]: r for r in (report or {}).get("files", [])}
+                for job in batch:
+                    job.results = [by_name[f.name] for f in job.files if f.name in by_name]
+                    job.timings = (report or {}).get("timings", {})
+                    job.status = "done"
+            except Exception as e:
+                logging.error(f"❌ Micro-batch {batch_id} failed: {e}")
+                for job in batch:
+                    job.status = "failed"
+                    job.error = str(e)
+            finally:
+                for job in batch:
+                    job.stage = None
+                    for path in job.decoded.values():
+                        path.unlink(missing_ok=True)   # Parquet giải mã lúc upload chỉ dùng cho lần chạy này
+                    job.decoded = {}
+                    job.finished_at = datetime.now()
+                    self._queue.task_done()
@@ -0,0 +1,538 @@
+"""
+Incremental decoder for the weather upload format.
+
+Uploads look like ``{"duration": ..., "data": [{"header": [...], "value": [[...]], "location": [lon, lat]}, ...]}``
+and can be several GB. Instead of ``json.load`` on the whole file, the decoder walks the
+top-level object and hands out the ``data[]`` items one location at a time, so only a single
+location block (plus one row batch) is ever held in memory. Each block is written straight into
+typed NumPy/Arrow column buffers in the final ``weather_data_table`` schema, with its columns
+mapped by the block's ``header`` (any order or subset of ``VALUE_COLUMNS``).
+"""
+import codecs
+import json
+import logging
+import re
+import zlib
+from functools import lru_cache
+from pathlib import Path
+from typing import IO, Iterator
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+CHUNK_SIZE = 1 << 20          # 1 MiB đọc mỗi lần
+BATCH_ROWS = 100_000          # số dòng tối đa mỗi batch
+
+# Đuôi file được chấp nhận và Content-Encoding tương ứng
+JSON_SUFFIXES = {".json": None, ".json.gz": "gzip", ".json.zst": "zstd"}
+
+COLUMNS = ["longitude", "latitude", "day", "month", "year",
+           "day_of_year", "t2m_max", "t2m_min", "precipitation"]
+VALUE_COLUMNS = tuple(COLUMNS[2:])    # thứ tự mặc định của ``value`` khi không có ``header``
+VALUE_WIDTH = len(VALUE_COLUMNS)
+
+# Schema cuối cùng của weather_data_table (INTEGER = int32, DOUBLE = float64)
+ARROW_SCHEMA = pa.schema([
+    ("longitude", pa.float64()), ("latitude", pa.float64()),
+    ("day", pa.int32()), ("month", pa.int32()), ("year", pa.int32()), ("day_of_year", pa.int32()),
+    ("t2m_max", pa.float64()), ("t2m_min", pa.float64()), ("precipitation", pa.float64()),
+])
+_INT32_MAX = 2**31 - 1
+
+_WHITESPACE = " \t\n\r"
+# Ký tự kết thúc một số/literal (true, false, null) ở cấp ngoài cùng
+_SCALAR_END = re.compile(r"[,\]}" + _WHITESPACE + "]")
+
+# Trạng thái của bộ giải mã
+_START, _KEY, _COLON, _VALUE, _ITEM, _ITEM_SEP, _MEMBER_SEP, _DONE = range(8)
+
+
+class LocationStreamDecoder:
+    """
+    Push-style decoder: ``feed()`` raw chunks (bytes or str) and get back the ``data[]``
+    items that became complete. Top-level members other than ``data`` (e.g. ``duration``)
+    are collected in ``meta``. Call ``close()`` at end of input to detect truncation.
+    """
+
+    def __init__(self):
+        self.meta = {}
+        self.has_data = False      # đã gặp mảng ``data``
+        self._text = codecs.getincrementaldecoder("utf-8")()
+        self._json = json.JSONDecoder()
+        self._buf = ""
+        self._pos = 0
+        self._state = _START
+        self._key = None
+        self._retry_len = 0
+        self._pending = []
+        self._pending_len = 0
+
+    @property
+    def done(self) -> bool:
+        return self._state == _DONE
+
+    def feed(self, chunk: bytes | str) -> list[dict]:
+        if isinstance(chunk, bytes):
+            chunk = self._text.decode(chunk)
+        self._pending.append(chunk)
+        self._pending_len += len(chunk)
+        # Gom chunk cho tới khi đủ dữ liệu để thử giải mã lại
+        if len(self._buf) - self._pos + self._pending_len < self._retry_len:
+            return []
+        self._flush_pending()
+        return self._drain(final=False)
+
+    def close(self) -> list[dict]:
+        self._pending.append(self._text.decode(b"", final=True))
+        self._flush_pending()
+        items = self._drain(final=True)
+        if self._state != _DONE:
+            raise ValueError("Unexpected end of JSON input")
+        if self._buf[self._pos:].strip(_WHITESPACE):
+            raise ValueError("Extra data after JSON document")
+        return items
+
+    # --- internals ---
+    def _flush_pending(self) -> None:
+        self._buf = "".join([self._buf[self._pos:], *self._pending])
+        self._pos = 0
+        self._pending = []
+        self._pending_len = 0
+
+    def _skip_ws(self) -> bool:
+        buf, pos = self._buf, self._pos
+        while pos < len(buf) and buf[pos] in _WHITESPACE:
+            pos += 1
+        self._pos = pos
+        return pos < len(buf)
+
+    def _expect(self, char: str) -> None:
+        if self._buf[self._pos] != char:
+            raise ValueError(f"Expecting '{char}' at position {self._pos}, got {self._buf[self._pos]!r}")
+        self._pos += 1
+
+    def _decode_value(self, final: bool):
+        """Decode one JSON value at the cursor, or return ``None`` if more input is needed."""
+        # Một object lớn chưa đủ dữ liệu: chỉ thử lại khi buffer đã lớn gấp đôi để tránh O(n^2)
+        if not final and len(self._buf) - self._pos < self._retry_len:
+            return None
+        if self._buf[self._pos] not in '{["':
+            return self._decode_scalar(final)
+        try:
+            value, end = self._json.raw_decode(self._buf, self._pos)
+        except json.JSONDecodeError:
+            if final:
+                raise
+            self._retry_len = 2 * (len(self._buf) - self._pos)
+            return None
+        self._retry_len = 0
+        self._pos = end
+        return (value,)
+
+    def _decode_scalar(self, final: bool):
+        # Số/literal chỉ trọn vẹn khi đã thấy ký tự kết thúc: "51." hay "1e" ở cuối chunk là chưa đọc hết
+        match = _SCALAR_END.search(self._buf, self._pos)
+        if match is None and not final:
+            return None
+        token_end = match.start() if match else len(self._buf)
+        value, end = self._json.raw_decode(self._buf, self._pos)
+        if end != token_end:
+            raise ValueError(f"Invalid JSON value at position {self._pos}: {self._buf[self._pos:token_end]!r}")
+        self._pos = end
+        return (value,)
+
+    def _drain(self, final: bool) -> list[dict]:
+        items = []
+        while self._state != _DONE and self._skip_ws():
+            state = self._state
+            if state == _START:
+                self._expect("{")
+                self._state = _KEY
+            elif state == _KEY:
+                if self._buf[self._pos] == "}":
+                    self._pos += 1
+                    self._state = _DONE
+                    continue
+                decoded = self._decode_value(final)
+                if decoded is None:
+                    break
+                if not isinstance(decoded[0], str):
+                    raise ValueError(f"Expecting property name at position {self._pos}")
+                self._key = decoded[0]
+                self._state = _COLON
+            elif state == _COLON:
+                self._expect(":")
+                self._state = _VALUE
+            elif state == _VALUE:
+                if self._key == "data" and self._buf[self._pos] == "[":
+                    self._pos += 1
+                    self.has_data = True
+                    self._state = _ITEM
+                    continue
+                decoded = self._decode_value(final)
+                if decoded is None:
+                    break
+                self.meta[self._key] = decoded[0]
+                self._state = _MEMBER_SEP
+            elif state == _ITEM:
+                if self._buf[self._pos] == "]":
+                    self._pos += 1
+                    self._state = _MEMBER_SEP
+                    continue
+                decoded = self._decode_value(final)
+                if decoded is None:
+                    break
+                items.append(decoded[0])
+                self._state = _ITEM_SEP
+            elif state == _ITEM_SEP:
+                if self._buf[self._pos] == "]":
+                    self._pos += 1
+                    self._state = _MEMBER_SEP
+                else:
+                    self._expect(",")
+                    self._state = _ITEM
+            elif state == _MEMBER_SEP:
+                if self._buf[self._pos] == "}":
+                    self._pos += 1
+                    self._state = _DONE
+                else:
+                    self._expect(",")
+                    self._state = _KEY
+        return items
+
+
+def iter_locations(fp: IO[bytes], chunk_size: int = CHUNK_SIZE) -> Iterator[dict]:
+    """Yield the ``data[]`` items of an upload one location at a time from a binary file object."""
+    decoder = LocationStreamDecoder()
+    while True:
+        chunk = fp.read(chunk_size)
+        if not chunk:
+            break
+        yield from decoder.feed(chunk)
+    yield from decoder.close()
+
+
+def json_stem(path: Path) -> str:
+    """``wt_data_1.json.gz`` → ``wt_data_1``."""
+    name = Path(path).name
+    for suffix in sorted(JSON_SUFFIXES, key=len, reverse=True):
+        if name.endswith(suffix):
+            return name[:-len(suffix)]
+    return Path(name).stem
+
+
+def glob_json(directory: Path) -> list[Path]:
+    """Every plain or compressed JSON upload in ``directory``."""
+    return sorted(f for suffix in JSON_SUFFIXES for f in Path(directory).glob(f"*{suffix}"))
+
+
+def open_json(path: Path) -> IO[bytes]:
+    """Open a plain, ``.gz`` or ``.zst`` JSON file as a stream of decompressed bytes."""
+    # pyarrow chọn codec theo đuôi file và giải nén dần khi đọc
+    return pa.input_stream(str(path), compression="detect")
+
+
+class _Identity:
+    def decompress(self, chunk: bytes) -> bytes:
+        return chunk
+
+    def flush(self) -> bytes:
+        return b""
+
+
+def decompressor(encoding: str | None):
+    """Incremental decompressor with ``decompress(chunk)``/``flush()`` for a Content-Encoding."""
+    if encoding in (None, "", "identity"):
+        return _Identity()
+    if encoding == "gzip":
+        return zlib.decompressobj(wbits=zlib.MAX_WBITS | 16)
+    if encoding == "zstd":
+        try:
+            import zstandard
+        except ImportError:
+            raise ValueError("zstd uploads need the 'zstandard' package")
+        return zstandard.ZstdDecompressor().decompressobj()
+    raise ValueError(f"Unsupported Content-Encoding: {encoding}")
+
+
+def _as_float(value) -> float:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+class HeaderLayout:
+    """
+    Column-index extractor for one ``header`` layout: maps a ``(n, len(header))`` value matrix
+    to the ``VALUE_COLUMNS`` order in one fancy-indexing step. Columns the header does not
+    carry come out as NaN. Built once per distinct header by ``compile_header``.
+    """
+
+    def __init__(self, header: tuple[str, ...]):
+        unknown = [name for name in header if name not in VALUE_COLUMNS]
+        if unknown:
+            raise ValueError(f"Unknown column(s) in header: {unknown}")
+        if len(set(header)) != len(header):
+            raise ValueError(f"Duplicate column(s) in header: {list(header)}")
+        self.width = len(header)
+        self.identity = header == VALUE_COLUMNS
+        # Vị trí trong header của từng cột VALUE_COLUMNS (None = header không có cột này)
+        self.positions = tuple(header.index(name) if name in header else None for name in VALUE_COLUMNS)
+        self.targets = np.array([i for i, p in enumerate(self.positions) if p is not None], dtype=np.intp)
+        self.sources = np.array([p for p in self.positions if p is not None], dtype=np.intp)
+
+    def __call__(self, matrix: np.ndarray) -> np.ndarray:
+        if self.identity:
+            return matrix
+        out = np.full((len(matrix), VALUE_WIDTH), np.nan)
+        out[:, self.targets] = matrix[:, self.sources]
+        return out
+
+
+@lru_cache(maxsize=256)
+def _compile_header(header: tuple[str, ...]) -> HeaderLayout:
+    return HeaderLayout(header)
+
+
+def compile_header(header: list | None) -> HeaderLayout:
+    """
+    Return the cached extractor for ``header`` (``None``/empty = the default column order).
+
+    Raises:
+        ValueError: If the header has unknown, duplicate or non-string column names.
+    """
+    if not header:
+        return _compile_header(VALUE_COLUMNS)
+    if not all(isinstance(name, str) for name in header):
+        raise ValueError(f"Header must be a list of column names: {header!r}")
+    return _compile_header(tuple(header))
+
+
+def _value_matrix(values: list, header: list | None = None, strict: bool = True) -> np.ndarray:
+    """
+    Convert a ``value`` block to an ``(n, VALUE_WIDTH)`` float64 matrix in ``VALUE_COLUMNS``
+    order, mapping the columns by ``header``; ``null`` becomes NaN.
+
+    Raises:
+        ValueError: (``strict``) If a row's width does not match the header or a value is not
+            a number, the same rows DuckDB mode rejects. Non-strict callers get
+            NaN for such values and short rows, and long rows are cut to the header width.
+    """
+    layout = compile_header(header)
+    width = layout.width
+    if not values:
+        return np.empty((0, VALUE_WIDTH))
+    try:
+        matrix = np.asarray(values, dtype=np.float64)
+        if matrix.ndim == 2 and matrix.shape[1] == width:
+            return layout(matrix)
+    except (TypeError, ValueError):
+        pass
+    if strict:
+        raise ValueError(f"Value rows must have {width} numeric values (header: {list(header or VALUE_COLUMNS)})")
+    # Đường chậm chỉ cho block lỗi: dòng thiếu/thừa cột hoặc giá trị không phải số
+    rows = [(row if isinstance(row, list) else []) + [None] * width for row in values]
+    return layout(np.array([[_as_float(v) for v in row[:width]] for row in rows], dtype=np.float64).reshape(-1, width))
+
+
+class _ColumnBatcher:
+    """Accumulate ``data[]`` items and cut them into float64 column batches of ``batch_rows`` rows."""
+
+    def __init__(self, batch_rows: int = BATCH_ROWS, source: str = "", strict: bool = True):
+        self.batch_rows = batch_rows
+        self.source = source
+        self.strict = strict
+        self._blocks, self._locations, self._counts = [], [], []
+        self._pending = 0
+
+    def add(self, loc) -> list[dict[str, np.ndarray]]:
+        location = loc.get("location") if isinstance(loc, dict) else None
+        if not isinstance(location, list) or len(location) != 2 or None in location:
+            logging.warning(f"⚠️ Skipping record in {self.source} due to missing location data.")
+            return []
+
+        matrix = _value_matrix(loc.get("value") or [], loc.get("header"), self.strict)
+        if not len(matrix):
+            return []
+        lon_lat = [_as_float(v) for v in location]
+        if self.strict and np.isnan(lon_lat).any():
+            raise ValueError(f"Location must be two numbers: {location!r}")
+        self._blocks.append(matrix)
+        self._locations.append(lon_lat)
+        self._counts.append(len(matrix))
+        self._pending += len(matrix)
+        batches = []
+        while self._pending >= self.batch_rows:
+            batches.append(self._build(self.batch_rows))
+        return batches
+
+    def flush(self) -> list[dict[str, np.ndarray]]:
+        return [self._build(self._pending)] if self._pending else []
+
+    def _build(self, n_rows: int) -> dict[str, np.ndarray]:
+        blocks = self._blocks
+        matrix = np.concatenate(blocks) if len(blocks) > 1 else blocks[0]
+        lon_lat = np.repeat(np.asarray(self._locations, dtype=np.float64).T, self._counts, axis=1)
+        # Chép 1 lần sang dạng cột liên tục: các phép kiểm tra/ép kiểu sau đó không phải đọc theo bước nhảy
+        values = np.ascontiguousarray(matrix[:n_rows].T)
+        batch = {"longitude": lon_lat[0, :n_rows], "latitude": lon_lat[1, :n_rows]}
+        for i, col in enumerate(COLUMNS[2:]):
+            batch[col] = values[i]
+        # Giữ lại phần dư cho batch sau
+        rest = len(matrix) - n_rows
+        self._blocks = [matrix[n_rows:]] if rest else []
+        self._locations = [self._locations[-1]] if rest else []
+        self._counts = [rest] if rest else []
+        self._pending = rest
+        return batch
+
+
+def iter_column_batches(json_path: Path, batch_rows: int = BATCH_ROWS,
+                        strict: bool = True) -> Iterator[dict[str, np.ndarray]]:
+    """
+    Stream a JSON upload as batches of at most ``batch_rows`` rows, one float64 NumPy array
+    per column of ``COLUMNS``.
+
+    Each ``value`` block is converted to a typed matrix in one call, its columns are mapped
+    by the block's ``header`` with a cached extractor, and ``location`` is broadcast with
+    ``np.repeat``, so no per-row Python objects are created. Locations
+    without a valid ``[lon, lat]`` pair are skipped with a warning; ``null`` values become NaN.
+    Rows that do not match their header or hold non-numeric values fail the file, unless
+    ``strict`` is off (src1 drops such rows one by one: they come out as NaN and fail validation).
+
+    Plain, gzip (``.json.gz``) and zstd (``.json.zst``) files are decompressed on the fly.
+
+    Raises:
+        ValueError: If the file is not a well-formed JSON document, or (``strict``) on a
+            ragged or non-numeric row.
+    """
+    batcher = _ColumnBatcher(batch_rows, source=Path(json_path).name, strict=strict)
+    with open_json(json_path) as f:
+        for loc in iter_locations(f):
+            yield from batcher.add(loc)
+    yield from batcher.flush()
+
+
+def to_record_batch(columns: dict[str, np.ndarray], keep: np.ndarray | None = None) -> pa.RecordBatch:
+    """
+    Build a RecordBatch with ``ARROW_SCHEMA`` from float64 column buffers.
+
+    Integer columns are cast directly from the buffers; values that are NaN, not whole
+    numbers or outside the INTEGER range become null. ``keep`` optionally selects rows.
+    """
+    arrays = []
+    for field in ARROW_SCHEMA:
+        values = columns[field.name] if keep is None else columns[field.name][keep]
+        invalid = np.isnan(values)
+        if pa.types.is_integer(field.type):
+            with np.errstate(invalid="ignore"):
+                invalid |= (np.mod(values, 1) != 0) | (np.abs(values) > _INT32_MAX)
+            ints = np.where(invalid, 0, values).astype(np.int32)
+            arrays.append(pa.array(ints, type=field.type, mask=invalid if invalid.any() else None))
+        else:
+            arrays.append(pa.array(values, type=field.type, mask=invalid if invalid.any() else None))
+    return pa.RecordBatch.from_arrays(arrays, schema=ARROW_SCHEMA)
+
+
+_MONTH_DAYS = np.array([31, 29, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31])
+
+
+def calendar_dates(day, month, year) -> np.ndarray:
+    """
+    Mask of the rows whose ``day``/``month``/``year`` form a real calendar date (no 30/2, no
+    29/2 outside leap years). Missing, fractional or out-of-range parts are ``False``.
+    """
+    day, month, year = (np.asarray(a, dtype=np.float64) for a in (day, month, year))
+    with np.errstate(invalid="ignore"):
+        ok = ((month >= 1) & (month <= 12) & (day >= 1)
+              & (day == np.trunc(day)) & (month == np.trunc(month)) & (year == np.trunc(year)))
+        month_idx = np.where(ok, month, 1).astype(np.int64) - 1
+        leap = (year % 4 == 0) & ((year % 100 != 0) | (year % 400 == 0))
+        last_day = _MONTH_DAYS[month_idx] - ((month_idx == 1) & ~leap)
+        return ok & (day <= last_day)
+
+
+def iter_arrow_batches(json_path: Path, batch_rows: int = BATCH_ROWS) -> Iterator[pa.RecordBatch]:
+    """Stream a JSON upload as RecordBatches in the final ``weather_data_table`` schema."""
+    for columns in iter_column_batches(json_path, batch_rows):
+        yield to_record_batch(columns)
+
+
+def json_to_arrow(json_path: Path) -> pa.Table:
+    """Convert a whole JSON upload to an Arrow table with ``ARROW_SCHEMA``."""
+    return pa.Table.from_batches(list(iter_arrow_batches(json_path)), schema=ARROW_SCHEMA)
+
+
+class ParquetUploadBuilder:
+    """
+    Push-style counterpart of ``json_to_arrow`` for request bodies: ``feed()`` raw chunks as
+    they arrive; every complete batch is appended to the Parquet file ``out_path`` (with
+    ``ARROW_SCHEMA``), so only one location block and one batch are in memory whatever the
+    upload size. ``finish()`` closes the file and returns the number of rows. The payload is
+    decoded exactly once; the pipeline validates and loads the Parquet file instead of
+    re-reading the stored upload. Compressed payloads (``encoding`` = ``gzip``/``zstd``) are
+    decompressed chunk by chunk in front of the parser, up to ``max_bytes`` decompressed bytes.
+
+    Checked while receiving: the document structure (``duration`` number, ``data`` list of
+    items with ``header``/``value``/``location`` lists), header names and numeric rows of the
+    header's width. Range and null checks are left to the pipeline's validation.
+
+    Raises:
+        ValueError: If the payload is not a well-formed upload document or is too large.
+    """
+
+    def __init__(self, out_path: Path, name: str = "", batch_rows: int = BATCH_ROWS,
+                 encoding: str | None = None, max_bytes: int | None = None):
+        self.out_path = Path(out_path)
+        self.max_bytes = max_bytes
+        self.rows = 0
+        self._decompressor = decompressor(encoding)
+        self._decoder = LocationStreamDecoder()
+        self._batcher = _ColumnBatcher(batch_rows, source=name)
+        self._decoded_bytes = 0
+        self._writer = None
+
+    def feed(self, chunk: bytes) -> None:
+        self._parse(self._decompressor.decompress(chunk))
+
+    def finish(self) -> int:
+        self._parse(self._decompressor.flush())
+        for loc in self._decoder.close():
+            self._add(loc)
+        if not isinstance(self._decoder.meta.get("duration"), (int, float)):
+            raise ValueError("Missing or invalid 'duration' field")
+        if not self._decoder.has_data:
+            raise ValueError("Missing or invalid 'data' list")
+        self._write(self._batcher.flush())
+        if self._writer is None:
+            self._writer = pq.ParquetWriter(self.out_path, ARROW_SCHEMA)
+        self._writer.close()
+        return self.rows
+
+    def abort(self) -> None:
+        """Discard the partially written Parquet file."""
+        if self._writer is not None:
+            self._writer.close()
+        self.out_path.unlink(missing_ok=True)
+
+    def _parse(self, data: bytes) -> None:
+        self._decoded_bytes += len(data)
+        if self.max_bytes is not None and self._decoded_bytes > self.max_bytes:
+            raise ValueError(f"Decompressed upload exceeds {self.max_bytes} bytes")
+        for loc in self._decoder.feed(data):
+            self._add(loc)
+
+    def _add(self, loc) -> None:
+        if not isinstance(loc, dict) or not all(isinstance(loc.get(k), list) for k in ("header", "value", "location")):
+            raise ValueError("Each data item needs 'header', 'value' and 'location' lists")
+        self._write(self._batcher.add(loc))
+
+    def _write(self, batches: list[dict[str, np.ndarray]]) -> None:
+        for columns in batches:
+            if self._writer is None:
+                self._writer = pq.ParquetWriter(self.out_path, ARROW_SCHEMA)
+            record_batch = to_record_batch(columns)
+            self._writer.write_batch(record_batch)
+            self.rows += record_batch.num_rows
@@ -0,0 +1,261 @@
+"""
+Storage schemas for ``weather_data_table``.
+
+- ``natural``: one table keyed by ``(day, month, year, longitude, latitude)``, as before.
+- ``compact``: ``weather_data_compact`` keyed by ``(date DATE, cell_id INTEGER)``, plus a
+  ``weather_cells`` dimension table mapping each grid cell id back to its exact longitude/latitude.
+  ``weather_data_table`` is then a view joining the two with the original columns, so queries,
+  rollups and exports work unchanged; only ``create_weather_table``, ``upsert_weather`` and
+  ``bulk_load_weather`` differ.
+
+Trade-off of ``compact``: filters on the view's longitude/latitude/day/month/year are not pushed
+below the join, so a point lookup through the view scans the storage table (several times slower
+than on ``natural`` in ``source/bench_key_encoding.py``). Point lookups should use ``point_lookup``,
+which filters on ``(date, cell_id)`` first and is close to ``natural``; range scans are unaffected.
+
+A cell id is the location quantized to ``1 / CELL_SCALE`` degrees, row-major from (-180, -90).
+Two distinct points falling into the same cell are rejected rather than merged: loaders call
+``colliding_files`` and send those files to the error directory, like any other invalid file.
+"""
+import os
+from contextlib import contextmanager
+from datetime import date
+
+from bulk_load import merge_rebuild
+from rollups import KEY_COLUMNS, MEASURES, TABLE_NAME
+
+KEY_ENCODING = os.getenv("KEY_ENCODING", "natural")   # "natural" | "compact"
+KEY_ENCODINGS = ("natural", "compact")
+
+DATA_TABLE = "weather_data_compact"
+CELLS_TABLE = "weather_cells"
+CELL_SCALE = 100                      # ô lưới 0.01° (~1.1 km); 36001 * 18001 ô vẫn vừa INTEGER
+CELL_COLUMNS = 360 * CELL_SCALE + 1
+
+
+def cell_id_sql(longitude: str = "longitude", latitude: str = "latitude") -> str:
+    """SQL expression of the grid cell id of a location."""
+    return (f"(round(({latitude} + 90) * {CELL_SCALE})::INTEGER * {CELL_COLUMNS}"
+            f" + round(({longitude} + 180) * {CELL_SCALE})::INTEGER)")
+
+
+# Cột của view compact, cùng thứ tự với bảng natural
+_VIEW_COLUMNS = ("c.longitude, c.latitude, "
+                 "day(d.date)::INTEGER AS day, month(d.date)::INTEGER AS month, year(d.date)::INTEGER AS year, "
+                 "d.day_of_year, d.t2m_max, d.t2m_min, d.precipitation")
+
+
+def _compact_select() -> str:
+    return (f"make_date(year, month, day) AS date, {cell_id_sql()} AS cell_id, "
+            "day_of_year, t2m_max, t2m_min, precipitation")
+
+
+def _check_encoding(encoding: str) -> None:
+    if encoding not in KEY_ENCODINGS:
+        raise ValueError(f"KEY_ENCODING không hợp lệ: {encoding} (hỗ trợ: {', '.join(KEY_ENCODINGS)})")
+
+
+def _table_type(con, name: str) -> str | None:
+    row = con.execute(
+        "SELECT table_type FROM information_schema.tables WHERE table_name = ?", [name]).fetchone()
+    return row[0] if row else None
+
+
+def create_weather_table(con, encoding: str = KEY_ENCODING) -> None:
+    """
+    Create the storage of ``weather_data_table`` for ``encoding`` if it does not exist.
+
+    Raises:
+        ValueError: On an unknown encoding, or if the database already holds the other schema.
+    """
+    _check_encoding(encoding)
+    existing = _table_type(con, TABLE_NAME)
+    if existing is not None and (existing == "VIEW") != (encoding == "compact"):
+        raise ValueError(f"Database đã dùng schema khác cho '{TABLE_NAME}' ({existing}); "
+                         f"không thể mở với KEY_ENCODING={encoding}.")
+
+    if encoding == "natural":
+        con.execute(f"""
+            CREATE TABLE IF NOT EXISTS {TABLE_NAME} (
+                longitude DOUBLE,
+                latitude DOUBLE,
+                day INTEGER,
+                month INTEGER,
+                year INTEGER,
+                day_of_year INTEGER,
+                t2m_max DOUBLE,
+                t2m_min DOUBLE,
+                precipitation DOUBLE,
+                PRIMARY KEY (day, month, year, longitude, latitude)
+            );
+        """)
+        return
+
+    con.execute(f"""
+        CREATE TABLE IF NOT EXISTS {CELLS_TABLE} (
+            cell_id INTEGER PRIMARY KEY,
+            longitude DOUBLE,
+            latitude DOUBLE
+        );
+        CREATE TABLE IF NOT EXISTS {DATA_TABLE} (
+            date DATE,
+            cell_id INTEGER,
+            day_of_year INTEGER,
+            t2m_max DOUBLE,
+            t2m_min DOUBLE,
+            precipitation DOUBLE,
+            PRIMARY KEY (date, cell_id)
+        );
+        CREATE VIEW IF NOT EXISTS {TABLE_NAME} AS
+        SELECT {_VIEW_COLUMNS}
+        FROM {DATA_TABLE} d JOIN {CELLS_TABLE} c USING (cell_id);
+    """)
+
+
+def upsert_weather(con, source: str, encoding: str = KEY_ENCODING) -> None:
+    """
+    UPSERT the rows of ``source`` (columns of ``weather_data_table``) into the storage of ``encoding``.
+
+    Raises:
+        ValueError: (compact) If a location shares its grid cell with a different stored location,
+            or a day/month/year is not a calendar date.
+    """
+    _check_encoding(encoding)
+    if encoding == "natural":
+        con.execute(f"""
+            INSERT INTO {TABLE_NAME}
+            SELECT * FROM {source}
+            ON CONFLICT (day, month, year, longitude, latitude) DO UPDATE SET
+                t2m_max = EXCLUDED.t2m_max,
+                t2m_min = EXCLUDED.t2m_min,
+                precipitation = EXCLUDED.precipitation;
+        """)
+        return
+
+    with _cells_checked(con, source):
+        con.execute(f"""
+            INSERT INTO {DATA_TABLE}
+            SELECT {_compact_select()} FROM {source}
+            ON CONFLICT (date, cell_id) DO UPDATE SET
+                t2m_max = EXCLUDED.t2m_max,
+                t2m_min = EXCLUDED.t2m_min,
+                precipitation = EXCLUDED.precipitation;
+        """)
+
+
+def bulk_load_weather(con, source: str, encoding: str = KEY_ENCODING) -> None:
+    """
+    Bulk-load ``source`` (see ``bulk_load.merge_rebuild``): same result as ``upsert_weather``
+    (existing keys only take the new measures), but the storage table is rebuilt set-wise with
+    its key index built once.
+
+    Raises:
+        ValueError: On a duplicated key in ``source``, or as ``upsert_weather``.
+    """
+    _check_encoding(encoding)
+    if encoding == "natural":
+        merge_rebuild(con, TABLE_NAME, f"SELECT * FROM {source}", KEY_COLUMNS, MEASURES,
+                      order_by=["year", "month", "day"])
+        return
+    with _cells_checked(con, source):
+        merge_rebuild(con, DATA_TABLE, f"SELECT {_compact_select()} FROM {source}", ["date", "cell_id"], MEASURES,
+                      order_by=["date"])
+
+
+def point_lookup(con, day: int, month: int, year: int, longitude: float, latitude: float,
+                 encoding: str = KEY_ENCODING) -> list[tuple]:
+    """
+    Rows of ``weather_data_table`` (zero or one) with the given natural key. For ``compact`` the
+    storage table is filtered on ``(date, cell_id)`` before the join, since filters on the view
+    columns are not pushed below it.
+    """
+    _check_encoding(encoding)
+    if encoding == "natural":
+        return con.execute(f"""
+            SELECT * FROM {TABLE_NAME}
+            WHERE day = ? AND month = ? AND year = ? AND longitude = ? AND latitude = ?
+        """, [day, month, year, longitude, latitude]).fetchall()
+    try:
+        key_date = date(year, month, day)   # tham số DATE sẵn để DuckDB dùng được index khoá
+    except ValueError:
+        return []
+    return con.execute(f"""
+        SELECT {_VIEW_COLUMNS}
+        FROM (
+            SELECT * FROM {DATA_TABLE}
+            WHERE date = $1 AND cell_id = {cell_id_sql('$2::DOUBLE', '$3::DOUBLE')}
+        ) d JOIN {CELLS_TABLE} c USING (cell_id)
+        WHERE c.longitude = $2 AND c.latitude = $3
+    """, [key_date, longitude, latitude]).fetchall()
+
+
+def storage_table(encoding: str = KEY_ENCODING) -> str:
+    """The physical table holding the rows of ``weather_data_table``."""
+    _check_encoding(encoding)
+    return TABLE_NAME if encoding == "natural" else DATA_TABLE
+
+
+def colliding_files(con, source: str, encoding: str = KEY_ENCODING) -> set[int]:
+    """
+    ``_file_seq`` of the files of ``source`` that ``compact`` cannot store: a file with two different
+    locations in one grid cell, or with a location whose cell already belongs to a different location,
+    either in ``CELLS_TABLE`` or in an earlier file of the batch. Always empty for ``natural``.
+    The storage tables must exist.
+    """
+    _check_encoding(encoding)
+    if encoding == "natural":
+        return set()
+    rows = con.execute(f"""
+        WITH locs AS (
+            SELECT DISTINCT _file_seq, {cell_id_sql()} AS cell_id, longitude, latitude FROM {source}
+        ), own_conflicts AS (
+            -- Trùng ô ngay trong file, hoặc với toạ độ đã lưu
+            SELECT _file_seq FROM locs GROUP BY _file_seq, cell_id HAVING count(*) > 1
+            UNION
+            SELECT l._file_seq FROM locs l JOIN {CELLS_TABLE} c USING (cell_id)
+            WHERE l.longitude <> c.longitude OR l.latitude <> c.latitude
+        ), owners AS (
+            -- Ô mới: thuộc về toạ độ của file đứng trước trong batch
+            SELECT cell_id, arg_min(longitude, _file_seq) AS longitude, arg_min(latitude, _file_seq) AS latitude
+            FROM locs WHERE _file_seq NOT IN (SELECT _file_seq FROM own_conflicts)
+            GROUP BY cell_id
+        )
+        SELECT _file_seq FROM own_conflicts
+        UNION
+        SELECT l._file_seq FROM locs l JOIN owners o USING (cell_id)
+        WHERE l.longitude <> o.longitude OR l.latitude <> o.latitude
+    """).fetchall()
+    return {row[0] for row in rows}
+
+
+@contextmanager
+def _cells_checked(con, source: str):
+    """
+    Register the batch's cells in ``CELLS_TABLE`` and validate the batch for the compact schema.
+    Loaders drop bad files beforehand (``calendar_dates``, ``colliding_files``); raising here is a last resort.
+    """
+    con.execute(f"""
+        CREATE OR REPLACE TEMP TABLE batch_cells AS
+        SELECT DISTINCT {cell_id_sql()} AS cell_id, longitude, latitude FROM {source};
+    """)
+    try:
+        con.execute(f"""
+            INSERT INTO {CELLS_TABLE}
+            SELECT cell_id, any_value(longitude), any_value(latitude) FROM batch_cells GROUP BY cell_id
+            ON CONFLICT DO NOTHING;
+        """)
+        # Mỗi ô chỉ ứng với đúng 1 toạ độ: giữ nguyên ngữ nghĩa khoá của schema natural
+        collisions = con.execute(f"""
+            SELECT count(*) FROM batch_cells b JOIN {CELLS_TABLE} c USING (cell_id)
+            WHERE b.longitude <> c.longitude OR b.latitude <> c.latitude
+        """).fetchone()[0]
+        if collisions:
+            raise ValueError(f"{collisions} toạ độ trùng ô lưới 1/{CELL_SCALE}° với một toạ độ khác đã lưu.")
+
+        invalid_dates = con.execute(
+            f"SELECT count(*) FROM {source} WHERE try(make_date(year, month, day)) IS NULL").fetchone()[0]
+        if invalid_dates:
+            raise ValueError(f"{invalid_dates} dòng có ngày/tháng/năm không phải ngày hợp lệ.")
+        yield
+    finally:
+        con.execute("DROP TABLE IF EXISTS batch_cells;")
@@ -1,84 +1,328 @@
-from fastapi import FastAPI, UploadFile, File
-from pydantic import BaseModel, conlist
-from typing import List
-import os, uuid, json
-from pydantic import BaseModel
-from typing import List, Union, Literal
+from fastapi import FastAPI, UploadFile, File, HTTPException, Query, Request, Response
+from fastapi.concurrency import run_in_threadpool
 from fastapi.responses import StreamingResponse
+from typing import Callable, List, Literal
+from datetime import date
+import duckdb
+import pyarrow as pa
+import os, uuid, threading
+from contextlib import asynccontextmanager
+from functools import partial
+from itertools import chain
+from pathlib import Path
 # from src1 import run_pipeline, duckdb_query, visualize_summary
-from src2 import run_pipeline, duckdb_query, visualize_summary
+from src2 import run_pipeline, visualize_summary, init_worker, data_version, decoded_path, DB_PATH, PARQUET_DIR
+from db import close_all, duckdb_query, duckdb_stream, get_manager
+from worker_pool import WorkerPool
+from jobs import JobQueue, QueueFullError
+from json_stream import ParquetUploadBuilder, JSON_SUFFIXES
+from columnar import COLUMNAR_SUFFIXES, columnar_format, stage_columnar
+from rollups import TABLE_NAME, YEARLY_SUMMARY_SQL, filter_sql, plan_query
+from export import ENCODERS, EXPORT_FORMATS
 
 
 
 UPLOAD_DIR = "new_data"
+UPLOAD_CHUNK_SIZE = 1 << 20                                            # xử lý upload theo từng 1 MiB
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", 2 * 1024 ** 3))   # giới hạn kích thước mỗi file (kiểm tra sau khi nhận xong)
+MAX_DECODED_BYTES = int(os.getenv("MAX_DECODED_BYTES", 8 * 1024 ** 3)) # giới hạn sau khi giải nén mỗi file
 os.makedirs(UPLOAD_DIR, exist_ok=True)
+os.makedirs(PARQUET_DIR, exist_ok=True)
 
-app = FastAPI()
 
+# === WORKER POOL + HÀNG ĐỢI JOB: tạo 1 lần khi khởi động, dùng lại cho mọi request ===
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    app.state.worker_pool = WorkerPool(initializer=init_worker).start()
+    app.state.jobs = JobQueue(partial(run_pipeline, pool=app.state.worker_pool))
+    app.state.jobs.start()
+    yield
+    await app.state.jobs.stop()
+    app.state.worker_pool.shutdown()
+    close_all()
 
-# === SCHEMA VALIDATION ===
-class WeatherRecord(BaseModel):
-    header: List[Literal["day", "month", "year", "day_of_year", "t2m_max", "t2m_min", "precipitation"]]
-    value: List[List[Union[int, float]]]
-    location: List[float]
+app = FastAPI(lifespan=lifespan)
 
-class WeatherMultiResponse(BaseModel):
-    duration: float
-    data: List[WeatherRecord]
 
+# === GIẢI MÃ + KIỂM TRA: mỗi upload chỉ được giải mã một lần, thẳng sang Parquet chờ pipeline ===
+class UploadTooLarge(ValueError):
+    pass
 
-@app.post("/upload-and-run")
+
+def _write_chunk(fh, on_chunk, chunk: bytes) -> None:
+    fh.write(chunk)
+    if on_chunk is not None:
+        on_chunk(chunk)
+
+
+def upload_encoding(file: UploadFile) -> str | None:
+    """Nén của upload: header Content-Encoding của phần multipart, nếu không có thì theo đuôi file."""
+    encoding = file.headers.get("content-encoding")
+    if encoding:
+        return encoding.strip().lower()
+    name = file.filename or ""
+    return next((enc for suffix, enc in JSON_SUFFIXES.items() if name.endswith(suffix)), None)
+
+
+async def receive_upload(file: UploadFile, file_path: Path, finish: Callable, on_chunk: Callable | None = None):
+    """
+    Chép upload xuống ``file_path`` theo từng chunk (qua file tạm ``.part``, rồi đổi tên khi xong).
+    ``on_chunk(chunk)`` xử lý tăng dần từng chunk, ``finish(part_path)`` trả về kết quả giải mã;
+    lỗi ở bất kỳ bước nào thì xoá file tạm. Mọi thao tác đĩa/CPU chạy ngoài event loop.
+
+    Giới hạn: đây không phải nhận upload dạng stream. Trước khi handler chạy, Starlette đã đọc hết
+    body multipart và spool từng file vào SpooledTemporaryFile (> 1 MiB là ra đĩa), nên
+    ``MAX_UPLOAD_BYTES`` chỉ được kiểm tra sau khi đã nhận đủ cả request, và mỗi byte được ghi
+    xuống đĩa hai lần (file spool + ``.part``). Hàm chỉ giữ cho bộ nhớ của bước giải mã không phụ
+    thuộc kích thước file. Giới hạn kích thước request cần đặt ở reverse proxy phía trước (vd
+    ``client_max_body_size`` của nginx).
+    """
+    part_path = file_path.with_name(file_path.name + ".part")
+    size = 0
+    fh = await run_in_threadpool(open, part_path, "wb")
+    try:
+        while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+            size += len(chunk)
+            if size > MAX_UPLOAD_BYTES:
+                raise UploadTooLarge(f"File vượt quá giới hạn {MAX_UPLOAD_BYTES} bytes.")
+            await run_in_threadpool(_write_chunk, fh, on_chunk, chunk)
+        await run_in_threadpool(fh.close)
+        result = await run_in_threadpool(finish, part_path)
+        await run_in_threadpool(os.replace, part_path, file_path)
+        return result
+    except BaseException:
+        await run_in_threadpool(fh.close)
+        await run_in_threadpool(part_path.unlink, missing_ok=True)
+        raise
+
+
+def enqueue(saved_files: list[Path], results: list[dict], decoded: dict) -> dict:
+    if not saved_files:
+        results.append({"pipeline_status": "⚠️ Không chạy pipeline vì không có file hợp lệ."})
+        return {"results": results}
+
+    # 🛠 Đưa vào hàng đợi, pipeline chạy nền; theo dõi qua /jobs/{job_id}
+    try:
+        job = app.state.jobs.submit(saved_files, uploads=results, decoded=decoded)
+    except QueueFullError as e:
+        for f in saved_files:
+            os.remove(f)
+            decoded[f].unlink(missing_ok=True)
+        raise HTTPException(status_code=503, detail=str(e))
+
+    results.append({"pipeline_status": "⏳ Pipeline đã được đưa vào hàng đợi."})
+    return {"job_id": job.id, "status_url": f"/jobs/{job.id}", "results": results}
+
+
+@app.post("/upload-and-run", status_code=202)
 async def upload_and_run(files: List[UploadFile] = File(...)):
     results = []
-    valid_json_files = 0
+    saved_files = []
+    decoded = {}
 
     for file in files:
+        builder = None
         try:
-            content = await file.read()
-            data = json.loads(content)
+            # Lưu nguyên bản bytes gốc (kể cả bản nén) nếu hợp lệ; pipeline dùng Parquet đã giải mã, không đọc lại file
+            encoding = upload_encoding(file)
+            suffix = next((sfx for sfx, enc in JSON_SUFFIXES.items() if enc == encoding), ".json")
+            unique_name = f"wt_data_{uuid.uuid4().hex[:8]}{suffix}"
+            file_path = Path(UPLOAD_DIR, unique_name).resolve()
+            builder = ParquetUploadBuilder(decoded_path(file_path), file.filename, encoding=encoding,
+                                           max_bytes=MAX_DECODED_BYTES)
+            rows = await receive_upload(file, file_path, lambda _: builder.finish(), builder.feed)
+
+            results.append({"filename": file.filename, "stored_as": unique_name, "rows": rows, "status": "✅ Hợp lệ"})
+            saved_files.append(file_path)
+            decoded[file_path] = builder.out_path
+
+        except Exception as e:
+            if builder is not None:
+                await run_in_threadpool(builder.abort)
+            results.append({"filename": file.filename, "status": f"❌ Không hợp lệ - {str(e)}"})
+
+    return enqueue(saved_files, results, decoded)
+
 
-            # Validate với Pydantic
-            parsed = WeatherMultiResponse(**data)
+# === NẠP DỮ LIỆU DẠNG CỘT: NDJSON phẳng, Parquet, Arrow IPC theo schema của weather_data_table ===
+@app.post("/ingest", status_code=202)
+async def ingest_columnar(files: List[UploadFile] = File(...)):
+    results = []
+    saved_files = []
+    decoded = {}
 
-            # Lưu nếu hợp lệ
-            unique_name = f"wt_data_{uuid.uuid4().hex[:8]}.json"
-            file_path = os.path.join(UPLOAD_DIR, unique_name)
-            with open(file_path, "w", encoding="utf-8") as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
+    for file in files:
+        out_path = None
+        try:
+            fmt = columnar_format(file.filename, file.content_type)
+            if fmt is None:
+                raise ValueError(f"Không nhận diện được định dạng (hỗ trợ: {', '.join(COLUMNAR_SUFFIXES)}).")
+            suffix = next(sfx for sfx, f in COLUMNAR_SUFFIXES.items() if f == fmt)
+            unique_name = f"wt_data_{uuid.uuid4().hex[:8]}{suffix}"
+            file_path = Path(UPLOAD_DIR, unique_name).resolve()
+            out_path = decoded_path(file_path)
+            rows = await receive_upload(file, file_path, partial(stage_columnar, fmt=fmt, out_path=out_path))
 
-            results.append({"filename": file.filename, "status": "✅ Hợp lệ"})
-            valid_json_files += 1
+            results.append({"filename": file.filename, "stored_as": unique_name, "format": fmt,
+                            "rows": rows, "status": "✅ Hợp lệ"})
+            saved_files.append(file_path)
+            decoded[file_path] = out_path
 
         except Exception as e:
+            if out_path is not None:
+                await run_in_threadpool(out_path.unlink, missing_ok=True)
             results.append({"filename": file.filename, "status": f"❌ Không hợp lệ - {str(e)}"})
 
-    if valid_json_files == 0:
-        results.append({"pipeline_status": "⚠️ Không chạy pipeline vì không có file hợp lệ."})
-        return {"results": results}
+    return enqueue(saved_files, results, decoded)
 
-    # 🛠 Gọi ETL Pipeline chính
-    try:
-        run_pipeline()
-        results.append({"pipeline_status": "🚀 Pipeline đã chạy thành công."})
-    except Exception as e:
-        results.append({"pipeline_status": f"❌ Lỗi khi chạy pipeline: {str(e)}"})
+@app.get("/jobs/{job_id}")
+def get_job(job_id: str):
+    job = app.state.jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Không tìm thấy job.")
+    return job.to_dict()
+
+# === CACHE CHO /chart: kết quả truy vấn + PNG, gắn với phiên bản dữ liệu (tăng mỗi lần nạp) ===
+_chart_cache = {"version": None, "result": None, "png": None}
+_chart_lock = threading.Lock()
+
+
+def _etag_matches(request: Request, etag: str) -> bool:
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    tags = [t.strip().removeprefix("W/") for t in header.split(",")]
+    return "*" in tags or etag in tags
 
-    return {"results": results}
 
 @app.get("/chart")
-def get_weather_chart():
+def get_weather_chart(request: Request):
     try:
-        db_file = "database/weather_data.duckdb"
-        table = "weather_data_table"
-        query = f"""
-            SELECT year, AVG(t2m_max) AS avg_max_temp, SUM(precipitation) AS total_precip
-            FROM {table}
-            GROUP BY year
-            ORDER BY year;
-        """
-        df = duckdb_query(db_file, query)
-        buf = visualize_summary(df)
-
-        return StreamingResponse(buf, media_type="image/png")
+        version = data_version()
+        etag = f'"chart-{version}"'
+        headers = {"ETag": etag, "Cache-Control": "no-cache"}
+        if _etag_matches(request, etag):
+            return Response(status_code=304, headers=headers)
+
+        with _chart_lock:
+            if _chart_cache["version"] != version:
+                df = duckdb_query(DB_PATH, YEARLY_SUMMARY_SQL)
+                _chart_cache.update(version=version, result=df, png=visualize_summary(df).getvalue())
+            png = _chart_cache["png"]
+
+        return Response(png, media_type="image/png", headers=headers)
     except Exception as e:
-        return {"error": str(e)}
\ No newline at end of file
+        return {"error": str(e)}
+
+
+# === TRUY VẤN TỔNG HỢP: tham số hoá, lọc đẩy xuống DuckDB, chọn rollup nhỏ nhất trả lời được ===
+GRANULARITIES = {
+    "total": [],
+    "year": ["year"],
+    "month": ["year", "month"],
+    "day": ["date"],
+    "location": ["longitude", "latitude"],
+    "location_month": ["longitude", "latitude", "year", "month"],
+    "region": ["region_lon", "region_lat"],
+    "region_year": ["region_lon", "region_lat", "year"],
+}
+MAX_PAGE_SIZE = 10_000
+NO_DATA_DETAIL = "Chưa có dữ liệu, hãy upload và chạy pipeline trước."
+
+
+def _summary_filters(bbox, year_from, year_to, date_from, date_to) -> dict:
+    filters = {}
+    if bbox:
+        try:
+            min_lon, min_lat, max_lon, max_lat = (float(v) for v in bbox.split(","))
+        except ValueError:
+            raise ValueError("bbox phải có dạng min_lon,min_lat,max_lon,max_lat.")
+        filters["longitude"] = (min_lon, max_lon)
+        filters["latitude"] = (min_lat, max_lat)
+    if date_from or date_to:
+        date_from, date_to = date_from or date.min, date_to or date.max
+        filters["date"] = (date_from, date_to)
+        # Thêm khoảng năm để zone map của DuckDB bỏ qua các row group không liên quan
+        year_from = max(year_from or date_from.year, date_from.year)
+        year_to = min(year_to or date_to.year, date_to.year)
+    if year_from is not None or year_to is not None:
+        filters["year"] = (year_from if year_from is not None else 0, year_to if year_to is not None else 9999)
+    return filters
+
+
+@app.get("/query/summary")
+def query_summary(
+    metrics: str = Query("avg_t2m_max", description="vd avg_t2m_max,sum_precipitation,count"),
+    granularity: Literal[tuple(GRANULARITIES)] = "year",
+    bbox: str | None = Query(None, description="min_lon,min_lat,max_lon,max_lat"),
+    year_from: int | None = None,
+    year_to: int | None = None,
+    date_from: date | None = None,
+    date_to: date | None = None,
+    format: Literal["json", "arrow"] = "json",
+    limit: int = Query(1000, ge=1, le=MAX_PAGE_SIZE),
+    offset: int = Query(0, ge=0),
+):
+    cur = get_manager(DB_PATH).cursor()
+    try:
+        filters = _summary_filters(bbox, year_from, year_to, date_from, date_to)
+        # Lấy dư 1 dòng để biết còn trang sau hay không
+        sql, params, source = plan_query(cur, [m.strip() for m in metrics.split(",") if m.strip()],
+                                         GRANULARITIES[granularity], filters, limit + 1, offset)
+        result = cur.execute(sql, params).arrow()
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except duckdb.CatalogException:
+        # DB mới, chưa chạy pipeline lần nào: chưa có bảng dữ liệu
+        raise HTTPException(status_code=503, detail=NO_DATA_DETAIL)
+
+    next_offset = offset + limit if result.num_rows > limit else None
+    result = result.slice(0, limit)
+
+    if format == "arrow":
+        sink = pa.BufferOutputStream()
+        with pa.ipc.new_stream(sink, result.schema) as writer:
+            writer.write_table(result)
+        headers = {"X-Source": source}
+        if next_offset is not None:
+            headers["X-Next-Offset"] = str(next_offset)
+        return Response(sink.getvalue().to_pybytes(), media_type="application/vnd.apache.arrow.stream", headers=headers)
+
+    return {
+        "source": source,
+        "granularity": granularity,
+        "rows": result.to_pylist(),
+        "limit": limit,
+        "offset": offset,
+        "next_offset": next_offset,
+    }
+
+
+# === XUẤT DỮ LIỆU: stream từng record batch từ DuckDB ra Arrow IPC / Parquet, bộ nhớ không đổi ===
+@app.get("/export")
+def export_data(
+    format: Literal[tuple(EXPORT_FORMATS)] = "parquet",
+    bbox: str | None = Query(None, description="min_lon,min_lat,max_lon,max_lat"),
+    year_from: int | None = None,
+    year_to: int | None = None,
+    date_from: date | None = None,
+    date_to: date | None = None,
+):
+    try:
+        where, params = filter_sql(_summary_filters(bbox, year_from, year_to, date_from, date_to))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    sql = f"SELECT * FROM {TABLE_NAME}" + (f" WHERE {where}" if where else "")
+    batches = duckdb_stream(DB_PATH, sql, params)
+    try:
+        # Chạy truy vấn trước khi trả response: lỗi phải thành mã lỗi, không phải body 200 bị cắt giữa chừng
+        first = next(batches)
+    except duckdb.CatalogException:
+        raise HTTPException(status_code=503, detail=NO_DATA_DETAIL)
+    media_type, suffix = EXPORT_FORMATS[format]
+    return StreamingResponse(
+        ENCODERS[format](chain([first], batches)),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{TABLE_NAME}{suffix}"'},
+    )
@@ -0,0 +1,302 @@
+"""
+Incrementally maintained rollups of ``weather_data_table`` and a query router over them.
+
+Each rollup keeps, per group of its dimensions, the row count and the sum/count of every
+measure. All rollups are updated from the delta of every upsert instead of re-aggregating
+the whole table: inside one transaction the rows the batch is about to overwrite are
+snapshotted, the upsert runs, and ``new - old`` per group is merged into each rollup.
+Overwritten rows are therefore retracted exactly, whatever the conflict semantics of the
+upsert.
+
+``plan_query`` answers ``(metrics, group_by, filters)`` from the smallest rollup whose
+dimensions cover the request and falls back to the base table only when none does (or
+when a metric, like ``min``/``max``, cannot be maintained under retraction).
+"""
+import logging
+from typing import Callable
+
+import duckdb
+import pandas as pd
+
+TABLE_NAME = "weather_data_table"
+KEY_COLUMNS = ["day", "month", "year", "longitude", "latitude"]
+MEASURES = ["t2m_max", "t2m_min", "precipitation"]
+
+REGION_DEGREES = 5   # vùng = ô lưới REGION_DEGREES x REGION_DEGREES độ
+
+# Chiều có thể group/lọc: tên → biểu thức trên bảng gốc (hoặc trên rollup có longitude/latitude)
+DIMENSIONS = {
+    "year": "year",
+    "month": "month",
+    "day": "day",
+    "day_of_year": "day_of_year",
+    "longitude": "longitude",
+    "latitude": "latitude",
+    "region_lon": f"floor(longitude / {REGION_DEGREES}) * {REGION_DEGREES}",
+    "region_lat": f"floor(latitude / {REGION_DEGREES}) * {REGION_DEGREES}",
+    "date": "make_date(year, month, day)",
+}
+# Chiều suy ra được từ các chiều khác của rollup
+DERIVED_FROM = {"region_lon": ("longitude",), "region_lat": ("latitude",), "date": ("year", "month", "day")}
+
+# Rollup: tên bảng → các chiều (khoá chính)
+ROLLUPS = {
+    "rollup_year": ["year"],
+    "rollup_global_day": ["year", "month", "day", "day_of_year"],
+    "rollup_region_year": ["region_lon", "region_lat", "year"],
+    "rollup_location_month": ["longitude", "latitude", "year", "month"],
+}
+VERSION_TABLE = "data_version"   # số phiên bản dữ liệu, tăng mỗi lần UPSERT commit
+
+_DIMENSION_TYPES = {"longitude": "DOUBLE", "latitude": "DOUBLE", "region_lon": "DOUBLE", "region_lat": "DOUBLE"}
+
+# Tổng hợp theo năm cho biểu đồ: đúng kết quả của AVG(t2m_max) / SUM(precipitation) theo năm
+YEARLY_SUMMARY_SQL = """
+    SELECT year,
+           t2m_max_sum / nullif(t2m_max_count, 0) AS avg_max_temp,
+           CASE WHEN precipitation_count > 0 THEN precipitation_sum END AS total_precip
+    FROM rollup_year
+    ORDER BY year;
+"""
+
+
+# ----- BẢO TRÌ ROLLUP -----
+def _aggregate_sql(source: str, dims: list[str], sign: int = 1) -> str:
+    measures = ",\n".join(
+        f"{sign} * coalesce(sum({m}), 0) AS {m}_sum, {sign} * count({m}) AS {m}_count" for m in MEASURES)
+    dim_sql = ", ".join(f"{DIMENSIONS[d]} AS {d}" for d in dims)
+    return f"""
+        SELECT {dim_sql}, {sign} * count(*) AS row_count, {measures}
+        FROM {source}
+        GROUP BY ALL
+    """
+
+
+def _table_exists(con, name: str) -> bool:
+    return con.execute(
+        "SELECT count(*) FROM information_schema.tables WHERE table_name = ?", [name]
+    ).fetchone()[0] > 0
+
+
+def read_version(con) -> int:
+    """Current data version (0 before the first ingest)."""
+    if not _table_exists(con, VERSION_TABLE):
+        return 0
+    row = con.execute(f"SELECT version FROM {VERSION_TABLE}").fetchone()
+    return row[0] if row else 0
+
+
+def _bump_version(con) -> int:
+    return con.execute(f"UPDATE {VERSION_TABLE} SET version = version + 1 RETURNING version").fetchone()[0]
+
+
+def create_rollup_tables(con) -> None:
+    """Create the rollup and version tables; a new rollup over an existing base table is backfilled once."""
+    if not _table_exists(con, VERSION_TABLE):
+        con.execute(f"CREATE TABLE {VERSION_TABLE} (version BIGINT); INSERT INTO {VERSION_TABLE} VALUES (0);")
+    base_exists = _table_exists(con, TABLE_NAME)
+    for name, dims in ROLLUPS.items():
+        if _table_exists(con, name):
+            continue
+        dim_cols = ", ".join(f"{d} {_DIMENSION_TYPES.get(d, 'INTEGER')}" for d in dims)
+        measure_cols = ", ".join(f"{m}_sum DOUBLE, {m}_count BIGINT" for m in MEASURES)
+        con.execute(f"""
+            CREATE TABLE {name} (
+                {dim_cols},
+                row_count BIGINT,
+                {measure_cols},
+                PRIMARY KEY ({", ".join(dims)})
+            );
+        """)
+        if base_exists:
+            rebuild_rollups(con, [name])
+
+
+def rebuild_rollups(con, names: list[str] | None = None) -> None:
+    """Recompute rollups from a full scan (backfill, or to reset floating-point drift)."""
+    for name in names or ROLLUPS:
+        con.execute(f"DELETE FROM {name};")
+        con.execute(f"INSERT INTO {name} {_aggregate_sql(TABLE_NAME, ROLLUPS[name])};")
+        logging.info(f"🧮 Rebuilt '{name}' from '{TABLE_NAME}'.")
+
+
+def _merge_delta(con, name: str, delta_sql: str) -> None:
+    dims = ROLLUPS[name]
+    value_cols = ["row_count"] + [f"{m}_{part}" for m in MEASURES for part in ("sum", "count")]
+    con.execute(f"""
+        INSERT INTO {name}
+        SELECT {", ".join(dims)}, {", ".join(f"sum({c})" for c in value_cols)}
+        FROM ({delta_sql})
+        GROUP BY ALL
+        ON CONFLICT ({", ".join(dims)}) DO UPDATE SET
+            {", ".join(f"{c} = {c} + EXCLUDED.{c}" for c in value_cols)};
+    """)
+    con.execute(f"DELETE FROM {name} WHERE row_count = 0;")
+
+
+def _rollback(con) -> None:
+    try:
+        con.execute("ROLLBACK;")
+    except duckdb.TransactionException:
+        pass  # COMMIT thất bại (vd vi phạm khoá) đã tự rollback
+
+
+def upsert_with_rollups(con, source: str, upsert: Callable) -> int:
+    """
+    Run ``upsert(con, source)``, update every rollup from its delta and bump the data
+    version, atomically. Returns the new data version.
+
+    Only the rows with the batch's keys are read back (before and after the upsert); the
+    year range of the batch is inlined so DuckDB's zone maps skip unrelated row groups.
+    """
+    keys = ", ".join(KEY_COLUMNS)
+    con.execute("BEGIN TRANSACTION;")
+    try:
+        con.execute(f"CREATE OR REPLACE TEMP TABLE batch_keys AS SELECT DISTINCT {keys} FROM {source};")
+        lo, hi = con.execute("SELECT min(year), max(year) FROM batch_keys").fetchone()
+        if lo is None:  # batch rỗng: không có gì để tổng hợp
+            upsert(con, source)
+            version = _bump_version(con)
+            con.execute("COMMIT;")
+            return version
+        affected = f"""
+            (SELECT t.* FROM {TABLE_NAME} t SEMI JOIN batch_keys k USING ({keys})
+             WHERE t.year BETWEEN {lo} AND {hi})
+        """
+        con.execute(f"CREATE OR REPLACE TEMP TABLE batch_old AS SELECT * FROM {affected};")
+        upsert(con, source)
+        con.execute(f"CREATE OR REPLACE TEMP TABLE batch_new AS SELECT * FROM {affected};")
+        for name, dims in ROLLUPS.items():
+            delta = f"{_aggregate_sql('batch_new', dims)} UNION ALL {_aggregate_sql('batch_old', dims, -1)}"
+            _merge_delta(con, name, delta)
+        version = _bump_version(con)
+        con.execute("COMMIT;")
+        return version
+    except Exception:
+        _rollback(con)
+        raise
+    finally:
+        con.execute("DROP TABLE IF EXISTS batch_keys; DROP TABLE IF EXISTS batch_old; DROP TABLE IF EXISTS batch_new;")
+
+
+def bulk_load_with_rollups(con, source: str, bulk_load: Callable) -> int:
+    """
+    Run ``bulk_load(con, source)``, rebuild every rollup from a full scan and bump the data
+    version, atomically. Returns the new data version.
+
+    For backfills a full re-aggregation costs about as much as the rebuild of the base table
+    itself and is cheaper than tracking the delta of a batch this large.
+    """
+    con.execute("BEGIN TRANSACTION;")
+    try:
+        bulk_load(con, source)
+        rebuild_rollups(con)
+        version = _bump_version(con)
+        con.execute("COMMIT;")
+        return version
+    except Exception:
+        _rollback(con)
+        raise
+
+
+# ----- QUERY ROUTER -----
+def _metric_sql(metric: str, from_rollup: bool) -> str:
+    """``count``, ``sum_<measure>``, ``avg_<measure>`` (rollup hoặc bảng gốc), ``min_``/``max_`` (chỉ bảng gốc)."""
+    if metric == "count":
+        return "sum(row_count)::BIGINT" if from_rollup else "count(*)"
+    func, _, measure = metric.partition("_")
+    if measure not in MEASURES or func not in ("sum", "avg", "min", "max"):
+        raise ValueError(f"Metric không hợp lệ: {metric}")
+    if not from_rollup:
+        return f"{func}({measure})"
+    if func == "sum":
+        return f"CASE WHEN sum({measure}_count) > 0 THEN sum({measure}_sum) END"
+    return f"sum({measure}_sum) / nullif(sum({measure}_count), 0)"
+
+
+def _covers(dims: list[str], needed: set[str]) -> bool:
+    return all(d in dims or (d in DERIVED_FROM and set(DERIVED_FROM[d]) <= set(dims)) for d in needed)
+
+
+def choose_source(con, metrics: list[str], group_by: list[str], filters: dict) -> str:
+    """The smallest rollup that can answer the request, else ``TABLE_NAME``."""
+    if any(metric.partition("_")[0] in ("min", "max") for metric in metrics):
+        return TABLE_NAME
+    needed = set(group_by) | set(filters)
+    sizes = dict(con.execute("SELECT table_name, estimated_size FROM duckdb_tables()").fetchall())
+    candidates = [name for name, dims in ROLLUPS.items() if name in sizes and _covers(dims, needed)]
+    return min(candidates, key=sizes.get) if candidates else TABLE_NAME
+
+
+def filter_sql(filters: dict, dim_expr: Callable[[str], str] = DIMENSIONS.__getitem__) -> tuple[str, list]:
+    """
+    ``WHERE`` condition (without the keyword, ``""`` if there are no filters) and its parameters for
+    ``{dimension: value | [values] | (lo, hi)}``; ``dim_expr`` maps a dimension to its SQL expression.
+
+    Raises:
+        ValueError: On an unknown dimension.
+    """
+    conditions, params = [], []
+    for d, value in filters.items():
+        if d not in DIMENSIONS:
+            raise ValueError(f"Chiều không hợp lệ: {d}")
+        if isinstance(value, tuple):
+            conditions.append(f"{dim_expr(d)} BETWEEN ? AND ?")
+            params += list(value)
+        elif isinstance(value, list):
+            conditions.append(f"{dim_expr(d)} IN ({', '.join('?' * len(value))})")
+            params += value
+        else:
+            conditions.append(f"{dim_expr(d)} = ?")
+            params.append(value)
+    return " AND ".join(conditions), params
+
+
+def plan_query(con, metrics: list[str], group_by: list[str] = (), filters: dict | None = None,
+               limit: int | None = None, offset: int = 0) -> tuple[str, list, str]:
+    """
+    Build the SQL, its parameters and the chosen source table for an aggregate request.
+    Only whitelisted identifiers are formatted into the SQL; every value is a ``?`` parameter.
+
+    Args:
+        metrics: e.g. ``["avg_t2m_max", "sum_precipitation", "count"]``.
+        group_by: Dimension names from ``DIMENSIONS``.
+        filters: ``{dimension: value | [values] | (lo, hi)}``.
+        limit, offset: Optional page of the (ordered) result.
+
+    Raises:
+        ValueError: On an unknown metric or dimension.
+    """
+    group_by, filters = list(group_by), dict(filters or {})
+    for d in [*group_by, *filters]:
+        if d not in DIMENSIONS:
+            raise ValueError(f"Chiều không hợp lệ: {d}")
+    if not metrics:
+        raise ValueError("Cần ít nhất một metric.")
+
+    source = choose_source(con, metrics, group_by, filters)
+    from_rollup = source != TABLE_NAME
+
+    def dim_expr(d):
+        # Chiều lưu sẵn trong rollup thì đọc thẳng cột, còn lại tính từ biểu thức
+        return d if from_rollup and d in ROLLUPS[source] else DIMENSIONS[d]
+
+    where, params = filter_sql(filters, dim_expr)
+
+    select = [f"{dim_expr(d)} AS {d}" for d in group_by] + [f"{_metric_sql(m, from_rollup)} AS {m}" for m in metrics]
+    sql = f"SELECT {', '.join(select)} FROM {source}"
+    if where:
+        sql += " WHERE " + where
+    if group_by:
+        sql += f" GROUP BY {', '.join(group_by)} ORDER BY {', '.join(group_by)}"
+    if limit is not None:
+        sql += " LIMIT ? OFFSET ?"
+        params += [limit, offset]
+    logging.info(f"🧭 Query routed to '{source}'.")
+    return sql, params, source
+
+
+def query(con, metrics: list[str], group_by: list[str] = (), filters: dict | None = None) -> pd.DataFrame:
+    """Run an aggregate request through the router and return the result as a DataFrame."""
+    sql, params, _ = plan_query(con, metrics, group_by, filters)
+    return con.execute(sql, params).df()
@@ -0,0 +1,55 @@
+# So sánh chi phí Great Expectations cho mỗi file:
+#   - cold: dựng context + datasource + suite cho từng file (cách cũ của src2.validate_and_convert)
+#   - warm: context + suite dựng 1 lần/worker (src2.init_worker), mỗi file chỉ còn bước validate
+# Chạy từ thư mục gốc: python source/bench_gx_context.py [số_file]
+
+import os
+import sys
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.makedirs("logs", exist_ok=True)
+
+import pandas as pd
+import pyarrow as pa
+import src2
+
+
+def sample_batch(n_rows=365):
+    rows = [[-118.2437, 34.0522, (i % 28) + 1, (i % 12) + 1, 1990, i + 1, 10.5, 2.1, 0.0] for i in range(n_rows)]
+    # Cùng kiểu cột với batch thật mà worker kiểm tra (ARROW_SCHEMA: cột nguyên là int32)
+    df = pd.DataFrame(rows, columns=src2.COLUMNS)
+    return pa.Table.from_pandas(df, schema=src2.ARROW_SCHEMA, preserve_index=False).to_pandas()
+
+
+def elapsed(start):
+    delta = datetime.now() - start
+    return delta.seconds + delta.microseconds / 1000000
+
+
+def main():
+    n_files = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    df = sample_batch()
+
+    # Cold: mỗi file khởi tạo lại toàn bộ context và suite
+    time_start = datetime.now()
+    for _ in range(n_files):
+        src2._gx_state = None
+        assert src2.validate_batch(df)
+    cold = elapsed(time_start)
+
+    # Warm: khởi tạo 1 lần như initializer của worker
+    src2.init_worker()
+    time_start = datetime.now()
+    for _ in range(n_files):
+        assert src2.validate_batch(df)
+    warm = elapsed(time_start)
+
+    print(f"\nSố file: {n_files}")
+    print(f"Cold (context mỗi file): {cold:.3f}s  ({cold / n_files * 1000:.1f} ms/file)")
+    print(f"Warm (context mỗi worker): {warm:.3f}s  ({warm / n_files * 1000:.1f} ms/file)")
+    print(f"Chi phí khởi tạo tiết kiệm mỗi file: {(cold - warm) / n_files * 1000:.1f} ms\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+# So sánh 2 chế độ nạp của src2.run_pipeline trên cùng một bộ file JSON:
+#   - python: worker (ProcessPoolExecutor) đọc JSON → Arrow → GE, rồi UPSERT từ bảng Arrow
+#   - duckdb: read_json + UNNEST + kiểm tra bằng SQL, UPSERT ngay trong DuckDB
+# Mỗi chế độ chạy trên bản sao riêng của thư mục JSON, với ERROR_DIR và file DuckDB tạm riêng:
+# file bị từ chối được chuyển khỏi bản sao, thư mục nguồn giữ nguyên và hai chế độ thấy cùng bộ file.
+# Chạy từ thư mục gốc: python source/bench_ingest_modes.py [thư_mục_json]
+
+import os
+import shutil
+import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from pathlib import Path
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.makedirs("logs", exist_ok=True)
+
+import src2
+from db import close_all
+
+
+def elapsed(start):
+    delta = datetime.now() - start
+    return delta.seconds + delta.microseconds / 1000000
+
+
+def run_python(json_files):
+    with ProcessPoolExecutor(max_workers=os.cpu_count(), initializer=src2.init_worker) as pool:
+        staged = [t for t in pool.map(src2.validate_and_convert, json_files) if t is not None]
+    src2.load_to_duckdb(staged)
+
+
+def run_duckdb(json_files):
+    src2.ingest_json_with_duckdb(json_files)
+
+
+def main():
+    json_dir = Path(sys.argv[1]) if len(sys.argv) > 1 else Path("raw_data")
+    json_files = sorted(json_dir.glob("*.json"))
+    if not json_files:
+        print(f"Không tìm thấy file JSON nào trong thư mục: {json_dir}")
+        return
+    size_mb = sum(f.stat().st_size for f in json_files) / 1024 / 1024
+    print(f"\nSố file: {len(json_files)} ({size_mb:.1f} MB)")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, run in [("python", run_python), ("duckdb", run_duckdb)]:
+            work_dir = Path(tmp) / name
+            input_dir = work_dir / "input"
+            input_dir.mkdir(parents=True)
+            (work_dir / "error").mkdir()
+            src2.ERROR_DIR = work_dir / "error"   # đặt trước khi tạo worker (fork) để worker cũng thấy
+            src2.DB_PATH = work_dir / f"bench_{name}.duckdb"
+            copies = [Path(shutil.copy(f, input_dir)) for f in json_files]
+
+            time_start = datetime.now()
+            run(copies)
+            seconds = elapsed(time_start)
+            rows = src2.duckdb_query(src2.DB_PATH, f"SELECT COUNT(*) AS n FROM {src2.TABLE_NAME}")["n"][0]
+            rejected = len(list(src2.ERROR_DIR.iterdir()))
+            print(f"{name:>7}: {seconds:.3f}s  ({rows} dòng, {rows / seconds:,.0f} dòng/s, {rejected} file bị từ chối)")
+        close_all()  # đóng kết nối dùng chung trước khi xoá thư mục tạm
+    print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+# So sánh 2 schema lưu weather_data_table (key_encoding.py) trên cùng một bộ file JSON:
+#   - natural: khoá chính (day, month, year, longitude, latitude)
+#   - compact: khoá chính (date DATE, cell_id INTEGER) + bảng weather_cells, weather_data_table là view
+# Đo: thời gian nạp lần đầu, thời gian UPSERT lại toàn bộ (mọi dòng đều trùng khoá),
+#     dung lượng file DuckDB, độ trễ tra cứu theo khoá và truy vấn tổng hợp theo vùng.
+# Chạy từ thư mục gốc: python source/bench_key_encoding.py [thư_mục_json]
+
+import os
+import random
+import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from pathlib import Path
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.makedirs("logs", exist_ok=True)
+
+import src2
+from db import close_all, get_manager
+from key_encoding import KEY_ENCODINGS, point_lookup
+
+LOOKUPS = 200
+
+
+def elapsed(start):
+    delta = datetime.now() - start
+    return delta.seconds + delta.microseconds / 1000000
+
+
+def load(json_files):
+    with ProcessPoolExecutor(max_workers=os.cpu_count(), initializer=src2.init_worker) as pool:
+        staged = [t for t in pool.map(src2.validate_and_convert, json_files) if t is not None]
+    start = datetime.now()
+    src2.load_to_duckdb(staged)
+    return elapsed(start)
+
+
+def lookup_latency(cur, sql, keys):
+    start = datetime.now()
+    for key in keys:
+        cur.execute(sql, key).fetchall()
+    return elapsed(start) / len(keys) * 1000
+
+
+def main():
+    json_dir = Path(sys.argv[1]) if len(sys.argv) > 1 else Path("raw_data")
+    json_files = sorted(json_dir.glob("*.json"))
+    if not json_files:
+        print(f"Không tìm thấy file JSON nào trong thư mục: {json_dir}")
+        return
+    print(f"\nSố file: {len(json_files)}")
+
+    keys = None
+    with tempfile.TemporaryDirectory() as tmp:
+        for encoding in KEY_ENCODINGS:
+            src2.KEY_ENCODING = encoding
+            src2.DB_PATH = Path(tmp) / f"bench_{encoding}.duckdb"
+            first = load(json_files)
+            again = load(json_files)   # toàn bộ dòng trùng khoá → đo đường ON CONFLICT
+
+            manager = get_manager(src2.DB_PATH)
+            with manager.writer() as con:
+                con.execute("CHECKPOINT;")
+            cur = manager.cursor()
+            rows = cur.execute(f"SELECT count(*) FROM {src2.TABLE_NAME}").fetchone()[0]
+            size_mb = src2.DB_PATH.stat().st_size / 1024 / 1024
+            if keys is None:
+                keys = cur.execute(f"SELECT day, month, year, longitude, latitude FROM {src2.TABLE_NAME}").fetchall()
+                keys = random.Random(0).sample(keys, min(LOOKUPS, len(keys)))
+
+            by_columns = lookup_latency(cur, f"""
+                SELECT * FROM {src2.TABLE_NAME}
+                WHERE day = ? AND month = ? AND year = ? AND longitude = ? AND latitude = ?
+            """, keys)
+            lon, lat = keys[0][3], keys[0][4]
+            start = datetime.now()
+            cur.execute(f"""
+                SELECT year, avg(t2m_max), sum(precipitation) FROM {src2.TABLE_NAME}
+                WHERE longitude BETWEEN ? AND ? AND latitude BETWEEN ? AND ?
+                GROUP BY year
+            """, [lon - 1, lon + 1, lat - 1, lat + 1]).fetchall()
+            scan_ms = elapsed(start) * 1000
+
+            print(f"\n{encoding:>8}: {rows} dòng, {size_mb:.1f} MB")
+            print(f"          nạp lần đầu {first:.3f}s, UPSERT lại {again:.3f}s")
+            print(f"          tra cứu theo cột gốc {by_columns:.3f} ms/lần, tổng hợp theo vùng {scan_ms:.1f} ms")
+            if encoding == "compact":
+                start = datetime.now()
+                for key in keys:
+                    point_lookup(cur, *key, encoding=encoding)
+                by_key = elapsed(start) / len(keys) * 1000
+                print(f"          tra cứu qua point_lookup (date, cell_id) {by_key:.3f} ms/lần")
+        close_all()  # đóng kết nối dùng chung trước khi xoá thư mục tạm
+    print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+# So sánh bước kiểm tra dữ liệu của src1 trên cùng một batch:
+#   - pydantic: 1 WeatherRecord cho mỗi dòng rồi .model_dump() (cách cũ của src1.validate_and_convert)
+#   - cột: src1.validate_columns, kiểm tra bằng mask NumPy trên cả cột
+# Cách cột tính cả việc dựng RecordBatch Arrow của các dòng hợp lệ; cách cũ chỉ ra list dict,
+# chưa tính vòng dict -> DataFrame -> Arrow mà nó còn phải làm thêm.
+# Chạy từ thư mục gốc: python source/bench_src1_validation.py [số_dòng]
+
+import os
+import sys
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.makedirs("logs", exist_ok=True)
+
+import numpy as np
+from pydantic import BaseModel, ValidationError, confloat, conint
+
+import src1
+
+REPEAT = 7
+
+class WeatherRecord(BaseModel):
+    """Model per-row cũ của src1, giữ lại chỉ để so sánh."""
+    lon: confloat(ge=-180, le=180)
+    lat: confloat(ge=-90, le=90)
+    day: conint(ge=1, le=31)
+    month: conint(ge=1, le=12)
+    year: conint(ge=1900, le=2100)
+    day_of_year: int
+    t2m_max: float
+    t2m_min: float
+    precipitation: float
+
+
+def sample_rows(n_rows):
+    rng = np.random.default_rng(0)
+    rows = [[105.85, 21.03, (i % 28) + 1, (i % 12) + 1, 1990 + i % 30, i % 365 + 1,
+             float(v), float(v) - 8.0, 0.0] for i, v in enumerate(rng.normal(30, 3, n_rows))]
+    for i in range(0, n_rows, 100):   # 1% dòng lỗi để cả 2 cách đều phải loại bỏ
+        rows[i][3] = 13
+    return rows
+
+
+def elapsed(start):
+    delta = datetime.now() - start
+    return delta.seconds + delta.microseconds / 1000000
+
+
+def main():
+    n_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    rows = sample_rows(n_rows)
+    fields = list(WeatherRecord.model_fields)
+
+    time_start = datetime.now()
+    accepted = []
+    for row in rows:
+        try:
+            accepted.append(WeatherRecord(**dict(zip(fields, row))).model_dump())
+        except ValidationError:
+            pass
+    per_row = elapsed(time_start)
+
+    matrix = np.asarray(rows, dtype=np.float64)
+    times = []
+    for _ in range(REPEAT):   # pipeline gọi validate_columns cho mỗi batch: lấy trung vị, bỏ lần chạy lạnh
+        time_start = datetime.now()
+        # Tính cả bước chép sang cột liên tục mà json_stream làm cho mỗi batch
+        values = np.ascontiguousarray(matrix.T)
+        batch, _, _ = src1.validate_columns({col: values[i] for i, col in enumerate(src1.FIELD_RULES)})
+        times.append(elapsed(time_start))
+    by_column = float(np.median(times))
+    assert batch.num_rows == len(accepted)
+
+    print(f"\nSố dòng: {n_rows} (hợp lệ: {batch.num_rows})")
+    print(f"Pydantic mỗi dòng: {per_row:.3f}s")
+    print(f"Mask theo cột:     {by_column:.4f}s (trung vị {REPEAT} lần)")
+    print(f"Nhanh hơn: {per_row / by_column:.1f}x\n")
+
+
+if __name__ == "__main__":
+    main()
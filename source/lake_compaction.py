@@ -0,0 +1,187 @@
+# Gộp các file Parquet nhỏ trong từng phân vùng của lake (xem parquet_lake.py).
+# Chạy 1 lần:      python source/lake_compaction.py [thư_mục_lake]
+# Chạy định kỳ:    python source/lake_compaction.py [thư_mục_lake] --interval 600
+"""
+Background compaction of the Parquet lake.
+
+Within a partition, files smaller than ``SMALL_FILE_BYTES`` are read, sorted by the remaining key
+columns and rewritten as files of about ``TARGET_FILE_BYTES`` with ``ROW_GROUP_ROWS``-row row groups.
+The new files are written next to the old ones (invisible until listed), then swapped in by one
+atomic manifest update; the replaced files become tombstones and are deleted after
+``RETENTION_SECONDS``. Readers never wait: they keep scanning whatever file list they started with.
+"""
+import argparse
+import os
+import threading
+import uuid
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from parquet_lake import RETENTION_SECONDS, manifest_lock, read_manifest, write_manifest
+
+SMALL_FILE_BYTES = 32 * 1024 ** 2
+TARGET_FILE_BYTES = 128 * 1024 ** 2
+ROW_GROUP_ROWS = 122_880           # = 1 row group của DuckDB
+MIN_FILES = int(os.getenv("LAKE_COMPACT_MIN_FILES", 4))   # chỉ gộp phân vùng có ít nhất ngần này file nhỏ
+SORT_COLUMNS = ["year", "month", "day", "longitude", "latitude"]
+
+
+def _file_bytes(lake_dir: Path, entry: dict) -> int:
+    return entry.get("bytes") or os.path.getsize(lake_dir / entry["path"])
+
+
+def plan_compaction(lake_dir, min_files: int = MIN_FILES, small_file_bytes: int = SMALL_FILE_BYTES) -> dict:
+    """``{partition directory: [manifest entries of its small files]}`` for partitions worth compacting."""
+    lake_dir = Path(lake_dir)
+    groups = {}
+    for entry in read_manifest(lake_dir)["files"]:
+        if _file_bytes(lake_dir, entry) < small_file_bytes:
+            groups.setdefault(Path(entry["path"]).parent.as_posix(), []).append(entry)
+    return {partition: entries for partition, entries in groups.items() if len(entries) >= min_files}
+
+
+def _rewrite(lake_dir: Path, partition: str, entries: list[dict]) -> list[dict]:
+    # Đọc từng file như 1 file lẻ (không suy ra cột phân vùng từ đường dẫn)
+    table = pa.concat_tables(pq.ParquetFile(lake_dir / e["path"]).read() for e in entries)
+    sort_keys = [c for c in SORT_COLUMNS if c in table.schema.names]
+    table = table.sort_by([(c, "ascending") for c in sort_keys])
+
+    total_bytes = sum(_file_bytes(lake_dir, e) for e in entries)
+    rows_per_file = max(ROW_GROUP_ROWS, TARGET_FILE_BYTES * table.num_rows // max(total_bytes, 1))
+    batch_id = f"{datetime.now():%Y%m%d%H%M%S}-{uuid.uuid4().hex[:8]}"
+    added = datetime.now().isoformat(timespec="seconds")
+    new_entries = []
+    for i, offset in enumerate(range(0, table.num_rows, rows_per_file)):
+        relative = f"{partition}/compact-{batch_id}-{i}.parquet"
+        chunk = table.slice(offset, rows_per_file)
+        pq.write_table(chunk, lake_dir / relative, row_group_size=ROW_GROUP_ROWS)
+        new_entries.append({"path": relative, "rows": chunk.num_rows, "bytes": os.path.getsize(lake_dir / relative),
+                            "partition": entries[0]["partition"], "added": added})
+    return new_entries
+
+
+def _purge_tombstones(lake_dir: Path, manifest: dict, retention_seconds: int) -> int:
+    cutoff = datetime.now() - timedelta(seconds=retention_seconds)
+    keep, purged = [], 0
+    for tombstone in manifest["tombstones"]:
+        if datetime.fromisoformat(tombstone["removed"]) <= cutoff:
+            (lake_dir / tombstone["path"]).unlink(missing_ok=True)
+            purged += 1
+        else:
+            keep.append(tombstone)
+    manifest["tombstones"] = keep
+    return purged
+
+
+def compact_partition(lake_dir, partition: str, entries: list[dict],
+                      retention_seconds: int = RETENTION_SECONDS) -> list[dict]:
+    """
+    Rewrite ``entries`` (small files of ``partition``) into target-sized sorted files and swap them in.
+
+    Returns:
+        The new manifest entries, or ``[]`` if another writer changed these files meanwhile
+        (the rewritten files are then discarded).
+    """
+    lake_dir = Path(lake_dir)
+    new_entries = _rewrite(lake_dir, partition, entries)
+
+    replaced = {e["path"] for e in entries}
+    with manifest_lock(lake_dir):
+        manifest = read_manifest(lake_dir)
+        current = {e["path"] for e in manifest["files"]}
+        if not replaced <= current:
+            for entry in new_entries:
+                (lake_dir / entry["path"]).unlink(missing_ok=True)
+            return []
+        removed = datetime.now().isoformat(timespec="seconds")
+        manifest["files"] = [e for e in manifest["files"] if e["path"] not in replaced] + new_entries
+        manifest["tombstones"] += [{"path": path, "removed": removed} for path in sorted(replaced)]
+        _purge_tombstones(lake_dir, manifest, retention_seconds)
+        manifest["version"] += 1
+        write_manifest(lake_dir, manifest)
+    return new_entries
+
+
+def compact_lake(lake_dir, min_files: int = MIN_FILES, retention_seconds: int = RETENTION_SECONDS) -> dict:
+    """Compact every partition with at least ``min_files`` small files; purge expired tombstones."""
+    lake_dir = Path(lake_dir)
+    stats = {"partitions": 0, "files_in": 0, "files_out": 0}
+    for partition, entries in plan_compaction(lake_dir, min_files).items():
+        new_entries = compact_partition(lake_dir, partition, entries, retention_seconds)
+        if new_entries:
+            stats["partitions"] += 1
+            stats["files_in"] += len(entries)
+            stats["files_out"] += len(new_entries)
+
+    with manifest_lock(lake_dir):
+        manifest = read_manifest(lake_dir)
+        if manifest["tombstones"] and _purge_tombstones(lake_dir, manifest, retention_seconds):
+            write_manifest(lake_dir, manifest)
+    return stats
+
+
+class LakeCompactor:
+    """
+    Runs ``compact_lake`` on a background thread every ``interval`` seconds.
+
+    Args:
+        lake_dir: Root directory of the lake.
+        interval (float): Seconds between runs.
+        min_files (int): Small files a partition needs before it is compacted.
+    """
+
+    def __init__(self, lake_dir, interval: float = 600, min_files: int = MIN_FILES):
+        self.lake_dir = Path(lake_dir)
+        self.interval = interval
+        self.min_files = min_files
+        self._stop = threading.Event()
+        self._thread = None
+
+    def run_once(self) -> dict:
+        start = datetime.now()
+        stats = compact_lake(self.lake_dir, self.min_files)
+        if stats["partitions"]:
+            print(f"🗜️ Đã gộp {stats['files_in']} → {stats['files_out']} file trong {stats['partitions']} phân vùng "
+                  f"({(datetime.now() - start).total_seconds():.2f}s).")
+        return stats
+
+    def _loop(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.run_once()
+            except Exception as e:
+                print(f"❌ Lỗi khi gộp file trong lake '{self.lake_dir}': {e}")
+
+    def start(self) -> "LakeCompactor":
+        self._thread = threading.Thread(target=self._loop, name="lake-compactor", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Gộp các file Parquet nhỏ trong lake.")
+    parser.add_argument("lake_dir", nargs="?", default="parquet_lake")
+    parser.add_argument("--interval", type=float, default=0, help="Chạy lặp lại mỗi N giây (0: chạy 1 lần)")
+    parser.add_argument("--min-files", type=int, default=MIN_FILES)
+    args = parser.parse_args()
+
+    compactor = LakeCompactor(args.lake_dir, args.interval, args.min_files)
+    print(compactor.run_once())
+    if args.interval > 0:
+        compactor.start()
+        try:
+            compactor._thread.join()
+        except KeyboardInterrupt:
+            compactor.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,188 @@
+"""
+Append-only, Hive-partitioned Parquet lake.
+
+New data is written as new files under ``year=/month=`` (and optionally ``tile_lon=/tile_lat=``)
+directories; existing files are never read or rewritten, so an ingest costs O(new data).
+``_manifest.json`` lists the committed files: it is replaced atomically after the files of an
+append are fully written, and readers only ever see files listed in it.
+
+Manifest updates (appends, compaction swaps) are serialized by ``manifest_lock``; files that a
+swap removes are kept as tombstones for ``RETENTION_SECONDS`` so readers holding an older file
+list are never broken.
+
+``create_lake_view`` exposes the lake to DuckDB as a view over exactly the manifest's files with
+Hive partitioning on, so filters on the partition columns skip whole files by path.
+"""
+import json
+import os
+import threading
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+
+try:
+    import fcntl
+except ImportError:  # Windows: chỉ khoá giữa các thread
+    fcntl = None
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+MANIFEST_NAME = "_manifest.json"
+LOCK_NAME = "_manifest.lock"
+PARTITION_COLUMNS = ["year", "month"]
+TILE_COLUMNS = ["tile_lon", "tile_lat"]
+VIEW_NAME = "weather_lake"
+RETENTION_SECONDS = int(os.getenv("LAKE_RETENTION_SECONDS", 3600))   # giữ file đã bị thay thế cho reader cũ
+
+_lock = threading.Lock()
+
+
+# ----- MANIFEST -----
+def read_manifest(lake_dir) -> dict:
+    """The committed state of the lake (an empty manifest if the lake does not exist yet)."""
+    path = Path(lake_dir, MANIFEST_NAME)
+    if not path.exists():
+        return {"version": 0, "columns": None, "partitioning": None, "tile_degrees": None,
+                "files": [], "tombstones": []}
+    with open(path, "r", encoding="utf-8") as f:
+        manifest = json.load(f)
+    manifest.setdefault("tombstones", [])
+    return manifest
+
+
+@contextmanager
+def manifest_lock(lake_dir):
+    """Exclusive right to read-modify-write the manifest, across threads and (via flock) processes."""
+    Path(lake_dir).mkdir(parents=True, exist_ok=True)
+    with _lock, open(Path(lake_dir, LOCK_NAME), "a") as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def write_manifest(lake_dir, manifest: dict) -> None:
+    """Atomically replace the manifest (temp file + ``os.replace``)."""
+    path = Path(lake_dir, MANIFEST_NAME)
+    tmp_path = path.with_name(f".{MANIFEST_NAME}.{uuid.uuid4().hex[:8]}.tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=1)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def _partition_of(relative_path: str) -> dict:
+    return {k: int(v) for k, v in (part.split("=", 1) for part in Path(relative_path).parent.parts)}
+
+
+# ----- GHI DỮ LIỆU -----
+def _add_tiles(table: pa.Table, tile_degrees: int) -> pa.Table:
+    for column, source in zip(TILE_COLUMNS, ["longitude", "latitude"]):
+        tile = pc.multiply(pc.floor(pc.divide(table[source], tile_degrees)), tile_degrees).cast(pa.int32())
+        table = table.append_column(column, tile)
+    return table
+
+
+def _check_layout(manifest: dict, columns: list[str], partitioning: list[str], tile_degrees) -> None:
+    if not manifest["files"]:
+        return
+    if columns != manifest["columns"]:
+        raise ValueError(f"Cột không khớp lake: {columns} != {manifest['columns']}")
+    if partitioning != manifest["partitioning"] or tile_degrees != manifest["tile_degrees"]:
+        raise ValueError(f"Phân vùng không khớp lake: {manifest['partitioning']} "
+                         f"(tile_degrees={manifest['tile_degrees']})")
+
+
+def append_to_lake(table: pa.Table, lake_dir, tile_degrees: int | None = None) -> list[dict]:
+    """
+    Write ``table`` as new files of the lake and commit them to the manifest.
+
+    Args:
+        table: Rows to append; must have the lake's columns (the first append fixes them).
+        lake_dir: Root directory of the lake.
+        tile_degrees: Also partition by a ``tile_degrees`` x ``tile_degrees`` spatial tile.
+            Fixed by the first append.
+
+    Returns:
+        The manifest entries of the new files.
+
+    Raises:
+        ValueError: If the columns or the partitioning differ from the existing lake.
+    """
+    lake_dir = Path(lake_dir)
+    partitioning = PARTITION_COLUMNS + (TILE_COLUMNS if tile_degrees else [])
+    _check_layout(read_manifest(lake_dir), table.schema.names, partitioning, tile_degrees)
+    if table.num_rows == 0:
+        return []
+
+    # Ghi file ngoài khoá: file chưa có trong manifest thì chưa reader nào thấy
+    if tile_degrees:
+        table = _add_tiles(table, tile_degrees)
+    batch_id = f"{datetime.now():%Y%m%d%H%M%S}-{uuid.uuid4().hex[:8]}"
+    written = []
+    pq.write_to_dataset(
+        table, lake_dir,
+        partition_cols=partitioning,
+        basename_template=f"part-{batch_id}-{{i}}.parquet",
+        existing_data_behavior="overwrite_or_ignore",   # tên file là duy nhất, không ghi đè file cũ
+        file_visitor=written.append,
+    )
+
+    added = datetime.now().isoformat(timespec="seconds")
+    entries = []
+    for w in written:
+        relative = Path(w.path).relative_to(lake_dir).as_posix()
+        entries.append({"path": relative, "rows": w.metadata.num_rows, "bytes": w.size,
+                        "partition": _partition_of(relative), "added": added})
+
+    columns = [c for c in table.schema.names if c not in TILE_COLUMNS]
+    with manifest_lock(lake_dir):
+        manifest = read_manifest(lake_dir)
+        try:
+            _check_layout(manifest, columns, partitioning, tile_degrees)
+        except ValueError:
+            for entry in entries:
+                (lake_dir / entry["path"]).unlink(missing_ok=True)
+            raise
+        manifest.update(version=manifest["version"] + 1, columns=columns, partitioning=partitioning,
+                        tile_degrees=tile_degrees, files=manifest["files"] + entries)
+        write_manifest(lake_dir, manifest)
+    return entries
+
+
+# ----- DUCKDB -----
+def lake_scan_sql(lake_dir, manifest: dict | None = None) -> str | None:
+    """``read_parquet`` over the committed files, columns in their original order (``None`` if empty)."""
+    lake_dir = Path(lake_dir)
+    manifest = manifest or read_manifest(lake_dir)
+    if not manifest["files"]:
+        return None
+    files = ", ".join(f"'{(lake_dir / f['path']).as_posix()}'" for f in manifest["files"])
+    hive_types = ", ".join(f"'{c}': INTEGER" for c in manifest["partitioning"])
+    columns = ", ".join(manifest["columns"] + [c for c in manifest["partitioning"] if c in TILE_COLUMNS])
+    return f"""
+        SELECT {columns}
+        FROM read_parquet([{files}], hive_partitioning = true, hive_types = {{{hive_types}}})
+    """
+
+
+def create_lake_view(con, lake_dir, view_name: str = VIEW_NAME) -> bool:
+    """
+    (Re)create ``view_name`` over the lake's current manifest. Filters on ``year``/``month``
+    (and ``tile_lon``/``tile_lat``) are pushed down as file filters. Call again after an append.
+
+    Returns:
+        False if the lake has no files yet (no view is created).
+    """
+    scan = lake_scan_sql(lake_dir)
+    if scan is None:
+        return False
+    con.execute(f"CREATE OR REPLACE VIEW {view_name} AS {scan};")
+    return True
@@ -4,13 +4,20 @@ import os
 import shutil 
 import duckdb
 from datetime import datetime
+from parquet_lake import VIEW_NAME, append_to_lake, create_lake_view
 
+# "lake": ghi thêm vào lake phân vùng year=/month= (mặc định); "merge": đọc + ghi lại toàn bộ merged_output.parquet
+STORAGE_MODE = os.getenv("STORAGE_MODE", "lake")
+LAKE_DIR = "parquet_lake"
+TILE_DEGREES = int(os.getenv("LAKE_TILE_DEGREES", "0")) or None   # > 0: phân vùng thêm theo ô không gian
 
-def merge_new_parquet(input_directory, output_file_path, schema):
+
+def read_new_parquet(input_directory, schema):
+    """Đọc + nối các file Parquet mới hợp lệ trong input_directory (None nếu không có)."""
     parquet_files = [f for f in os.listdir(input_directory) if f.endswith('.parquet')]
     if not parquet_files:
         print(f"\nKhông tìm thấy file Parquet nào trong thư mục: {input_directory}'.\n")
-        return
+        return None
     print(f"\nTìm thấy {len(parquet_files)} file Parquet trong thư mục: {input_directory}.\n")
 
     new_tables = []
@@ -30,7 +37,7 @@ def merge_new_parquet(input_directory, output_file_path, schema):
 
     if not new_tables:
         print("Không có dữ liệu mới hợp lệ để hợp nhất.")
-        return
+        return None
     print(f"Thời gian đọc: {(datetime.now() - time1).seconds + ((datetime.now() - time1).microseconds) / 1000000}s")
 
 
@@ -39,6 +46,13 @@ def merge_new_parquet(input_directory, output_file_path, schema):
     new_data_table = pa.concat_tables(new_tables)
     print(f"Tổng số hàng dữ liệu mới: {new_data_table.num_rows}")
     print(f"Thời gian nối: {(datetime.now() - time2).seconds + ((datetime.now() - time2).microseconds) / 1000000}s")
+    return new_data_table
+
+
+def merge_new_parquet(input_directory, output_file_path, schema):
+    new_data_table = read_new_parquet(input_directory, schema)
+    if new_data_table is None:
+        return
 
     final_table = new_data_table
 
@@ -94,15 +108,58 @@ def merge_new_parquet(input_directory, output_file_path, schema):
         print(f"Lỗi khi ghi file '{output_file_path}': {e}")
 
     finally:
-        if os.path.exists(input_directory):
-            try:
-                print(f"\nĐang xóa thư mục đầu vào: {input_directory}")
-                time6 = datetime.now()
-                shutil.rmtree(input_directory)
-                print(f"Đã xóa thành công thư mục: {input_directory}.")
-                print(f"Thời gian xoá: {(datetime.now() - time6).seconds + ((datetime.now() - time6).microseconds) / 1000000}s\n")
-            except OSError as e:
-                print(f"Lỗi khi xóa thư mục: {input_directory}': {e}")
+        remove_input_directory(input_directory)
+
+
+def remove_input_directory(input_directory):
+    if os.path.exists(input_directory):
+        try:
+            print(f"\nĐang xóa thư mục đầu vào: {input_directory}")
+            time6 = datetime.now()
+            shutil.rmtree(input_directory)
+            print(f"Đã xóa thành công thư mục: {input_directory}.")
+            print(f"Thời gian xoá: {(datetime.now() - time6).seconds + ((datetime.now() - time6).microseconds) / 1000000}s\n")
+        except OSError as e:
+            print(f"Lỗi khi xóa thư mục: {input_directory}': {e}")
+
+
+def append_new_parquet(input_directory, lake_dir, schema, tile_degrees=None):
+    """Chế độ lake: chỉ ghi dữ liệu mới thành file mới trong lake phân vùng, không đọc lại dữ liệu cũ."""
+    new_data_table = read_new_parquet(input_directory, schema)
+    if new_data_table is None:
+        return
+
+    try:
+        print(f"\nĐang ghi dữ liệu mới vào lake '{lake_dir}'...")
+        time5 = datetime.now()
+        entries = append_to_lake(new_data_table, lake_dir, tile_degrees=tile_degrees)
+        print(f"Đã ghi {len(entries)} file mới, {sum(e['rows'] for e in entries)} hàng.")
+        print(f"Thời gian ghi: {(datetime.now() - time5).seconds + ((datetime.now() - time5).microseconds) / 1000000}s")
+
+        query_time = datetime.now()
+        con = duckdb.connect(database=':memory:', read_only=False)
+        create_lake_view(con, lake_dir)
+        years = sorted({e["partition"]["year"] for e in entries})
+        # Lọc theo cột phân vùng → DuckDB chỉ mở các file của những năm vừa nạp
+        qr = f"""
+            SELECT year, AVG(t2m_max) AS avg_max_temp, SUM(precipitation) AS total_precip
+            FROM {VIEW_NAME}
+            WHERE year BETWEEN {years[0]} AND {years[-1]}
+            GROUP BY year
+            ORDER BY year;
+        """
+        print("\nĐang chạy truy vấn SQL trên view của lake (các năm vừa nạp)...")
+        print("Kết quả truy vấn:")
+        print(con.execute(qr).fetchdf())
+        con.close()
+        print(f"Thời gian truy vấn: {(datetime.now() - query_time).seconds + ((datetime.now() - query_time).microseconds) / 1000000}s")
+
+        print("\nQuá trình ghi vào lake hoàn tất!")
+    except Exception as e:
+        print(f"Lỗi khi ghi vào lake '{lake_dir}': {e}")
+        return
+    remove_input_directory(input_directory)
+
 
 # def agg_query(qr):
 #     time7 = datetime.now()
@@ -134,7 +191,10 @@ def main():
     start_time = datetime.now()
     convert_json_to_parquet(input_json_folder, output_parquet_folder)
     
-    merge_new_parquet(input_dir, output_file, schema)
+    if STORAGE_MODE == "merge":
+        merge_new_parquet(input_dir, output_file, schema)
+    else:
+        append_new_parquet(input_dir, LAKE_DIR, schema, tile_degrees=TILE_DEGREES)
 
     print(f"Tổng thời gian: {(datetime.now() - start_time).seconds + ((datetime.now() - start_time).microseconds) / 1000000}s\n")
     
@@ -1,11 +1,12 @@
 import time
 import os
-import json
 import logging
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import duckdb
 from pathlib import Path
-from pydantic import BaseModel, conint, confloat
 from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 import seaborn as sns
 from io import BytesIO
@@ -13,6 +14,11 @@ import matplotlib
 import matplotlib.pyplot as plt
 import matplotlib.ticker as ticker
 from datetime import datetime
+from json_stream import ARROW_SCHEMA, calendar_dates, glob_json, iter_column_batches, json_stem
+from worker_pool import WorkerPool
+from db import duckdb_query, get_manager
+from bulk_load import LOAD_MODE, choose_load_mode, merge_rebuild
+from dedup import STAGED_BATCH, parquet_sequence_sql, stage_latest, tag_sequence
 matplotlib.use("Agg")
 
 # --- Define ---
@@ -23,6 +29,7 @@ DB_DIR = BASE_DIR / "database"
 DB_PATH = DB_DIR / "weather_data.duckdb"
 TABLE_NAME = "weather_data_table"
 CHART_DIR = BASE_DIR / "charts"
+STAGE_TO_DISK = False   # Opt-in: stage converted data as temporary Parquet files instead of Arrow tables
 
 
 RENAME_MAP = {
@@ -33,152 +40,287 @@ RENAME_MAP = {
     "t2m_max": "max_temp",
     "t2m_min": "min_temp",
     "precipitation": "precip",
-    "lon": "lon",
-    "lat": "lat"
+    "longitude": "lon",
+    "latitude": "lat"
 }
 
 DUCKDB_COLUMNS = ["day", "month", "year", "doy", "max_temp", "min_temp", "precip", "lon", "lat"]
+KEY_COLUMNS = ["day", "month", "year", "lon", "lat"]
+
+PARQUET_SCHEMA = pa.schema([
+    ("day", pa.int32()), ("month", pa.int32()), ("year", pa.int32()), ("doy", pa.int32()),
+    ("max_temp", pa.float64()), ("min_temp", pa.float64()), ("precip", pa.float64()),
+    ("lon", pa.float64()), ("lat", pa.float64()),
+])
 
 # --- Logging Setup ---
 logging.basicConfig(
     level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 
-# --- Data Validation Model ---
-class WeatherRecord(BaseModel):
+# --- Data Validation Rules ---
+# Constraints applied column-wise to every batch: (min, max, must_be_integer).
+# ``None`` bounds mean the column is only type-checked.
+FIELD_RULES = {
+    "longitude": (-180, 180, False),    # Longitude: float between -180 and 180
+    "latitude": (-90, 90, False),       # Latitude: float between -90 and 90
+    "day": (1, 31, True),               # Day of month: integer between 1 and 31
+    "month": (1, 12, True),             # Month: integer between 1 and 12
+    "year": (1900, 2100, True),         # Year: integer between 1900 and 2100
+    "day_of_year": (None, None, True),  # Day of year: integer (no specific range, but typically 1-366)
+    "t2m_max": (None, None, False),     # Maximum temperature at 2 meters
+    "t2m_min": (None, None, False),     # Minimum temperature at 2 meters
+    "precipitation": (None, None, False),  # Total precipitation
+}
+# Cross-field rule: day/month/year must form a real calendar date (e.g. no 30 February).
+DATE_RULE = "date_calendar"
+INT32_MIN, INT32_MAX = -2**31, 2**31 - 1
+
+
+def _rule_counts(columns: dict[str, np.ndarray]) -> dict[str, int]:
+    """Number of rows of ``columns`` failing each rule (see ``validate_columns``)."""
+    reject = np.zeros(len(columns["longitude"]), dtype=bool)
+    reject_counts = {}
+
+    for col, (lo, hi, integer) in FIELD_RULES.items():
+        values = columns[col]
+        missing = np.isnan(values)
+        checks = {f"{col}_type": missing}
+        if integer:
+            with np.errstate(invalid="ignore"):
+                checks[f"{col}_int"] = ~missing & (np.mod(values, 1) != 0)
+            if lo is None:
+                lo, hi = INT32_MIN, INT32_MAX   # giá trị phải vừa cột INTEGER
+        if lo is not None:
+            checks[f"{col}_range"] = ~missing & ((values < lo) | (values > hi))
+
+        for rule, failed in checks.items():
+            count = int(failed.sum())
+            if count:
+                reject_counts[rule] = count
+                reject |= failed
+
+    # Checked on rows that passed the field rules, so a bad month is not counted twice
+    failed = ~reject & ~calendar_dates(columns["day"], columns["month"], columns["year"])
+    if failed.any():
+        reject_counts[DATE_RULE] = int(failed.sum())
+    return reject_counts
+
+
+def validate_columns(columns: dict[str, np.ndarray]) -> tuple[pa.RecordBatch, np.ndarray, dict[str, int]]:
     """
-    Pydantic model for validating the structure and types of each weather record.
-    Ensures data integrity with type hints and range constraints.
+    Validates a batch of weather rows against ``FIELD_RULES`` using whole-column mask
+    operations instead of one model instance per row.
+
+    A row is rejected if any of its fields is missing or non-numeric (``<col>_type``), not a
+    whole number for integer fields (``<col>_int``) or outside its bounds (``<col>_range``;
+    the INTEGER range for unbounded integer fields), or if a complete day/month/year is not a
+    calendar date (``DATE_RULE``).
+
+    The checks run once over the float64 columns, and each integer column is cast to int32
+    only once: that cast is both the integrality check and the Arrow column. The Arrow batch
+    is built once from the accepted rows. Per-rule counts are computed only on rejected rows.
+
+    Args:
+        columns (dict[str, np.ndarray]): float64 column buffers keyed by the names of ``FIELD_RULES``.
+
+    Returns:
+        tuple: The accepted rows as an Arrow RecordBatch, the boolean reject mask aligned
+        with the input and the number of rows failing each rule.
     """
-    lon: confloat(ge=-180, le=180)      # Longitude: float between -180 and 180
-    lat: confloat(ge=-90, le=90)        # Latitude: float between -90 and 90
-    day: conint(ge=1, le=31)            # Day of month: integer between 1 and 31
-    month: conint(ge=1, le=12)          # Month: integer between 1 and 12
-    year: conint(ge=1900, le=2100)      # Year: integer between 1900 and 2100
-    day_of_year: int                    # Day of year: integer (no specific range, but typically 1-366)
-    t2m_max: float                      # Maximum temperature at 2 meters
-    t2m_min: float                      # Minimum temperature at 2 meters
-    precipitation: float                # Total precipitation
+    valid = np.ones(len(columns["longitude"]), dtype=bool)
+    typed = {}
+
+    with np.errstate(invalid="ignore"):
+        for col, (lo, hi, integer) in FIELD_RULES.items():
+            values = columns[col]
+            if integer:
+                # NaN, phần lẻ và giá trị tràn int32 đều không còn bằng giá trị gốc sau khi ép kiểu
+                typed[col] = values.astype(np.int32)
+                valid &= typed[col] == values
+            else:
+                typed[col] = values
+                if lo is None:
+                    valid &= ~np.isnan(values)
+            if lo is not None:
+                valid &= values >= lo   # NaN không thoả so sánh nào
+                valid &= values <= hi
+
+    # Ngày 1-28 luôn hợp lệ: chỉ kiểm tra lịch cho các dòng còn lại
+    late = np.flatnonzero(valid & (typed["day"] > 28))
+    if len(late):
+        valid[late] = calendar_dates(typed["day"][late], typed["month"][late], typed["year"][late])
+
+    reject = ~valid
+    if not reject.any():
+        return _accepted_batch(typed), reject, {}
+    reject_counts = _rule_counts({col: values[reject] for col, values in columns.items()})
+    return _accepted_batch({col: values[valid] for col, values in typed.items()}), reject, reject_counts
+
+
+def _accepted_batch(typed: dict[str, np.ndarray]) -> pa.RecordBatch:
+    """RecordBatch with ``ARROW_SCHEMA`` from validated columns (no nulls, integers already int32)."""
+    return pa.RecordBatch.from_arrays([pa.array(typed[field.name], type=field.type) for field in ARROW_SCHEMA],
+                                      schema=ARROW_SCHEMA)
 
 # --- JSON to Parquet Conversion ---
-def validate_and_convert(json_path: Path) -> Path | None:
+def validate_and_convert(json_path: Path, stage_to_disk: bool = STAGE_TO_DISK) -> Path | pa.Table | None:
     """
-    Validates data from a JSON file using Pydantic, transforms it into a Pandas DataFrame,
-    renames columns, and saves it as a Parquet file.
+    Validates data from a JSON file with the vectorized column rules, renames columns,
+    and stages the accepted rows for loading.
+
+    The JSON file is decoded incrementally into batches of ``BATCH_ROWS`` rows; invalid
+    rows are dropped batch by batch, so memory stays bounded regardless of the file size.
 
     Args:
         json_path (Path): The path to the input JSON file.
+        stage_to_disk (bool): Write a temporary Parquet file instead of returning an
+            in-memory Arrow table.
 
     Returns:
-        Path | None: The path to the generated Parquet file if successful, otherwise None.
+        Path | pa.Table | None: The Arrow table (or Parquet file path when staging to disk)
+        if successful, otherwise None.
     """
+    parquet_path = PARQUET_DIR / f"{json_stem(json_path)}.parquet"
+    writer = None
+    tables = []
+    total_rows = 0
+    total_rejects = {}
+
     try:
-        with open(json_path, 'r', encoding='utf-8') as f: # Specify encoding for robustness
-            raw_data = json.load(f)
-        
-        valid_records = []
-        
-        for location_data in raw_data.get("data", []):
-            lon, lat = location_data.get("location", [None, None])
-            
-            if lon is None or lat is None:
-                logging.warning(f"⚠️ Skipping record in {json_path.name} due to missing location data.")
+        for columns in iter_column_batches(json_path, strict=False):  # bad rows are dropped below
+            accepted, reject, reject_counts = validate_columns(columns)
+            for rule, count in reject_counts.items():
+                total_rejects[rule] = total_rejects.get(rule, 0) + count
+            if not accepted.num_rows:
                 continue
 
-            for row_values in location_data.get("value", []):
-                try:
-                    # Validate each row against the WeatherRecord Pydantic model
-                    record = WeatherRecord(
-                        lon=lon, lat=lat,
-                        day=row_values[0], month=row_values[1], year=row_values[2], day_of_year=row_values[3],
-                        t2m_max=row_values[4], t2m_min=row_values[5], precipitation=row_values[6]
-                    )
-                    valid_records.append(record.dict())
-                except Exception as e:
-                    # Log validation errors for individual rows but continue processing
-                    logging.debug(f"DEBUG: Validation failed for a row in {json_path.name}: {e}. Skipping row.")
-                    continue
-
-        if valid_records:
-            df = pd.DataFrame(valid_records)
-            
-            # Rename columns according to RENAME_MAP and select only DUCKDB_COLUMNS
-            df = df.rename(columns=RENAME_MAP)[DUCKDB_COLUMNS]
-            
-            parquet_path = PARQUET_DIR / json_path.with_suffix(".parquet").name
-            df.to_parquet(parquet_path, index=False)           
+            table = (pa.Table.from_batches([accepted])
+                     .rename_columns([RENAME_MAP[name] for name in accepted.schema.names])
+                     .select(DUCKDB_COLUMNS))
+            total_rows += table.num_rows
+            if not stage_to_disk:
+                tables.append(table)
+                continue
+            if writer is None:
+                writer = pq.ParquetWriter(parquet_path, PARQUET_SCHEMA)
+            writer.write_table(table)
+
+        if total_rejects:
+            logging.debug(f"DEBUG: Rows failing validation in {json_path.name}: {total_rejects}. Skipped.")
+
+        if tables:
+            logging.info(f"✅ Converted: {json_path.name} → Arrow table ({total_rows} rows)")
+            return pa.concat_tables(tables)
 
-            logging.info(f"✅ Converted: {json_path.name} → {parquet_path.name}")
+        elif writer is not None:
+            writer.close()
+            logging.info(f"✅ Converted: {json_path.name} → {parquet_path.name} ({total_rows} rows)")
             return parquet_path
-        
+
         else:
             logging.warning(f"⚠️ No valid records found in {json_path.name}. No Parquet file generated.")
             return None
 
-    except json.JSONDecodeError as e:
+    except (ValueError, OSError) as e:
         logging.error(f"❌ Failed to parse JSON from {json_path.name}: {e}")
-        return None
     except Exception as e:
         logging.error(f"❌ An unexpected error occurred while converting {json_path.name}: {e}")
-        return None
+
+    # Remove the partially written Parquet file so it is never loaded
+    if writer is not None:
+        writer.close()
+        parquet_path.unlink(missing_ok=True)
+    return None
 
 # --- Load to DuckDB ---
-def append_parquets_to_duckdb(parquet_files: list[Path]):
+def append_parquets_to_duckdb(staged: list[Path] | list[pa.Table], load_mode: str = LOAD_MODE):
     """
-    Appends data from a list of Parquet files into a DuckDB table.
+    Appends staged data into a DuckDB table.
     Creates the database directory and table if they don't exist.
 
+    Arrow tables are registered as a view and scanned by DuckDB directly from memory;
+    Parquet files are read with ``read_parquet``.
+
     Args:
-        parquet_files (list[Path]): A list of paths to Parquet files to be loaded.
+        staged (list[Path] | list[pa.Table]): Parquet file paths or Arrow tables to be loaded.
+        load_mode (str): "upsert", "bulk" (rebuild the table and its key index once, for
+            backfills) or "auto" (bulk only for batches that are large compared to the table).
     """
     DB_DIR.mkdir(parents=True, exist_ok=True) # Ensure the database directory exists
 
-    if not parquet_files:
-        logging.warning("⚠️ No Parquet files provided to append to DuckDB.")
+    if not staged:
+        logging.warning("⚠️ No staged data provided to append to DuckDB.")
         return
 
-    con = duckdb.connect(str(DB_PATH))
     try:
-        con.execute(f"""
-            CREATE TABLE IF NOT EXISTS {TABLE_NAME} (
-                day INTEGER,
-                month INTEGER,
-                year INTEGER,
-                doy INTEGER,
-                max_temp DOUBLE,
-                min_temp DOUBLE,
-                precip DOUBLE,
-                lon DOUBLE,
-                lat DOUBLE,
-                PRIMARY KEY (day, month, year, lon, lat)
-            );
-        """)
+        with get_manager(DB_PATH).writer() as con:
+            _append_staged(con, staged, load_mode)
+        logging.info(f"📥 Successfully appended {len(staged)} staged files to DuckDB table '{TABLE_NAME}'.")
+    except duckdb.Error as e:
+        logging.error(f"❌ DuckDB error while appending files: {e}")
+    except Exception as e:
+        logging.error(f"❌ An unexpected error occurred during DuckDB append: {e}")
+
 
+def _append_staged(con, staged: list[Path] | list[pa.Table], load_mode: str = LOAD_MODE):
+    """Create the table if needed and upsert or bulk-load ``staged`` on the given (writer) connection."""
+    con.execute(f"""
+        CREATE TABLE IF NOT EXISTS {TABLE_NAME} (
+            day INTEGER,
+            month INTEGER,
+            year INTEGER,
+            doy INTEGER,
+            max_temp DOUBLE,
+            min_temp DOUBLE,
+            precip DOUBLE,
+            lon DOUBLE,
+            lat DOUBLE,
+            PRIMARY KEY (day, month, year, lon, lat)
+        );
+    """)
+
+    if isinstance(staged[0], pa.Table):
+        # Register the Arrow tables as a view: no temporary files are written or read
+        con.register("staged_data", tag_sequence(staged))
+        raw_source = "staged_data"
+    else:
         # Convert Path objects to string paths for DuckDB's read_parquet function
-        file_list_str = [str(p) for p in parquet_files]
-        
-        # Use DuckDB's efficient read_parquet function to insert data
+        file_list_str = [str(p) for p in staged]
+        raw_source = parquet_sequence_sql(file_list_str)
+
+    try:
+        # A key repeated in the batch would fail the whole upsert: keep the last staged row per key
+        duplicates = stage_latest(con, raw_source, KEY_COLUMNS)
+        if duplicates:
+            logging.warning(f"⚠️ Dropped {duplicates} duplicate-key rows from the batch (last file/row wins).")
+        source = STAGED_BATCH
+
+        if choose_load_mode(con, TABLE_NAME, source, load_mode) == "bulk":
+            logging.info(f"🚚 Bulk loading into DuckDB table '{TABLE_NAME}'.")
+            con.execute("BEGIN TRANSACTION;")
+            try:
+                merge_rebuild(con, TABLE_NAME, f"SELECT * FROM {source}", KEY_COLUMNS,
+                              ["max_temp", "min_temp", "precip"], order_by=["year", "month", "day"])
+                con.execute("COMMIT;")
+            except Exception:
+                con.execute("ROLLBACK;")
+                raise
+            return
+
+        # Upsert straight from the staged source
         con.execute(f"""
             INSERT INTO {TABLE_NAME}
-            SELECT * FROM read_parquet({file_list_str})
+            SELECT * FROM {source}
             ON CONFLICT (day, month, year, lon, lat) DO UPDATE SET
                 max_temp = EXCLUDED.max_temp,
                 min_temp = EXCLUDED.min_temp,
                 precip = EXCLUDED.precip;
         """)
-        logging.info(f"📥 Successfully appended {len(parquet_files)} Parquet files to DuckDB table '{TABLE_NAME}'.")
-    except duckdb.Error as e:
-        logging.error(f"❌ DuckDB error while appending files: {e}")
-    except Exception as e:
-        logging.error(f"❌ An unexpected error occurred during DuckDB append: {e}")
     finally:
-        con.close() # Always ensure the connection is closed
-
-def duckdb_query(duckdb_fileabase, query):
-    con = duckdb.connect(f'{duckdb_fileabase}')
-    result = con.sql(query).df()
-    con.close()
-    return result
+        con.execute(f"DROP TABLE IF EXISTS {STAGED_BATCH};")
+        if raw_source == "staged_data":
+            con.unregister("staged_data")  # the connection is long-lived: release the Arrow data now
 
 
 def visualize_summary(df: pd.DataFrame):
@@ -233,20 +375,38 @@ def cleanup_parquets(parquet_files: list[Path]):
             logging.warning(f"❌ An unexpected error occurred while deleting {f.name}: {e}")
 
 # --- Main Pipeline Execution ---
-def run_pipeline():
+def run_pipeline(stage_to_disk: bool = STAGE_TO_DISK, pool: WorkerPool | None = None,
+                 json_files: list[Path] | None = None, progress=None, load_mode: str = LOAD_MODE) -> dict | None:
     """
     Orchestrates the entire data processing pipeline:
     1. Discovers new JSON files.
-    2. Converts JSON to Parquet in parallel (using ThreadPoolExecutor for I/O bound tasks
+    2. Converts JSON to Arrow tables in parallel (using ThreadPoolExecutor for I/O bound tasks
        and ProcessPoolExecutor for CPU-bound validation/conversion).
-    3. Appends generated Parquet files to the DuckDB database.
-    4. Cleans up the temporary Parquet files.
+    3. Appends the staged data to the DuckDB database.
+    4. Cleans up the temporary Parquet files when staging to disk.
+
+    Args:
+        stage_to_disk (bool): Stage converted data as temporary Parquet files.
+        pool (WorkerPool | None): A started, long-lived worker pool to reuse. A temporary
+            ProcessPoolExecutor is created for this run when omitted.
+        json_files (list[Path] | None): Files to process; defaults to every JSON file in DATA_DIR.
+        progress (Callable | None): Called with the name of each pipeline stage as it starts.
+        load_mode (str): How staged data is loaded, see ``append_parquets_to_duckdb``.
+
+    Returns:
+        dict | None: ``{"files": [...], "timings": {...}}`` with a status per file, or None
+        if there was nothing to process.
     """
 
-    PARQUET_DIR.mkdir(parents=True, exist_ok=True) 
-    json_files = list(DATA_DIR.glob("*.json")) 
+    if stage_to_disk:
+        PARQUET_DIR.mkdir(parents=True, exist_ok=True)
+    if json_files is None:
+        json_files = glob_json(DATA_DIR)
+    report_stage = progress or (lambda stage: None)
     
-    processed_parquet_files = []
+    staged = []
+    results = [None] * len(json_files)
+    timings = {}
 
     if not json_files:
         logging.info("📂 No new JSON files found to process. Exiting pipeline.")
@@ -254,30 +414,47 @@ def run_pipeline():
     
     time_start = datetime.now()
     logging.info(f"🚀 Starting to process {len(json_files)} JSON files...")
+    report_stage("converting")
 
-    with ThreadPoolExecutor(max_workers=4):
-        with ProcessPoolExecutor(max_workers=os.cpu_count()) as process_pool:
-            futures = [
-                process_pool.submit(validate_and_convert, jf)
-                for jf in json_files
-            ]
-            
-            # Wait for all futures to complete and collect results
-            for future in as_completed(futures):
-                try:
-                    # Get the result from the completed future (which is the parquet file path or None)
-                    parquet_file_path = future.result()
-                    if parquet_file_path:
-                        processed_parquet_files.append(parquet_file_path)
-                except Exception as e:
-                    # Log any exceptions that occurred during conversion of a specific file
-                    logging.error(f"❌ Error during JSON to Parquet conversion: {e}")
-
-
-    if processed_parquet_files:
-        logging.info(f"📊 {len(processed_parquet_files)} valid Parquet files generated. Proceeding to load to DuckDB.")
-        append_parquets_to_duckdb(processed_parquet_files)
+    if pool is not None:
+        try:
+            results = pool.map_files(validate_and_convert, json_files, stage_to_disk)
+            staged = [r for r in results if r is not None]
+        except Exception as e:
+            logging.error(f"❌ Error during JSON conversion: {e}")
 
+    else:
+        with ThreadPoolExecutor(max_workers=4):
+            with ProcessPoolExecutor(max_workers=os.cpu_count()) as process_pool:
+                futures = {
+                    process_pool.submit(validate_and_convert, jf, stage_to_disk): i
+                    for i, jf in enumerate(json_files)
+                }
+            
+                # Wait for all futures to complete and collect results
+                for future in as_completed(futures):
+                    try:
+                        # Get the result from the completed future (an Arrow table, a parquet file path or None)
+                        result = future.result()
+                        results[futures[future]] = result
+                        if result is not None:
+                            staged.append(result)
+                    except Exception as e:
+                        # Log any exceptions that occurred during conversion of a specific file
+                        logging.error(f"❌ Error during JSON conversion: {e}")
+
+
+    timings["convert"] = (datetime.now() - time_start).total_seconds()
+
+    if staged:
+        logging.info(f"📊 {len(staged)} files converted. Proceeding to load to DuckDB.")
+        report_stage("loading")
+        step_start = datetime.now()
+        append_parquets_to_duckdb(staged, load_mode)
+        timings["load"] = (datetime.now() - step_start).total_seconds()
+
+        report_stage("summarizing")
+        step_start = datetime.now()
         query = f"""
         SELECT year, AVG(max_temp) AS avg_max_temp, SUM(precip) AS total_precip
         FROM {TABLE_NAME}
@@ -290,10 +467,19 @@ def run_pipeline():
         print(f'\nTổng thời gian: {(time_end - time_start).seconds + ((time_end - time_start).microseconds) / 1000000}s\n')
         
         visualize_summary(result_df)
-        cleanup_parquets(processed_parquet_files)
+        timings["summary"] = (datetime.now() - step_start).total_seconds()
+        if stage_to_disk:
+            cleanup_parquets(staged)
         logging.info("✅ Data pipeline completed successfully.")
     else:
-        logging.info("⚠️ No valid Parquet files were generated. Nothing to append to DuckDB.")
+        logging.info("⚠️ No valid data was converted. Nothing to append to DuckDB.")
+
+    timings["total"] = (datetime.now() - time_start).total_seconds()
+    return {
+        "files": [{"filename": f.name, "status": "loaded" if r is not None else "rejected"}
+                  for f, r in zip(json_files, results)],
+        "timings": timings,
+    }
     
 
 # if __name__ == "__main__":
@@ -1,18 +1,30 @@
 import os
-import json
 import shutil
 import logging
 from datetime import datetime
-from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 from io import BytesIO
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import duckdb
 import psutil
 import seaborn as sns
 import matplotlib
 import matplotlib.pyplot as plt
 import matplotlib.ticker as ticker
+from json_stream import (ARROW_SCHEMA, BATCH_ROWS, COLUMNS, VALUE_COLUMNS, calendar_dates, glob_json,
+                         iter_arrow_batches, json_stem)
+from columnar import columnar_format, read_columnar
+from worker_pool import WorkerPool
+from db import duckdb_query, get_manager
+from key_encoding import (KEY_ENCODING, bulk_load_weather, colliding_files, create_weather_table, storage_table,
+                          upsert_weather)
+from bulk_load import LOAD_MODE, LOAD_MODES, choose_load_mode
+from dedup import STAGED_BATCH, parquet_sequence_sql, stage_latest, tag_sequence
+from rollups import (KEY_COLUMNS, YEARLY_SUMMARY_SQL, bulk_load_with_rollups, create_rollup_tables,
+                     read_version, upsert_with_rollups, query as rollup_query)
 
 matplotlib.use("Agg")
 
@@ -25,6 +37,10 @@ PARQUET_DIR = BASE_DIR / "parquet_data"
 CHART_DIR = BASE_DIR / "charts"
 DB_PATH = BASE_DIR / "database" / "weather_data.duckdb"
 TABLE_NAME = "weather_data_table"
+STAGE_TO_DISK = False   # True: ghi Parquet tạm vào PARQUET_DIR thay vì trả bảng Arrow trong bộ nhớ
+INGEST_MODE = "python"  # "python": worker GE + Arrow, "duckdb": read_json + UNNEST trong DuckDB
+# KEY_ENCODING (key_encoding.py, biến môi trường KEY_ENCODING): "natural" hoặc "compact" (DATE + cell_id)
+# LOAD_MODE (bulk_load.py, biến môi trường LOAD_MODE): "upsert", "bulk" (backfill) hoặc "auto" theo kích thước batch
 
 # ----- LOGGING -----
 timestamp = datetime.now().strftime("%Y_%m_%d_%H:%M:%S")
@@ -40,31 +56,12 @@ def print_ram_usage(message):
     now = datetime.now().strftime("%H:%M:%S")
     print(f"[{now}] [{message}] RAM sử dụng: {mem:.2f} MB")
 
-# ----- VALIDATE + CONVERT -----
-def validate_and_convert(file_path: Path) -> Path | None:
-    import great_expectations as gx  # tránh bị pickle
-    import pandas as pd
-    import shutil
-    import gc
-
-    try:
-        with open(file_path, "r", encoding="utf-8") as f:
-            raw = json.load(f)
-    except json.JSONDecodeError:
-        shutil.move(file_path, ERROR_DIR)
-        return None
+# ----- GREAT EXPECTATIONS (khởi tạo 1 lần cho mỗi worker) -----
+_gx_state = None
 
-    values = []
-    for loc in raw["data"]:
-        lon_lat = loc.get("location")
-        for row in loc.get("value", []):
-            values.append([*lon_lat, *row])
-
-    columns = ["longitude", "latitude", "day", "month", "year",
-               "day_of_year", "t2m_max", "t2m_min", "precipitation"]
-    df = pd.DataFrame(values, columns=columns)
+def _build_gx_state():
+    import great_expectations as gx  # tránh bị pickle
 
-    # Khởi tạo GE context & suite trong subprocess
     context = gx.get_context()
     datasource = context.data_sources.add_pandas("pandas_source")
     asset = datasource.add_dataframe_asset("asset")
@@ -72,75 +69,310 @@ def validate_and_convert(file_path: Path) -> Path | None:
 
     suite = gx.ExpectationSuite(name="data_suite")
     suite.add_expectation(gx.expectations.ExpectTableColumnCountToEqual(value=9))
-    suite.add_expectation(gx.expectations.ExpectTableColumnsToMatchSet(column_set=columns))
+    suite.add_expectation(gx.expectations.ExpectTableColumnsToMatchSet(column_set=COLUMNS))
     suite.add_expectation(gx.expectations.ExpectColumnValuesToBeBetween(column="longitude", min_value=-180, max_value=180))
     suite.add_expectation(gx.expectations.ExpectColumnValuesToBeBetween(column="latitude", min_value=-90, max_value=90))
     suite.add_expectation(gx.expectations.ExpectColumnValuesToBeBetween(column="day", min_value=1, max_value=31))
     suite.add_expectation(gx.expectations.ExpectColumnValuesToBeBetween(column="month", min_value=1, max_value=12))
     suite.add_expectation(gx.expectations.ExpectColumnValuesToBeBetween(column="year", min_value=1900, max_value=2100))
     suite.add_expectation(gx.expectations.ExpectColumnValuesToBeBetween(column="day_of_year", min_value=1, max_value=366))
-    suite.add_expectation(gx.expectations.ExpectColumnValuesToBeOfType(column="day_of_year", type_="int"))
+    suite.add_expectation(gx.expectations.ExpectColumnValuesToBeOfType(column="day_of_year", type_="int32"))
     suite.add_expectation(gx.expectations.ExpectColumnValuesToBeOfType(column="t2m_max", type_="float"))
     suite.add_expectation(gx.expectations.ExpectColumnValuesToBeOfType(column="t2m_min", type_="float"))
     suite.add_expectation(gx.expectations.ExpectColumnValuesToBeOfType(column="precipitation", type_="float"))
-
+    # Giá trị thiếu/không nguyên ở cột khoá được builder chuyển thành null
+    for column in ["longitude", "latitude", "day", "month", "year"]:
+        suite.add_expectation(gx.expectations.ExpectColumnValuesToNotBeNull(column=column))
+    return batch_def, suite
+
+def init_worker():
+    """Initializer của ProcessPoolExecutor: dựng GE context & suite một lần cho mỗi process."""
+    global _gx_state
+    _gx_state = _build_gx_state()
+
+def validate_batch(df: pd.DataFrame) -> bool:
+    """Kiểm tra một batch bằng context & suite đã khởi tạo sẵn (tự khởi tạo nếu chưa có)."""
+    global _gx_state
+    if _gx_state is None:
+        _gx_state = _build_gx_state()
+    batch_def, suite = _gx_state
 
     batch = batch_def.get_batch(batch_parameters={"dataframe": df})
     result = batch.validate(suite)
+    # Ràng buộc giữa nhiều cột (GE không có expectation sẵn): ngày/tháng/năm phải là ngày có thật, vd không có 30/2
+    return result["success"] and bool(calendar_dates(df["day"], df["month"], df["year"]).all())
 
-    if not result["success"]:
+# ----- VALIDATE + CONVERT -----
+def decoded_path(file_path: Path) -> Path:
+    """Parquet (ARROW_SCHEMA) của một upload đã được API giải mã lúc nhận, chờ pipeline kiểm tra + nạp."""
+    return PARQUET_DIR / f"{json_stem(file_path)}.decoded.parquet"
+
+def validate_and_convert(file_path: Path, stage_to_disk: bool = STAGE_TO_DISK,
+                         decoded: dict[Path, Path] | None = None) -> Path | pa.Table | None:
+    """
+    Kiểm tra file JSON theo từng batch và trả về dữ liệu đã chuẩn hoá:
+    mặc định là bảng Arrow giữ trong bộ nhớ, hoặc đường dẫn Parquet nếu ``stage_to_disk``.
+    Nếu ``decoded`` có file này (upload đã giải mã sẵn thành Parquet) thì đọc Parquet đó, không giải mã lại;
+    file dạng cột (Parquet, Arrow IPC, NDJSON) được đọc bằng ``read_columnar``.
+    """
+    # Đọc JSON theo từng location, kiểm tra theo từng batch để RAM không phụ thuộc kích thước file
+    out_path = PARQUET_DIR / f"{json_stem(file_path)}.parquet"
+    decoded_file = (decoded or {}).get(file_path)
+    writer = None
+    tables = []
+    try:
+        if decoded_file is not None:
+            batches = pq.ParquetFile(decoded_file).iter_batches(batch_size=BATCH_ROWS)
+        elif (fmt := columnar_format(file_path.name)) is not None:
+            batches = read_columnar(file_path, fmt).to_batches(max_chunksize=BATCH_ROWS)
+        else:
+            batches = iter_arrow_batches(file_path)
+        for record_batch in batches:
+            if not validate_batch(record_batch.to_pandas()):
+                raise ValueError(f"Dữ liệu của {file_path.name} không đạt yêu cầu.")
+
+            if not stage_to_disk:
+                tables.append(record_batch)
+                continue
+            if writer is None:
+                writer = pq.ParquetWriter(out_path, ARROW_SCHEMA)
+            writer.write_batch(record_batch)
+    except (ValueError, OSError) as e:  # OSError: file nén bị hỏng
+        logging.error(f"❌ {file_path.name}: {e}")
+        if writer is not None:
+            writer.close()
+            out_path.unlink(missing_ok=True)
         shutil.move(file_path, ERROR_DIR)
         return None
 
-    out_path = PARQUET_DIR / file_path.with_suffix(".parquet").name
-    df.to_parquet(out_path, index=False)
-
-    # Giải phóng bộ nhớ
-    del df, values, raw
-    gc.collect()
+    if tables:
+        return pa.Table.from_batches(tables, schema=ARROW_SCHEMA)
+    if writer is None:
+        return None
+    writer.close()
     return out_path
 
 
 # ----- UPSERT VÀO DUCKDB -----
-def load_to_duckdb(parquet_files: list[Path]):
-    if not parquet_files:
-        logging.warning("⚠️ Không có file Parquet hợp lệ.")
-        return
-
-    con = duckdb.connect(DB_PATH)
+def create_table(con):
+    create_weather_table(con, KEY_ENCODING)
+    create_rollup_tables(con)
+
+def upsert(con, source: str):
+    upsert_weather(con, source, KEY_ENCODING)
+
+def bulk_load(con, source: str):
+    bulk_load_weather(con, source, KEY_ENCODING)
+
+def load_source(con, source: str, load_mode: str = LOAD_MODE):
+    """
+    Nạp ``source`` (có cột thứ tự ``_file_seq``/``_row_seq``) bằng UPSERT từng dòng hoặc bulk load
+    (dựng lại bảng + index 1 lần), kèm rollup + phiên bản. Khoá lặp trong batch: dòng sau cùng thắng.
+    """
+    duplicates = stage_latest(con, source, KEY_COLUMNS)
+    if duplicates:
+        logging.warning(f"⚠️ Bỏ {duplicates} dòng trùng khoá trong batch (giữ dòng của file/vị trí sau cùng).")
+    source = STAGED_BATCH
+    if choose_load_mode(con, storage_table(KEY_ENCODING), source, load_mode) == "bulk":
+        logging.info(f"🚚 Bulk load '{source}' vào '{TABLE_NAME}'.")
+        bulk_load_with_rollups(con, source, bulk_load)
+    else:
+        upsert_with_rollups(con, source, upsert)
+
+def _colliding_seqs(con, source: str) -> tuple[set[int], str]:
+    """File (``_file_seq``) của ``source`` không lưu được theo KEY_ENCODING, và ``source`` đã bỏ các file đó."""
+    rejected = colliding_files(con, source, KEY_ENCODING)
+    if rejected:
+        source = f"(SELECT * FROM {source} WHERE _file_seq NOT IN ({', '.join(map(str, sorted(rejected)))}))"
+    return rejected, source
+
+def data_version() -> int:
+    """
+    Phiên bản dữ liệu hiện tại, đọc từ bảng data_version mỗi lần gọi (1 dòng).
+    Chỉ các lần nạp qua ``load_source`` (pipeline src2, API) tăng phiên bản; src1 ghi schema riêng,
+    không có rollup và không cập nhật bảng này. Đọc lại mỗi lần để thấy lần nạp từ kết nối khác trong
+    cùng process; process khác không ghi được file DuckDB khi process này đang mở nó.
+    """
+    return read_version(get_manager(DB_PATH).cursor())
+
+def _staged_source(con, staged: list[Path] | list[pa.Table], file_seqs: list[int]) -> str:
+    """
+    Nguồn SQL (có ``_file_seq``/``_row_seq``) của dữ liệu đã chuẩn hoá: file Parquet, hoặc bảng Arrow
+    đăng ký làm view ``staged_data`` (người gọi ``unregister`` sau khi nạp).
+    """
+    if isinstance(staged[0], pa.Table):
+        # Arrow → DuckDB không qua đĩa: DuckDB quét trực tiếp bộ nhớ của bảng Arrow
+        con.register("staged_data", tag_sequence(staged, file_seqs))
+        return "staged_data"
+    return parquet_sequence_sql([str(f) for f in staged], file_seqs)
+
+def load_to_duckdb(staged: list[Path] | list[pa.Table], load_mode: str = LOAD_MODE) -> list[int]:
+    """
+    Nạp dữ liệu đã chuẩn hoá: danh sách file Parquet hoặc bảng Arrow (đăng ký làm view).
+    Trả về vị trí trong ``staged`` của các file bị bỏ qua vì trùng ô lưới (``colliding_files``, KEY_ENCODING compact).
+    """
+    if not staged:
+        logging.warning("⚠️ Không có dữ liệu hợp lệ để nạp.")
+        return []
+
+    with get_manager(DB_PATH).writer() as con:
+        create_table(con)
+        try:
+            source = _staged_source(con, staged, list(range(len(staged))))
+            rejected, valid_source = _colliding_seqs(con, source)
+            load_source(con, valid_source, load_mode)
+        finally:
+            con.execute(f"DROP TABLE IF EXISTS {STAGED_BATCH};")
+            con.unregister("staged_data")  # kết nối sống lâu: nhả bảng Arrow ngay
+    print(f"✅ Đã UPSERT dữ liệu mới vào bảng '{TABLE_NAME}'.")
+    return sorted(rejected)
+
+# ----- NẠP JSON TRỰC TIẾP BẰNG DUCKDB -----
+# Làm phẳng data[].value[][] + data[].location ngay trong engine vector hoá của DuckDB (read_json + UNNEST).
+# Lưu ý: read_json đọc cả object gốc của mỗi file vào bộ nhớ, giới hạn bởi MAX_JSON_OBJECT_SIZE.
+MAX_JSON_OBJECT_SIZE = 1 << 31
+JSON_COLUMNS = "{'data': 'STRUCT(header VARCHAR[], value DOUBLE[][], location DOUBLE[])[]'}"
+
+# Cột của value[] được ánh xạ theo header (không có header = thứ tự mặc định VALUE_COLUMNS)
+HEADER_NAMES_SQL = ", ".join(f"'{c}'" for c in VALUE_COLUMNS)
+VALUE_COLUMNS_SQL = ",\n".join(
+    f"v[CASE WHEN header IS NULL THEN {i} ELSE list_position(header, '{c}') END] AS {c}"
+    for i, c in enumerate(VALUE_COLUMNS, start=1))
+
+# Cùng các ràng buộc với bộ expectation của GE; NULL được coi là không hợp lệ
+VALID_ROW_SQL = """
+    coalesce(
+        header_ok AND width = coalesce(len(header), 7)
+        AND longitude BETWEEN -180 AND 180 AND latitude BETWEEN -90 AND 90
+        AND day BETWEEN 1 AND 31 AND day = trunc(day)
+        AND month BETWEEN 1 AND 12 AND month = trunc(month)
+        AND year BETWEEN 1900 AND 2100 AND year = trunc(year)
+        AND try(make_date(year::BIGINT, month::BIGINT, day::BIGINT)) IS NOT NULL
+        AND day_of_year BETWEEN 1 AND 366 AND day_of_year = trunc(day_of_year),
+    false)
+"""
+
+def _stage_json_sql(con, json_files: list[Path], order: list[Path]):
+    """Đọc + làm phẳng ``json_files`` vào bảng tạm staged_json; ``_file_seq`` là vị trí (từ 1) của file trong ``order``."""
+    file_strs = [str(f) for f in json_files]
     con.execute(f"""
-        CREATE TABLE IF NOT EXISTS {TABLE_NAME} (
-            longitude DOUBLE,
-            latitude DOUBLE,
-            day INTEGER,
-            month INTEGER,
-            year INTEGER,
-            day_of_year INTEGER,
-            t2m_max DOUBLE,
-            t2m_min DOUBLE,
-            precipitation DOUBLE,
-            PRIMARY KEY (day, month, year, longitude, latitude)
-        );
+        CREATE OR REPLACE TEMP TABLE staged_json AS
+        WITH locs AS (
+            SELECT filename, unnest(data) AS loc, generate_subscripts(data, 1) AS loc_idx
+            FROM read_json({file_strs}, columns = {JSON_COLUMNS}, filename = true,
+                           maximum_object_size = {MAX_JSON_OBJECT_SIZE})
+        ), rows_ AS (
+            SELECT filename, loc.location[1] AS longitude, loc.location[2] AS latitude,
+                   nullif(loc.header, []) AS header, unnest(loc.value) AS v,
+                   loc_idx, generate_subscripts(loc.value, 1) AS row_idx
+            FROM locs
+            -- Bỏ qua location không hợp lệ giống bộ chuyển đổi Python
+            WHERE len(loc.location) = 2 AND loc.location[1] IS NOT NULL AND loc.location[2] IS NOT NULL
+        )
+        SELECT filename, longitude, latitude,
+               {VALUE_COLUMNS_SQL},
+               len(v) AS width, header,
+               -- header chỉ được chứa tên cột đã biết, không trùng lặp
+               header IS NULL OR (len(list_filter(header, h -> h NOT IN ({HEADER_NAMES_SQL}))) = 0
+                                  AND len(list_distinct(header)) = len(header)) AS header_ok,
+               -- Thứ tự trong batch (file, rồi vị trí trong file) để khử trùng khoá
+               list_position({[str(f) for f in order]}, filename)::BIGINT AS _file_seq,
+               (loc_idx::BIGINT << 32) + row_idx AS _row_seq
+        FROM rows_;
     """)
 
-    file_strs = [str(f) for f in parquet_files]
-    con.execute(f"""
-        INSERT INTO {TABLE_NAME}
-        SELECT * FROM read_parquet({file_strs})
-        ON CONFLICT (day, month, year, longitude, latitude) DO UPDATE SET
-            t2m_max = EXCLUDED.t2m_max,
-            t2m_min = EXCLUDED.t2m_min,
-            precipitation = EXCLUDED.precipitation;
-    """)
-    con.close()
-    print(f"✅ Đã UPSERT dữ liệu mới vào bảng '{TABLE_NAME}'.")
+def ingest_json_with_duckdb(json_files: list[Path], load_mode: str = LOAD_MODE,
+                            staged: dict[Path, Path | pa.Table] | None = None,
+                            order: list[Path] | None = None) -> list[Path]:
+    """
+    Đọc, làm phẳng, kiểm tra và UPSERT các file JSON hoàn toàn bằng SQL.
+    File có dòng không hợp lệ (hoặc không đọc được) bị bỏ qua cả file và chuyển vào ERROR_DIR.
+
+    Args:
+        staged: Dữ liệu đã chuẩn hoá (``validate_and_convert``) của các file khác trong cùng batch
+            (vd file dạng cột), được nạp chung một giao dịch với các file JSON.
+        order: Thứ tự mọi file của batch (mặc định: ``json_files`` rồi ``staged``); khoá trùng giữa
+            các file thì dòng của file đứng sau thắng.
+
+    Returns:
+        list[Path]: Các file đã được nạp (JSON và ``staged``), theo ``order``.
+    """
+    staged = staged or {}
+    order = order or [*json_files, *staged]
+    with get_manager(DB_PATH).writer() as con:
+        create_table(con)
+        try:
+            invalid, unreadable, colliding = _ingest_json_sql(con, json_files, load_mode, staged, order)
+        finally:
+            # Kết nối sống lâu: dọn bảng/view tạm ngay
+            con.execute(f"DROP VIEW IF EXISTS staged_json_valid; DROP TABLE IF EXISTS invalid_json; "
+                        f"DROP TABLE IF EXISTS staged_json; DROP TABLE IF EXISTS {STAGED_BATCH};")
+            con.unregister("staged_data")
+
+    rejected = unreadable + [f for f in json_files if str(f) in invalid]
+    for f in rejected:
+        logging.error(f"❌ Dữ liệu của {f.name} không đạt yêu cầu.")
+    for f in colliding:
+        logging.error(f"❌ {f.name}: toạ độ trùng ô lưới với một toạ độ khác, không lưu được.")
+    for f in rejected + colliding:
+        shutil.move(f, ERROR_DIR)
+    loaded = [f for f in order if (f in staged or f in json_files) and f not in rejected + colliding]
+    print(f"✅ Đã UPSERT {len(loaded)} file bằng DuckDB read_json vào bảng '{TABLE_NAME}'.")
+    return loaded
+
+def _ingest_json_sql(con, json_files: list[Path], load_mode: str, staged: dict[Path, Path | pa.Table],
+                     order: list[Path]) -> tuple[set[str], list[Path], list[Path]]:
+    """Trả về (tên file JSON có dòng không hợp lệ, file JSON không đọc được, file trùng ô lưới)."""
+    readable, unreadable = json_files, []
+    try:
+        _stage_json_sql(con, json_files, order)
+    except duckdb.Error:
+        # Một file lỗi làm hỏng cả lệnh: thử từng file để tách file lỗi ra
+        readable = []
+        for f in json_files:
+            try:
+                _stage_json_sql(con, [f], order)
+                readable.append(f)
+            except duckdb.Error as e:
+                logging.error(f"❌ {f.name}: {e}")
+                unreadable.append(f)
+        if readable:
+            _stage_json_sql(con, readable, order)
+
+    sources, invalid = [], set()
+    if readable:
+        con.execute(f"""
+            CREATE OR REPLACE TEMP TABLE invalid_json AS
+            SELECT filename FROM staged_json GROUP BY filename HAVING NOT bool_and({VALID_ROW_SQL});
+        """)
+        invalid = {row[0] for row in con.execute("SELECT filename FROM invalid_json").fetchall()}
+        con.execute("""
+            CREATE OR REPLACE TEMP VIEW staged_json_valid AS
+            SELECT longitude, latitude,
+                   day::INTEGER AS day, month::INTEGER AS month, year::INTEGER AS year,
+                   day_of_year::INTEGER AS day_of_year,
+                   t2m_max, t2m_min, precipitation, _file_seq, _row_seq
+            FROM staged_json
+            WHERE filename NOT IN (SELECT filename FROM invalid_json);
+        """)
+        sources.append("staged_json_valid")
+    if staged:
+        sources.append(_staged_source(con, list(staged.values()), [order.index(f) + 1 for f in staged]))
+    if not sources:
+        return invalid, unreadable, []
+
+    # Cùng cột, cùng thứ tự ARROW_SCHEMA + SEQ_COLUMNS: 1 lần khử trùng khoá + 1 giao dịch cho cả batch
+    source = "(" + " UNION ALL ".join(f"SELECT * FROM {name}" for name in sources) + ")"
+    colliding, valid_source = _colliding_seqs(con, source)
+    load_source(con, valid_source, load_mode)
+    return invalid, unreadable, [order[seq - 1] for seq in sorted(colliding)]
 
 # ----- KẾT NỐI DUCKDB -----
-def duckdb_query(duckdb_fileabase, query):
-    con = duckdb.connect(f'{duckdb_fileabase}')
-    result = con.sql(query).df()
-    con.close()
-    return result
+# duckdb_query (db.py): truy vấn đọc trên kết nối dùng chung của process, không mở/đóng mỗi lần
+def aggregate_query(metrics: list[str], group_by: list[str] = (), filters: dict | None = None,
+                    duckdb_fileabase=None) -> pd.DataFrame:
+    """Truy vấn tổng hợp qua router: tự chọn rollup nhỏ nhất trả lời được, không có thì quét bảng gốc."""
+    return rollup_query(get_manager(duckdb_fileabase or DB_PATH).cursor(), metrics, group_by, filters)
 
 # ----- VẼ BIỂU ĐỒ -----
 def visualize_summary(df: pd.DataFrame):
@@ -177,39 +409,87 @@ def visualize_summary(df: pd.DataFrame):
     return buf
 
 # ----- MAIN PIPELINE -----
-def run_pipeline():
-    os.makedirs(PARQUET_DIR, exist_ok=True)
-    json_files = list(DATA_DIR.glob("*.json"))
+def _seconds(start: datetime) -> float:
+    delta = datetime.now() - start
+    return delta.seconds + delta.microseconds / 1000000
+
+def run_pipeline(stage_to_disk: bool = STAGE_TO_DISK, mode: str = INGEST_MODE, pool: WorkerPool | None = None,
+                 json_files: list[Path] | None = None, decoded: dict[Path, Path] | None = None,
+                 progress=None, load_mode: str = LOAD_MODE) -> dict | None:
+    """
+    Chạy pipeline và trả về báo cáo ``{"files": [...], "timings": {...}}`` (None nếu không có file).
+
+    Args:
+        pool: WorkerPool đã khởi động sẵn (vd của FastAPI app), nếu không sẽ tạo pool tạm.
+        json_files: Danh sách file cần xử lý; mặc định là mọi file JSON trong DATA_DIR.
+        decoded: File → Parquet đã giải mã sẵn (``decoded_path``, vd từ API upload); ở mode "python"
+            worker kiểm tra + nạp Parquet đó thay vì giải mã lại file gốc.
+        progress: Hàm ``progress(stage)`` được gọi khi chuyển sang từng bước của pipeline.
+        load_mode: "upsert", "bulk" (backfill lớn) hoặc "auto" (bulk khi batch đủ lớn so với bảng).
+    """
+    if mode not in ("python", "duckdb"):
+        raise ValueError(f"mode không hợp lệ: {mode}")
+    if load_mode not in LOAD_MODES:
+        raise ValueError(f"load_mode không hợp lệ: {load_mode}")
+    if stage_to_disk:
+        os.makedirs(PARQUET_DIR, exist_ok=True)
+    if json_files is None:
+        json_files = glob_json(DATA_DIR)
+    report_stage = progress or (lambda stage: None)
 
     if not json_files:
         print("📂 Không có file JSON mới.")
         return
     
     time_start = datetime.now()
+    timings = {}
     print(f"🚀 Bắt đầu xử lý {len(json_files)} file JSON...")
     print_ram_usage("🚦 Trước khi bắt đầu")
 
 
-    processed_parquets = []
-    with ProcessPoolExecutor(max_workers=os.cpu_count()) as pool:
-        futures = [pool.submit(validate_and_convert, f) for f in json_files]
-        for future in as_completed(futures):
-            result = future.result()
-            if result:
-                processed_parquets.append(result)
-
-    print_ram_usage("🏁 Sau khi hoàn tất chuyển đổi")
-    load_to_duckdb(processed_parquets)
-
+    staged = []
+    statuses = {}
+    report_stage("converting")
+    step_start = datetime.now()
+    # read_json chỉ dành cho JSON: file dạng cột (vd từ /ingest) luôn được chuyển đổi trên worker, ở mọi mode
+    duckdb_files = [f for f in json_files if columnar_format(f.name) is None] if mode == "duckdb" else []
+    arrow_files = [f for f in json_files if f not in duckdb_files]
+    if arrow_files:
+        # Kiểm tra GE luôn chạy trên worker, kể cả upload đã giải mã sẵn (worker đọc Parquet đã giải mã)
+        if pool is not None:
+            results = pool.map_files(validate_and_convert, arrow_files, stage_to_disk, decoded)
+        else:
+            n_files = len(arrow_files)
+            with ProcessPoolExecutor(max_workers=os.cpu_count(), initializer=init_worker) as executor:
+                results = list(executor.map(validate_and_convert, arrow_files, [stage_to_disk] * n_files, [decoded] * n_files))
+        staged = [r for r in results if r is not None]
+        statuses.update({f: "loaded" if r is not None else ("empty" if f.exists() else "rejected")
+                         for f, r in zip(arrow_files, results)})
+        timings["convert"] = _seconds(step_start)
+        print_ram_usage("🏁 Sau khi hoàn tất chuyển đổi")
+
+    report_stage("loading")
+    step_start = datetime.now()
+    if duckdb_files:
+        # JSON qua read_json + dữ liệu đã chuyển đổi của file dạng cột: 1 giao dịch, khoá trùng theo thứ tự upload
+        staged_by_file = {f: r for f, r in zip(arrow_files, results) if r is not None} if arrow_files else {}
+        loaded = set(ingest_json_with_duckdb(duckdb_files, load_mode, staged_by_file, order=json_files))
+        statuses.update({f: "loaded" if f in loaded else "rejected" for f in [*duckdb_files, *staged_by_file]})
+        timings["ingest"] = _seconds(step_start)
+        print_ram_usage("🏁 Sau khi nạp bằng DuckDB")
+    elif arrow_files:
+        staged_files = [f for f, r in zip(arrow_files, results) if r is not None]
+        for i in load_to_duckdb(staged, load_mode):
+            logging.error(f"❌ {staged_files[i].name}: toạ độ trùng ô lưới với một toạ độ khác, không lưu được.")
+            shutil.move(staged_files[i], ERROR_DIR)
+            statuses[staged_files[i]] = "rejected"
+        timings["load"] = _seconds(step_start)
+
+    report_stage("summarizing")
+    step_start = datetime.now()
     try:
-        # Truy vấn tổng hợp 
-        query = f"""
-        SELECT year, AVG(t2m_max) AS avg_max_temp, SUM(precipitation) AS total_precip
-        FROM {TABLE_NAME}
-        GROUP BY year
-        ORDER BY year;
-        """
-        result = duckdb_query(DB_PATH, query)
+        # Truy vấn tổng hợp: đọc rollup theo năm (được cập nhật cùng lúc với UPSERT)
+        result = duckdb_query(DB_PATH, YEARLY_SUMMARY_SQL)
         time_end = datetime.now()
         print("Kết quả tổng hợp:")
         print(result)
@@ -219,14 +499,22 @@ def run_pipeline():
         visualize_summary(result)
     except Exception as e:
         print(e)
+    timings["summary"] = _seconds(step_start)
 
     # Cleanup
     for f in json_files:
-        shutil.move(f, RAW_DIR)
-    for f in processed_parquets:
-        os.remove(f)
+        if f.exists():  # file lỗi đã được chuyển vào ERROR_DIR
+            shutil.move(f, RAW_DIR)
+    if stage_to_disk:
+        for f in staged:
+            os.remove(f)
+    timings["total"] = _seconds(time_start)
 
     print("✅ Kết thúc pipeline.")
+    return {
+        "files": [{"filename": f.name, "status": statuses[f]} for f in json_files],
+        "timings": timings,
+    }
 
 # if __name__ == "__main__":
 #     start = datetime.now()
@@ -0,0 +1,7 @@
+import os
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+os.makedirs(ROOT / "logs", exist_ok=True)   # src1/src2 ghi log vào logs/ ngay khi import
@@ -0,0 +1,44 @@
+import duckdb
+import pytest
+
+from key_encoding import bulk_load_weather, create_weather_table, storage_table, upsert_weather
+
+SCHEMA = ("longitude DOUBLE, latitude DOUBLE, day INTEGER, month INTEGER, year INTEGER, day_of_year INTEGER, "
+          "t2m_max DOUBLE, t2m_min DOUBLE, precipitation DOUBLE")
+
+# (longitude, latitude, day, month, year, day_of_year, t2m_max, t2m_min, precipitation)
+OLD_ROWS = [
+    (105.85, 21.03, 1, 1, 2000, 1, 30.5, 20.1, 0.0),
+    (105.85, 21.03, 2, 1, 2000, 2, 31.0, 21.0, 1.5),
+    (106.66, 10.76, 1, 1, 2000, 1, 33.0, 24.0, 0.0),
+]
+# 2 dòng đầu trùng khoá đã có (day_of_year khác để thấy cột nào bị ghi đè), dòng cuối là khoá mới
+NEW_ROWS = [
+    (105.85, 21.03, 1, 1, 2000, 99, 28.0, 19.0, 4.0),
+    (106.66, 10.76, 1, 1, 2000, 99, 34.0, 25.0, 2.0),
+    (106.66, 10.76, 2, 1, 2000, 2, 32.0, 23.0, 0.0),
+]
+
+
+def load(con, encoding, bulk):
+    create_weather_table(con, encoding)
+    con.execute(f"CREATE TEMP TABLE old_rows ({SCHEMA})")
+    con.executemany("INSERT INTO old_rows VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", OLD_ROWS)
+    con.execute("CREATE TEMP TABLE new_rows AS SELECT * FROM old_rows LIMIT 0")
+    con.executemany("INSERT INTO new_rows VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", NEW_ROWS)
+    upsert_weather(con, "old_rows", encoding)
+    if bulk:
+        con.execute("BEGIN")
+        bulk_load_weather(con, "new_rows", encoding)
+        con.execute("COMMIT")
+    else:
+        upsert_weather(con, "new_rows", encoding)
+    return con.execute(f"SELECT * FROM {storage_table(encoding)} ORDER BY ALL").fetchall()
+
+
+@pytest.mark.parametrize("encoding", ["natural", "compact"])
+def test_bulk_load_matches_upsert_on_overlapping_keys(encoding):
+    upserted = load(duckdb.connect(), encoding, bulk=False)
+    bulk = load(duckdb.connect(), encoding, bulk=True)
+    assert len(bulk) == 4
+    assert bulk == upserted
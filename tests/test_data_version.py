@@ -0,0 +1,49 @@
+import importlib
+
+import duckdb
+import pyarrow as pa
+import pytest
+from fastapi.testclient import TestClient
+
+import src2
+from db import close_all
+
+
+@pytest.fixture
+def db_path(tmp_path, monkeypatch):
+    (tmp_path / "charts").mkdir()
+    monkeypatch.setattr(src2, "DB_PATH", tmp_path / "weather.duckdb")
+    monkeypatch.setattr(src2, "CHART_DIR", tmp_path / "charts")
+    monkeypatch.chdir(tmp_path)   # main tạo new_data/, parquet_data/ khi import
+    rows = {"longitude": [105.85], "latitude": [21.03], "day": [1], "month": [1], "year": [2000],
+            "day_of_year": [1], "t2m_max": [30.5], "t2m_min": [20.1], "precipitation": [0.0]}
+    src2.load_to_duckdb([pa.Table.from_pydict(rows, schema=src2.ARROW_SCHEMA)])
+    yield src2.DB_PATH
+    close_all()
+
+
+def bump_from_other_connection(path):
+    con = duckdb.connect(str(path))   # kết nối riêng, không qua ConnectionManager
+    con.execute("UPDATE data_version SET version = version + 1")
+    con.close()
+
+
+def test_data_version_sees_other_connections(db_path):
+    assert src2.data_version() == 1
+    bump_from_other_connection(db_path)
+    assert src2.data_version() == 2
+
+
+def test_chart_etag_follows_other_connections(db_path, monkeypatch):
+    main = importlib.import_module("main")
+    monkeypatch.setattr(main, "DB_PATH", db_path)
+    client = TestClient(main.app)
+
+    first = client.get("/chart")
+    assert first.status_code == 200 and first.headers["etag"] == '"chart-1"'
+    assert client.get("/chart", headers={"If-None-Match": '"chart-1"'}).status_code == 304
+
+    bump_from_other_connection(db_path)
+    second = client.get("/chart", headers={"If-None-Match": '"chart-1"'})
+    assert second.status_code == 200 and second.headers["etag"] == '"chart-2"'
+    assert second.headers["content-type"] == "image/png"
@@ -0,0 +1,27 @@
+import importlib
+
+import pytest
+from fastapi.testclient import TestClient
+
+from db import close_all
+
+
+@pytest.fixture
+def main(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)   # main tạo new_data/, parquet_data/ khi import
+    main = importlib.import_module("main")
+    monkeypatch.setattr(main, "DB_PATH", tmp_path / "weather.duckdb")
+    yield main
+    close_all()
+
+
+@pytest.mark.parametrize("url, params", [
+    ("/query/summary", {"format": "json"}),
+    ("/query/summary", {"format": "arrow"}),
+    ("/export", {"format": "parquet"}),
+    ("/export", {"format": "arrow"}),
+])
+def test_empty_database(main, url, params):
+    response = TestClient(main.app).get(url, params=params)
+    assert response.status_code == 503
+    assert "Chưa có dữ liệu" in response.json()["detail"]
@@ -0,0 +1,94 @@
+import json
+import shutil
+from pathlib import Path
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+
+import src2
+from db import close_all, get_manager
+
+ROW = [1, 1, 2000, 1, 30.5, 20.1, 0.0]
+
+FILES = {
+    "valid": ([ROW], [105.85, 21.03], None),
+    "null_measure": ([[1, 1, 2000, 1, None, 20.1, 0.0]], [105.85, 21.03], None),
+    "non_numeric_measure": ([[1, 1, 2000, 1, "abc", 20.1, 0.0]], [105.85, 21.03], None),
+    "short_row": ([ROW, ROW[:6]], [105.85, 21.03], None),
+    "long_row": ([ROW, ROW + [9]], [105.85, 21.03], None),
+    "header_width": ([ROW], [105.85, 21.03], ["day", "month", "year"]),
+    "non_numeric_location": ([ROW], ["abc", 21.03], None),
+    "feb_30": ([[30, 2, 2000, 61, 30.5, 20.1, 0.0]], [105.85, 21.03], None),
+}
+ACCEPTED = {"valid", "null_measure"}
+
+
+@pytest.fixture
+def pipeline_dirs(tmp_path, monkeypatch):
+    for name in ("error", "parquet", "data", "raw", "charts"):
+        (tmp_path / name).mkdir()
+    monkeypatch.setattr(src2, "ERROR_DIR", tmp_path / "error")
+    monkeypatch.setattr(src2, "PARQUET_DIR", tmp_path / "parquet")
+    monkeypatch.setattr(src2, "RAW_DIR", tmp_path / "raw")
+    monkeypatch.setattr(src2, "CHART_DIR", tmp_path / "charts")
+    monkeypatch.setattr(src2, "DB_PATH", tmp_path / "weather.duckdb")
+    yield tmp_path
+    close_all()
+
+
+def write_file(directory: Path, name: str, spec: tuple | None = None) -> Path:
+    values, location, header = spec or FILES[name]
+    path = directory / f"{name}.json"
+    path.write_text(json.dumps({"duration": 1.0, "data": [{"header": header or [], "value": values, "location": location}]}))
+    return path
+
+
+@pytest.mark.parametrize("name", FILES)
+def test_python_and_duckdb_modes_agree(pipeline_dirs, name):
+    path = write_file(pipeline_dirs / "data", name)
+    copy = pipeline_dirs / f"{name}_copy.json"
+    shutil.copy(path, copy)
+
+    python_ok = src2.validate_and_convert(path) is not None
+    duckdb_ok = src2.ingest_json_with_duckdb([copy]) == [copy]
+
+    assert python_ok == duckdb_ok == (name in ACCEPTED)
+    assert path.exists() == python_ok and copy.exists() == duckdb_ok   # file bị từ chối → ERROR_DIR
+
+
+@pytest.mark.parametrize("mode", ["python", "duckdb"])
+def test_compact_rejects_only_the_bad_files(pipeline_dirs, monkeypatch, mode):
+    monkeypatch.setattr(src2, "KEY_ENCODING", "compact")
+    data = pipeline_dirs / "data"
+    files = [
+        write_file(data, "good", FILES["valid"]),
+        write_file(data, "feb_30"),
+        write_file(data, "same_cell", ([ROW], [105.851, 21.03], None)),   # cùng ô 0.01° với good.json
+    ]
+
+    report = src2.run_pipeline(mode=mode, json_files=files)
+
+    statuses = {f["filename"]: f["status"] for f in report["files"]}
+    assert statuses == {"good.json": "loaded", "feb_30.json": "rejected", "same_cell.json": "rejected"}
+    assert sorted(p.name for p in (pipeline_dirs / "error").iterdir()) == ["feb_30.json", "same_cell.json"]
+    cur = get_manager(src2.DB_PATH).cursor()
+    assert cur.execute("SELECT longitude, latitude, day, month FROM weather_data_table").fetchall() == [(105.85, 21.03, 1, 1)]
+
+
+@pytest.mark.parametrize("json_last", [True, False])
+def test_duckdb_mode_mixed_batch_follows_upload_order(pipeline_dirs, json_last):
+    data = pipeline_dirs / "data"
+    json_file = write_file(data, "upload", ([[1, 1, 2000, 1, 11.0, 20.1, 0.0]], [105.85, 21.03], None))
+    parquet_file = data / "upload.parquet"
+    row = {"longitude": [105.85], "latitude": [21.03], "day": [1], "month": [1], "year": [2000],
+           "day_of_year": [1], "t2m_max": [22.0], "t2m_min": [20.1], "precipitation": [0.0]}
+    pq.write_table(pa.Table.from_pydict(row, schema=src2.ARROW_SCHEMA), parquet_file)
+    files = [parquet_file, json_file] if json_last else [json_file, parquet_file]
+
+    report = src2.run_pipeline(mode="duckdb", json_files=files)
+
+    assert [f["status"] for f in report["files"]] == ["loaded", "loaded"]
+    cur = get_manager(src2.DB_PATH).cursor()
+    assert cur.execute("SELECT t2m_max FROM weather_data_table").fetchall() == [(11.0 if json_last else 22.0,)]
+    assert src2.data_version() == 1   # cả batch là 1 giao dịch
@@ -0,0 +1,48 @@
+import json
+
+import pytest
+
+from json_stream import LocationStreamDecoder
+
+DOCUMENT = (
+    '{"duration": 51.23, "scale": -1.5e-3, "count": 12, "ok": true, "note": null, '
+    '"data": [{"header": ["day", "t2m_max"], "value": [[1, 2.5E+2], [2, -0.75]], "location": [105.85, 21.03]},'
+    ' {"header": [], "value": [], "location": [1e2, -9.0]}], "ratio": 6.02e23}'
+)
+
+
+def decode(chunks) -> tuple[list, dict]:
+    decoder = LocationStreamDecoder()
+    items = []
+    for chunk in chunks:
+        items += decoder.feed(chunk)
+    items += decoder.close()
+    return items, decoder.meta
+
+
+def test_every_split_point():
+    expected = json.loads(DOCUMENT)
+    raw = DOCUMENT.encode()
+    for i in range(len(raw) + 1):
+        items, meta = decode([raw[:i], raw[i:]])
+        assert items == expected["data"], i
+        assert meta == {k: v for k, v in expected.items() if k != "data"}, i
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 7])
+def test_small_chunks(chunk_size):
+    raw = b'{"data": [], "duration": 51.23}'
+    items, meta = decode(raw[i:i + chunk_size] for i in range(0, len(raw), chunk_size))
+    assert items == [] and meta == {"duration": 51.23}
+
+
+@pytest.mark.parametrize("document", [
+    '{"data": [], "duration": 51.x}',
+    '{"data": [], "duration": 1e}',
+    '{"data": [], "duration": tru}',
+    '{"data": [], "duration": 51.23',
+    '{"data": [{"value": [[1, 2]]}',
+])
+def test_invalid_documents(document):
+    with pytest.raises(ValueError):
+        decode([document[:len(document) // 2], document[len(document) // 2:]])
@@ -0,0 +1,33 @@
+import duckdb
+import pytest
+
+from key_encoding import create_weather_table, point_lookup, upsert_weather
+
+SCHEMA = ("longitude DOUBLE, latitude DOUBLE, day INTEGER, month INTEGER, year INTEGER, day_of_year INTEGER, "
+          "t2m_max DOUBLE, t2m_min DOUBLE, precipitation DOUBLE")
+ROWS = [
+    (105.85, 21.03, 1, 1, 2000, 1, 30.5, 20.1, 0.0),
+    (105.85, 21.03, 2, 1, 2000, 2, 31.0, 21.0, 1.5),
+    (106.66, 10.76, 1, 1, 2000, 1, 33.0, 24.0, 0.0),
+]
+
+
+@pytest.mark.parametrize("encoding", ["natural", "compact"])
+@pytest.mark.parametrize("key", [
+    (1, 1, 2000, 105.85, 21.03),
+    (2, 1, 2000, 105.85, 21.03),
+    (3, 1, 2000, 105.85, 21.03),    # ngày chưa có
+    (1, 1, 2000, 105.851, 21.03),   # cùng ô lưới, khác điểm
+    (30, 2, 2000, 105.85, 21.03),   # không phải ngày hợp lệ
+])
+def test_point_lookup_matches_view(encoding, key):
+    con = duckdb.connect()
+    create_weather_table(con, encoding)
+    con.execute(f"CREATE TEMP TABLE rows ({SCHEMA})")
+    con.executemany("INSERT INTO rows VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", ROWS)
+    upsert_weather(con, "rows", encoding)
+    expected = con.execute("""
+        SELECT * FROM weather_data_table
+        WHERE day = ? AND month = ? AND year = ? AND longitude = ? AND latitude = ?
+    """, list(key)).fetchall()
+    assert point_lookup(con, *key, encoding=encoding) == expected
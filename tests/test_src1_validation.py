@@ -0,0 +1,26 @@
+import numpy as np
+
+import src1
+
+# (longitude, latitude, day, month, year, day_of_year, t2m_max, t2m_min, precipitation)
+ROWS = [
+    [105.85, 21.03, 1, 1, 2000, 1, 30.5, 20.1, 0.0],
+    [105.85, 21.03, 29, 2, 2000, 60, 30.5, 20.1, 0.0],      # năm nhuận
+    [105.85, 21.03, 29, 2, 2001, 60, 30.5, 20.1, 0.0],      # date_calendar
+    [105.85, 21.03, 1, 13, 2000, 1, 30.5, 20.1, 0.0],       # month_range
+    [105.85, 21.03, 1.5, 1, 2000, 1, 30.5, 20.1, 0.0],      # day_int
+    [105.85, np.nan, 1, 1, 2000, 1, 30.5, 20.1, 0.0],       # latitude_type
+    [105.85, 21.03, 1, 1, 2000, 3e9, 30.5, 20.1, 0.0],      # day_of_year_range (tràn INTEGER)
+    [105.85, 21.03, 31, 12, 2000, 366, 30.5, 20.1, np.nan],  # precipitation_type
+]
+
+
+def test_validate_columns():
+    values = np.asarray(ROWS, dtype=np.float64).T
+    batch, reject, counts = src1.validate_columns({col: values[i] for i, col in enumerate(src1.FIELD_RULES)})
+
+    assert reject.tolist() == [False, False, True, True, True, True, True, True]
+    assert counts == {"date_calendar": 1, "month_range": 1, "day_int": 1, "latitude_type": 1,
+                      "day_of_year_range": 1, "precipitation_type": 1}
+    assert batch.schema == src1.ARROW_SCHEMA
+    assert batch.to_pydict()["day"] == [1, 29] and batch.to_pydict()["year"] == [2000, 2000]
@@ -0,0 +1,117 @@
+"""
+Long-lived process pool for the JSON conversion step.
+
+The pool is created once (e.g. at FastAPI startup), every worker runs the initializer up
+front (imports + Great Expectations context), and each pipeline run only submits work.
+Work is split adaptively: small runs are packed into a few tasks so that a single small
+upload does not fan out over every core, large runs spread over all workers.
+"""
+import logging
+import math
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+from typing import Callable
+
+MIN_BYTES_PER_WORKER = 32 * 1024 * 1024   # dưới ngưỡng này không đáng tách thêm worker
+
+
+def _warm_up(delay: float) -> int:
+    # Giữ worker bận một chút để các task warm-up rơi vào các process khác nhau
+    time.sleep(delay)
+    return os.getpid()
+
+
+def _run_group(fn: Callable, files: list[Path], args: tuple) -> list:
+    return [fn(f, *args) for f in files]
+
+
+def plan_groups(files: list[Path], max_workers: int,
+                min_bytes_per_worker: int = MIN_BYTES_PER_WORKER) -> list[list[Path]]:
+    """
+    Split ``files`` into at most ``max_workers`` groups of roughly equal total size.
+
+    The number of groups grows with the total input size (one per ``min_bytes_per_worker``)
+    and is capped by the number of files, so a handful of small files runs in one task.
+    """
+    if not files:
+        return []
+    sizes = {f: (f.stat().st_size if f.exists() else 0) for f in files}
+    total = sum(sizes.values())
+    n_groups = max(1, min(max_workers, len(files), math.ceil(total / min_bytes_per_worker)))
+
+    # Largest-first greedy: file tiếp theo vào nhóm đang nhẹ nhất
+    groups = [[] for _ in range(n_groups)]
+    loads = [0] * n_groups
+    for f in sorted(files, key=sizes.get, reverse=True):
+        i = loads.index(min(loads))
+        groups[i].append(f)
+        loads[i] += sizes[f]
+    return [g for g in groups if g]
+
+
+class WorkerPool:
+    """
+    A ProcessPoolExecutor that is started once and reused across pipeline runs.
+
+    Args:
+        max_workers (int | None): Upper bound on worker processes (defaults to the CPU count).
+        initializer (Callable | None): Run once in each worker process, e.g. ``src2.init_worker``.
+        min_bytes_per_worker (int): Input size that justifies one more parallel task.
+    """
+
+    def __init__(self, max_workers: int | None = None, initializer: Callable | None = None,
+                 min_bytes_per_worker: int = MIN_BYTES_PER_WORKER):
+        self.max_workers = max_workers or os.cpu_count()
+        self.initializer = initializer
+        self.min_bytes_per_worker = min_bytes_per_worker
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def start(self, warm: bool = True) -> "WorkerPool":
+        """Create the executor and, if ``warm``, spawn and initialize every worker now."""
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.max_workers, initializer=self.initializer)
+        if warm:
+            futures = [self._executor.submit(_warm_up, 0.05) for _ in range(self.max_workers)]
+            pids = {f.result() for f in futures}
+            logging.info(f"🔥 Worker pool ready: {len(pids)} warm processes.")
+        return self
+
+    def shutdown(self) -> None:
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True, cancel_futures=True)
+                self._executor = None
+
+    def _restart(self) -> None:
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = ProcessPoolExecutor(max_workers=self.max_workers, initializer=self.initializer)
+
+    def map_files(self, fn: Callable, files: list[Path], *args) -> list:
+        """
+        Run ``fn(file, *args)`` for every file on the warm workers and return the results
+        in the order of ``files``. Exceptions raised by ``fn`` propagate.
+        """
+        if self._executor is None:
+            self.start(warm=False)
+        groups = plan_groups(files, self.max_workers, self.min_bytes_per_worker)
+        logging.info(f"🧮 {len(files)} files → {len(groups)} tasks on a pool of {self.max_workers} workers.")
+
+        by_file = {}
+        try:
+            futures = {self._executor.submit(_run_group, fn, group, args): group for group in groups}
+            for future in as_completed(futures):
+                by_file.update(zip(futures[future], future.result()))
+        except BrokenProcessPool:
+            # Một worker chết (vd OOM): dựng lại pool cho các lần chạy sau
+            logging.error("❌ Worker pool broken, restarting it.")
+            self._restart()
+            raise
+        return [by_file[f] for f in files]